@@ -0,0 +1,65 @@
+""" Compare building models from server responses with and without pydantic validation.
+
+    python benchmarks/bench_models.py [n]
+"""
+import sys, os
+sys.path.insert(0, os.getcwd())
+import random
+import time
+
+from projectkiwi.models import Annotation, Label, Task, Tile
+
+
+def annotationsPayload(n: int) -> dict:
+    annotations = {}
+    for i in range(n):
+        lng, lat = random.uniform(-180, 180), random.uniform(-80, 80)
+        annotations[str(i)] = {
+            'shape': "Polygon",
+            'label_id': 374,
+            'label_name': "airport",
+            'label_color': "rgb(10, 184, 227)",
+            'coordinates': [[lng + random.random()*1e-3, lat + random.random()*1e-3] for _ in range(12)],
+            'url': None,
+            'imagery_id': "NULL",
+            'confidence': random.random() if i % 2 else "NULL"
+        }
+    return annotations
+
+
+def timeIt(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def compare(name: str, validated, fast):
+    slow = timeIt(validated)
+    quick = timeIt(fast)
+    print(f"{name:<12} validated: {slow*1000:8.1f}ms  fast: {quick*1000:8.1f}ms  speedup: {slow/quick:5.1f}x")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    annotations = annotationsPayload(n)
+    tasks = [{'complete': i % 2, 'id': i, 'imagery_id': "abc", 'queue': 3, 'submitter_login': None,
+            'zxy': f"18/{i}/{i}"} for i in range(n)]
+    tiles = [{'zxy': f"18/{i}/{i}", 'url': f"https://api.projectkiwi.io/get_tile/abc/18/{i}/{i}"} for i in range(n)]
+    labels = [{'id': i, 'project_id': "p", 'color': "#fff", 'name': f"label {i}", 'status': "active"} for i in range(n)]
+
+    print(f"{n} of each")
+    compare("Annotation",
+            lambda: [Annotation.from_dict(data, annotation_id) for annotation_id, data in annotations.items()],
+            lambda: Annotation.from_dicts_fast(annotations, validate=False))
+    compare("Task",
+            lambda: [Task(**task) for task in tasks],
+            lambda: Task.from_dicts_fast(tasks, validate=False))
+    compare("Tile",
+            lambda: [Tile.from_zxy(zxy=tile['zxy'], imagery_id="abc", url=tile['url']) for tile in tiles],
+            lambda: Tile.from_dicts_fast(tiles, "abc", validate=False))
+    compare("Label",
+            lambda: [Label(**label) for label in labels],
+            lambda: Label.from_dicts_fast(labels, validate=False))
@@ -0,0 +1,61 @@
+""" Compare the old pairwise shapely nms with the tensor nms, for one tile of detections.
+
+    python benchmarks/bench_nms.py [n]
+"""
+import sys, os
+sys.path.insert(0, os.getcwd())
+import time
+
+import numpy as np
+import torch
+
+from projectkiwi.data import nonMaximumSuppression
+from projectkiwi.nms import boxNMS, maskNMS, softNMS
+from projectkiwi.tools import bbox_iou
+
+
+def pairwiseNMS(boxes, scores, iou_threshold=0.3):
+    # how data.nonMaximumSuppression worked before
+    keep = []
+    for i, (box, score) in enumerate(zip(boxes, scores)):
+        skip = False
+        for j, (box2, score2) in enumerate(zip(boxes, scores)):
+            if i != j and score2 > score:
+                if bbox_iou(box, box2) > iou_threshold:
+                    skip = True
+        if not skip:
+            keep.append(i)
+    return keep
+
+
+def timeIt(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(0, 448, (n, 2))
+    boxes = np.concatenate([xy, xy + rng.uniform(10, 64, (n, 2))], 1).astype(np.float32)
+    scores = rng.uniform(0, 1, n).astype(np.float32)
+    class_ids = rng.integers(1, 4, n)
+    masks = torch.rand((n, 1, 512, 512)) > 0.99
+
+    tensorBoxes, tensorScores, tensorIds = torch.from_numpy(boxes), torch.from_numpy(scores), torch.from_numpy(class_ids)
+
+    print(f"{n} detections")
+    old = timeIt(lambda: pairwiseNMS(list(boxes), list(scores)), repeat=1)
+    print(f"{'pairwise shapely':<24} {old*1000:9.2f}ms")
+    for name, fn in [
+            ("list wrapper", lambda: nonMaximumSuppression(list(boxes), list(scores), list(class_ids))),
+            ("box nms", lambda: boxNMS(tensorBoxes, tensorScores)),
+            ("box nms, class aware", lambda: boxNMS(tensorBoxes, tensorScores, tensorIds, class_aware=True)),
+            ("soft nms", lambda: softNMS(tensorBoxes, tensorScores)),
+            ("mask nms 512px", lambda: maskNMS(masks, tensorScores))]:
+        seconds = timeIt(fn)
+        print(f"{name:<24} {seconds*1000:9.2f}ms  speedup: {old/seconds:8.1f}x")
@@ -0,0 +1,97 @@
+""" Compare converting polygon vertices between lng/lat and tile coordinates one at a time
+with math (how tools did it before) and all at once with the array functions.
+
+    python benchmarks/bench_tools.py [n]
+"""
+import sys, os
+sys.path.insert(0, os.getcwd())
+import gc
+import math
+import random
+import time
+
+import numpy as np
+
+from projectkiwi.tools import (coordsFromPolygon, coordsFromPolygons, latLngToImgCoords, latLngsToImgCoords,
+        lngLatToTile, raggedFromPolygons, tileToLngLat)
+
+
+def deg2numScalar(lat_deg: float, lon_deg: float, zoom: int):
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    return (lon_deg + 180.0) / 360.0 * n, (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+
+
+def num2degScalar(xtile: float, ytile: float, zoom: int):
+    n = 2.0 ** zoom
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))), xtile / n * 360.0 - 180.0
+
+
+def timeIt(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def compare(name: str, n: int, scalar, array):
+    slow = timeIt(scalar)
+    quick = timeIt(array)
+    print(f"{name:<22} scalar: {slow/n*1e9:8.1f}ns/vertex  array: {quick/n*1e9:8.1f}ns/vertex  speedup: {slow/quick:5.1f}x")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lngLat = [[-87.7 + random.random()*0.1, 41.8 + random.random()*0.1] for _ in range(n)]
+    tile = [[random.random()*256, random.random()*256] for _ in range(n)]
+    zxy = "12/1051/1522"
+
+    print(f"{n} vertices")
+    compare("deg2num", n,
+            lambda: [deg2numScalar(lat, lng, 18) for lng, lat in lngLat],
+            lambda: lngLatToTile(lngLat, 18))
+    compare("num2deg", n,
+            lambda: [num2degScalar(x, y, 18) for x, y in tile],
+            lambda: tileToLngLat(tile, 18))
+
+    # without converting from and to lists
+    lngLatArray, tileArray = np.array(lngLat), np.array(tile)
+    compare("deg2num (numpy in)", n,
+            lambda: [deg2numScalar(lat, lng, 18) for lng, lat in lngLatArray.tolist()],
+            lambda: lngLatToTile(lngLatArray, 18))
+    compare("num2deg (numpy in)", n,
+            lambda: [num2degScalar(x, y, 18) for x, y in tileArray.tolist()],
+            lambda: tileToLngLat(tileArray, 18))
+    compare("latLngToImgCoords", n,
+            lambda: [(int((x - 1051)*256), int((y - 1522)*256))
+                    for x, y in (deg2numScalar(lat, lng, 12) for lng, lat in lngLat)],
+            lambda: latLngToImgCoords(lngLat, zxy, 256))
+    compare("coordsFromPolygon", n,
+            lambda: [num2degScalar(x/256 + 1051, y/256 + 1522, 12)[::-1] for x, y in tile],
+            lambda: coordsFromPolygon(tile, zxy, 256))
+
+    # a typical polygon is a handful of vertices, where the fixed cost of the array calls matters
+    polygon = tile[:12]
+    compare("coordsFromPolygon x12", 12*10000,
+            lambda: [[num2degScalar(x/256 + 1051, y/256 + 1522, 12)[::-1] for x, y in polygon] for _ in range(10000)],
+            lambda: [coordsFromPolygon(polygon, zxy, 256) for _ in range(10000)])
+
+    # a tile of dense detections, every polygon converted at once from a flat vertex array.
+    # the vertices above stay alive, keep the garbage collector from rescanning them
+    gc.freeze()
+    detections = [[[random.random()*256, random.random()*256] for _ in range(5)] for _ in range(300)]
+    vertices, offsets = raggedFromPolygons(detections)
+    compare("300 polygons (ragged)", 300*5*100,
+            lambda: [[[num2degScalar(x/256 + 1051, y/256 + 1522, 12)[::-1] for x, y in polygon] for polygon in detections]
+                    for _ in range(100)],
+            lambda: [coordsFromPolygons(vertices, offsets, zxy, 256) for _ in range(100)])
+    # the dataset reads the flat vertices straight from its AnnotationTable
+    lngLatPolygons = coordsFromPolygons(vertices, offsets, zxy, 256)
+    lngLat, lngLatOffsets = raggedFromPolygons(lngLatPolygons)
+    compare("300 annotations (ragged)", 300*5*100,
+            lambda: [[[(int((x - 1051)*256), int((y - 1522)*256))
+                    for x, y in (deg2numScalar(lat, lng, 12) for lng, lat in polygon)] for polygon in lngLatPolygons]
+                    for _ in range(100)],
+            lambda: [latLngsToImgCoords(lngLat, lngLatOffsets, zxy, 256) for _ in range(100)])
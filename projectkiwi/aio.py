@@ -0,0 +1,504 @@
+import asyncio
+import json
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+import numpy as np
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from projectkiwi.tools import decodeTile, randomLabelColor, splitZXY, urlFromZxy
+from projectkiwi.models import Annotation, Project, ImageryLayer, Tile, TileArray, Task, Label
+from projectkiwi.metrics import HTTPMetrics, bodySize
+from projectkiwi.session import (
+        DEFAULT_TIMEOUTS,
+        IDEMPOTENT_METHODS,
+        RETRY_STATUSES,
+        backoffDelay,
+        parseRetryAfter,
+        tileRoute,
+        timeoutForRoute)
+
+
+
+class AsyncConnector():
+    """asyncio version of projectkiwi.connector.Connector, requires aiohttp (pip install projectkiwi[async]).
+
+    The methods mirror Connector but are coroutines. In-flight requests are bounded per host by a
+    semaphore, and tiles are decoded in an executor so that decoding never stalls the event loop.
+
+    Args:
+        key (str): API key.
+        url (str, optional): url for api, in case of multiple instances. Defaults to "https://projectkiwi.io/".
+        limit_per_host (int, optional): maximum number of concurrent requests to each host. Defaults to 64.
+        max_retries (int, optional): retries on 429/5xx statuses and connection errors. Defaults to 5.
+        backoff_factor (float, optional): base delay in seconds for exponential backoff between retries. Defaults to 0.5.
+        timeouts (dict, optional): (connect, read) timeouts by route name e.g. {'get_annotations': (5, 300)}. Defaults to None.
+        executor (concurrent.futures.Executor, optional): executor used to decode tiles, the loop default if None. Defaults to None.
+        metrics (HTTPMetrics, optional): record latency, bytes, retries and statuses by route here. Defaults to None, a new one available as conn.metrics.
+
+    Example:
+        >>> async with AsyncConnector(API_KEY) as conn:
+        ...     tiles = await asyncio.gather(*[conn.getTile(imagery_id, z, x, y) for z, x, y in zxys])
+    """
+
+    def __init__(self, key, url="https://projectkiwi.io/",
+            limit_per_host: int = 64,
+            max_retries: int = 5,
+            backoff_factor: float = 0.5,
+            timeouts: dict = None,
+            executor = None,
+            metrics: HTTPMetrics = None):
+
+        if aiohttp is None:
+            raise ImportError("AsyncConnector requires aiohttp, install it with: pip install projectkiwi[async]")
+
+        self.key = key
+        self.url = url
+        self.limit_per_host = limit_per_host
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = 30
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+        self.executor = executor
+        self.metrics = metrics if metrics is not None else HTTPMetrics()
+
+        self._client = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """ close the underlying http client
+        """
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+    def _getClient(self):
+        if self._client is None or self._client.closed:
+            self._client = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.limit_per_host))
+        return self._client
+
+    def _getSemaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.limit_per_host)
+        return self._semaphores[host]
+
+
+    async def _request(self, method: str, route: str, url: str = None, idempotent: bool = None, **kwargs) -> bytes:
+        """ make a request, retrying on connection errors and retryable statuses.
+        Requests that aren't idempotent are only retried when the connection couldn't be made, see Session.request
+
+        Args:
+            method (str): http method e.g. GET
+            route (str): route name e.g. api/get_imagery, used for timeouts
+            url (str, optional): full url if not under the api url. Defaults to None.
+            idempotent (bool, optional): whether the request is safe to send twice. Defaults to None, true for GET, HEAD, PUT, DELETE and OPTIONS.
+
+        Returns:
+            bytes: response body
+        """
+        if url is None:
+            url = self.url + route
+        connect, read = timeoutForRoute(self.timeouts, route)
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+
+        client = self._getClient()
+        semaphore = self._getSemaphore(url)
+        bytes_out = bodySize(kwargs.get('data'))
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            try:
+                async with semaphore:
+                    start = time.monotonic()
+                    async with client.request(method, url, **kwargs) as r:
+                        if r.status in RETRY_STATUSES and attempt <= self.max_retries and idempotent:
+                            retry_after = parseRetryAfter(r.headers.get('Retry-After'))
+                            self.metrics.record(route, method, r.status, time.monotonic() - start,
+                                    r.content_length or 0, bytes_out, attempt)
+                        else:
+                            content = await r.read()
+                            self.metrics.record(route, method, r.status, time.monotonic() - start,
+                                    len(content), bytes_out, attempt)
+                            r.raise_for_status()
+                            return content
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.metrics.record(route, method, None, time.monotonic() - start, 0, bytes_out, attempt)
+                if attempt > self.max_retries or not (idempotent or isConnectError(e)):
+                    raise
+            await asyncio.sleep(backoffDelay(attempt, self.backoff_factor, self.backoff_max, retry_after))
+
+
+    async def _getJSON(self, route: str, params: dict):
+        return json.loads(await self._request("GET", route, params=params))
+
+    async def _postJSON(self, route: str, data: dict):
+        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+        return json.loads(await self._request("POST", route, data=json.dumps(data), headers=headers))
+
+
+    async def getImagery(self, project_id: str) -> List[ImageryLayer]:
+        """Get a list of imagery layers for a project
+
+        Args:
+            project_id (str): ID of the project to get all the imagery for.
+
+        Returns:
+            List[ImageryLayer]: list of imagery layers
+        """
+        imageryList = await self._getJSON("api/get_imagery", {'key': self.key, 'project_id': project_id})
+        return [ImageryLayer(**layer) for layer in imageryList]
+
+
+    async def getTileContent(self,
+            imagery_id: str,
+            z: int,
+            x: int,
+            y: int,
+            tile_size: int = 256,
+            tile_buffer: int = 0
+        ) -> bytes:
+        """Download the encoded image for a tile without decoding it
+
+        Args:
+            imagery_id (str): id of the imagery
+            z (int): zoom
+            x (int): x tile
+            y (int): y tile
+            tile_size (int): width or height of the square tile
+            tile_buffer (int): number of pixels to read each side of the tile
+
+        Returns:
+            bytes: encoded tile
+        """
+        url = urlFromZxy(z, x, y, imagery_id, self.url)
+        params = {
+            'key': self.key,
+            'tile_size': tile_size,
+            'tile_buffer': tile_buffer
+        }
+        return await self._request("GET", tileRoute(tile_size), url=url, params=params)
+
+
+    async def getTile(self,
+            imagery_id: str,
+            z: int,
+            x: int,
+            y: int,
+            tile_size: int = 256,
+            tile_buffer: int = 0
+        ) -> np.ndarray:
+        """Download a tile given the z,x,y and id, the image is decoded in an executor
+
+        Args:
+            imagery_id (str): id of the imagery
+            z (int): zoom
+            x (int): x tile
+            y (int): y tile
+            tile_size (int): width or height of the square tile
+            tile_buffer (int): number of pixels to read each side of the tile
+
+        Returns:
+            np.ndarray: numpy array of tile
+        """
+        content = await self.getTileContent(imagery_id, z, x, y, tile_size, tile_buffer)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, decodeTile, content)
+
+
+    async def getSuperTile(self,
+                imagery_id: str,
+                zxy: str,
+                max_zoom: int = 22,
+                padding: int = 0
+        ) -> np.ndarray:
+        """Get a tile as higher resolution, as specified by the max zoom.
+
+        Args:
+            imagery_id (str): The ID of the imagery
+            zxy (str): zxy string to specify the tile e.g. 12/345/678
+            max_zoom (int, optional): Maximum zoom. Defaults to 22.
+            padding (int, optional): Number of pixels to read on each side of the tile. Defaults to 0.
+
+        Returns:
+            np.ndarray: Image data for the tile.
+        """
+        z,x,y = splitZXY(zxy)
+        width = 256*2**(max_zoom - z)
+        return await self.getTile(imagery_id, z, x, y, tile_size=width, tile_buffer=padding)
+
+
+    async def getTileList(self,
+            imagery_id: str,
+            project_id: str,
+            zoom: int) -> List[Tile]:
+        """Get a list of tiles for a given imagery id
+
+        Args:
+            imagery_id (str): ID of the imagery to retrieve a list of tiles for
+            project_id (str): ID of the project
+            zoom (int): Zoom level
+
+        Returns:
+            List[Tile]: A list of tiles with zxy and url
+        """
+        params = {
+            'key': self.key,
+            'imagery_id': imagery_id,
+            'project_id': project_id,
+            'zoom': zoom}
+        tileList = await self._getJSON("api/get_tile_list", params)
+        return Tile.from_dicts_fast(tileList, imagery_id)
+
+
+    async def getTileArray(self,
+            imagery_id: str,
+            project_id: str,
+            zoom: int) -> TileArray:
+        """Get the tiles for a given imagery id as a compact TileArray, for large tile lists
+
+        Args:
+            imagery_id (str): ID of the imagery to retrieve a list of tiles for
+            project_id (str): ID of the project
+            zoom (int): Zoom level
+
+        Returns:
+            TileArray: the tiles, indexing it gives Tile objects
+        """
+        params = {
+            'key': self.key,
+            'imagery_id': imagery_id,
+            'project_id': project_id,
+            'zoom': zoom}
+        tileList = await self._getJSON("api/get_tile_list", params)
+        return TileArray.from_list(tileList, imagery_id)
+
+
+    async def getImageryStatus(self, imagery_id: str) -> str:
+        """ Get the status of imagery
+
+        Args:
+            imagery_id (str): Imagery id
+
+        Returns:
+            str: status
+        """
+        data = await self._getJSON("api/get_imagery_status", {'key': self.key, 'imagery_id': imagery_id})
+        return data['status']
+
+
+    async def getProjects(self) -> List[Project]:
+        """Get a list of projects for a user
+
+        Returns:
+            List[Projects]: projects
+        """
+        projectList = await self._getJSON("api/get_projects", {'key': self.key})
+        assert len(projectList) > 0, "Error: No projects found"
+        return [Project(**proj) for proj in projectList]
+
+
+    async def getImageryUrl(self, imagery_id: str, project_id: str) -> str:
+        """Get the url for imagery from it's id
+
+        Args:
+            imagery_id (str): Id for the imagery
+            project_id (str): Project to look in
+
+        Returns:
+            str: The url template
+        """
+        imagery = await self.getImagery(project_id)
+        return [image.url for image in imagery if image.id == imagery_id][0]
+
+
+    async def getAnnotations(self, project_id: str) -> List[Annotation]:
+        """Get all annotations in a project
+
+        Args:
+            project_id (str): id for the project to get the annotations for
+
+        Returns:
+            List[Annotation]: annotations
+        """
+        content = await self._request("GET", "api/get_annotations", params={'key': self.key, 'project_id': project_id})
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _parseAnnotations, content)
+
+
+    async def getPredictions(self, project_id: str) -> List[Annotation]:
+        """Get all predictions in a project
+
+        Args:
+            project_id (str): id for the project to get the predictions for
+
+        Returns:
+            List[Annotation]: predictions
+        """
+        annotations = await self.getAnnotations(project_id)
+        return [annotation for annotation in annotations if annotation.confidence != None]
+
+
+    async def getTasks(self, queue_id: int) -> List[Task]:
+        """Get a list of tasks in a queue.
+
+        Args:
+            queue_id (int): The ID of the queue
+
+        Returns:
+            List[Task]: list of tasks
+        """
+        data = await self._getJSON("api/get_tasks", {'key': self.key, "queue_id": queue_id})
+        assert data['success'] == True, "Failed to get tasks"
+        return Task.from_dicts_fast(data['task'])
+
+
+    async def getTask(self, queue_id: int) -> Task:
+        """Get a random task for a queue.
+
+        Args:
+            queue_id (int): The ID of the queue
+
+        Returns:
+            Task: task
+        """
+        data = await self._getJSON("api/get_task", {'key': self.key, "queue_id": queue_id})
+        assert data['success'] == True, "Failed to get tasks"
+        return Task(**data['task'])
+
+
+    async def getNextTask(self, queue_id: int) -> Task:
+        """Get a predictable next task for a queue.
+
+        Args:
+            queue_id (int): The ID of the queue
+
+        Returns:
+            Task: task
+        """
+        data = await self._getJSON("api/get_next_task", {'key': self.key, "queue_id": queue_id})
+        assert data['success'] == True, "Failed to get tasks"
+        return Task(**data['task'])
+
+
+    async def addAnnotation(self, annotation: Annotation, project: str) -> int:
+        """Add an annotation to a project
+
+        Args:
+            annotation (Annotation): the annotation to add (note that not everything is mandatory)
+            project (str): project id
+
+        Returns:
+            int: annotation id if successful
+        """
+        annoDict = dict(annotation)
+        annoDict['project_id'] = project
+        annoDict['key'] = self.key
+        jsonResponse = await self._postJSON("api/add_annotation", annoDict)
+        return jsonResponse['annotation_id']
+
+
+    async def addPrediction(self, annotation: Annotation, project: str) -> int:
+        """Add a prediction to a project
+
+        Args:
+            annotation (Annotation): an annotation object with a confidence value
+            project (str): project id
+
+        Returns:
+            int: annotation id if successful
+        """
+        assert not annotation.confidence is None, "No confidence for prediction"
+        annoDict = dict(annotation)
+        annoDict['project_id'] = project
+        annoDict['key'] = self.key
+        jsonResponse = await self._postJSON("api/add_prediction", annoDict)
+        return jsonResponse['annotation_id']
+
+
+    async def removeAllPredictions(self, project_id: str):
+        """Remove all predictions in a project
+
+        Args:
+            project_id (str): project id
+        """
+        params = {'key': self.key, 'project_id': project_id}
+        await self._request("DELETE", "api/remove_all_predictions",
+                headers={'Content-Type': 'application/json'},
+                data=json.dumps(params))
+
+
+    async def getLabels(self, project_id: str) -> List[Label]:
+        """Get all labels in a project
+
+        Args:
+            project_id (str): id for the project to get the labels for
+
+        Returns:
+            List[Label]: labels
+        """
+        labelsJSON = await self._getJSON("api/get_labels", {'key': self.key, 'project_id': project_id})
+        return Label.from_dicts_fast(labelsJSON)
+
+
+    async def addLabel(self, name: str, project_id: str, color: str = None) -> Label:
+        """ add a label to the project
+
+        Args:
+            name (str): name of the label e.g. object class
+            project_id (str): id of the project that the label will belong to
+            color (str, optional): Color string for the label e.g. rgb(255, 0, 100), will be selected randomly if not supplied. Defaults to None.
+
+        Returns:
+            Label: the label including it's id
+        """
+        if color is None:
+            color = randomLabelColor()
+        labelDict = {
+            'key': self.key,
+            'project_id': project_id,
+            'name': name,
+            'status': 'active',
+            'color': color
+        }
+        jsonResponse = await self._postJSON("api/add_label", labelDict)
+        return Label(**jsonResponse)
+
+
+
+def _parseAnnotations(content: bytes) -> List[Annotation]:
+    annotationsDict = json.loads(content)
+    return Annotation.from_dicts_fast(annotationsDict)
+
+
+
+def isConnectError(e: Exception) -> bool:
+    """ whether an aiohttp request failed while connecting, before the server could have seen it
+
+    Args:
+        e (Exception): exception raised by aiohttp
+
+    Returns:
+        bool: True for connection refused, dns failures and connect timeouts
+    """
+    return isinstance(e, (aiohttp.ClientConnectorError, getattr(aiohttp, 'ConnectionTimeoutError', ())))
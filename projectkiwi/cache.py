@@ -0,0 +1,556 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from projectkiwi.models import Annotation
+from projectkiwi.stream import iterObjectItems
+from projectkiwi.tools import decodeTile
+
+
+
+class AnnotationMirror():
+    """On-disk mirror of the annotations in each project, revalidated with conditional requests.
+
+    The raw api/get_annotations payload is kept on disk along with its ETag, Last-Modified and
+    sha256. Requests are sent with If-None-Match/If-Modified-Since, so an unchanged project
+    costs a 304. Servers that ignore conditional requests still send the payload, but it is only
+    re-parsed if its hash has changed. Parsed annotations are kept in memory for reuse.
+
+    Args:
+        directory (Union[str, Path]): where to keep the mirrored annotations.
+
+    Example:
+        >>> conn = Connector(API_KEY, annotation_cache="./cache")
+        >>> annotations = conn.getAnnotations(project_id)  # downloaded
+        >>> annotations = conn.getAnnotations(project_id)  # 304, nothing parsed
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory) / "annotations"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._parsed: Dict[str, Tuple[str, List[Annotation]]] = {}
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_parsed'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def _paths(self, project_id: str) -> Tuple[Path, Path]:
+        name = hashlib.sha1(str(project_id).encode()).hexdigest()
+        return self.directory / f"{name}.json", self.directory / f"{name}.meta.json"
+
+
+    def meta(self, project_id: str) -> dict:
+        """ validators for the mirrored payload
+
+        Args:
+            project_id (str): project id
+
+        Returns:
+            dict: etag, last_modified and sha256, empty if the project isn't mirrored
+        """
+        payloadPath, metaPath = self._paths(project_id)
+        if not payloadPath.exists() or not metaPath.exists():
+            return {}
+        with open(metaPath) as f:
+            return json.load(f)
+
+
+    def conditionalHeaders(self, project_id: str) -> dict:
+        """ headers to revalidate the mirrored payload with
+
+        Args:
+            project_id (str): project id
+
+        Returns:
+            dict: If-None-Match and/or If-Modified-Since headers
+        """
+        meta = self.meta(project_id)
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+
+    def store(self, project_id: str, chunks: Iterable[bytes], headers: dict = None) -> bool:
+        """ store a freshly downloaded payload
+
+        Args:
+            project_id (str): project id
+            chunks (Iterable[bytes]): the response body
+            headers (dict, optional): response headers, for the ETag and Last-Modified. Defaults to None.
+
+        Returns:
+            bool: whether the payload differs from the mirrored one
+        """
+        headers = headers or {}
+        payloadPath, metaPath = self._paths(project_id)
+        tmpPath = payloadPath.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+        sha256 = hashlib.sha256()
+        with open(tmpPath, "wb") as f:
+            for chunk in chunks:
+                sha256.update(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+
+        changed = self.meta(project_id).get('sha256') != digest
+        if changed:
+            os.replace(tmpPath, payloadPath)
+        else:
+            os.remove(tmpPath)
+
+        meta = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'sha256': digest
+        }
+        tmpMeta = metaPath.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmpMeta, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmpMeta, metaPath)
+        return changed
+
+
+    def annotations(self, project_id: str) -> List[Annotation]:
+        """ the mirrored annotations, parsed only if the payload changed since they were last parsed
+
+        Args:
+            project_id (str): project id
+
+        Returns:
+            List[Annotation]: annotations (a new list, but the Annotation objects are shared)
+        """
+        digest = self.meta(project_id).get('sha256')
+        assert digest is not None, f"Project {project_id} has not been mirrored"
+
+        with self._lock:
+            cached = self._parsed.get(project_id)
+            if cached is not None and cached[0] == digest:
+                return list(cached[1])
+
+        payloadPath, _ = self._paths(project_id)
+        with open(payloadPath, "rb") as f:
+            chunks = iter(lambda: f.read(2**16), b"")
+            annotations = Annotation.from_dicts_fast(iterObjectItems(chunks))
+
+        with self._lock:
+            self._parsed[project_id] = (digest, annotations)
+        return list(annotations)
+
+
+
+class TTLCache():
+    """Thread-safe in-memory cache whose entries expire after a fixed time.
+
+    Keys are tuples, the first element naming what is cached e.g. ("labels", project_id), so
+    related entries can be invalidated together by prefix.
+
+    Args:
+        ttl (float): seconds an entry stays valid.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: Dict[tuple, Tuple[float, object]] = {}
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def get(self, key: tuple) -> Tuple[bool, object]:
+        """ look up a key, counting the hit or miss
+
+        Args:
+            key (tuple): key
+
+        Returns:
+            Tuple[bool, object]: whether a valid entry was found, and its value
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+
+    def put(self, key: tuple, value):
+        """ store a value
+
+        Args:
+            key (tuple): key
+            value: value
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+
+    def invalidate(self, *prefix):
+        """ drop entries whose key starts with prefix, everything if no prefix is given
+
+        Args:
+            prefix: leading elements of the keys to drop e.g. invalidate("labels", project_id)
+        """
+        with self._lock:
+            for key in list(self._data):
+                if key[:len(prefix)] == prefix:
+                    del self._data[key]
+
+
+    def stats(self) -> dict:
+        """ hit/miss counters
+
+        Returns:
+            dict: hits, misses and the number of entries
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+
+# disk hits are recorded in memory and written to the index in batches of this many
+ACCESS_FLUSH_READS = 64
+
+
+class TileCache():
+    """Two-tier tile cache: decoded arrays in memory, backed by encoded tiles on disk.
+
+    The memory tier is an LRU of decoded arrays bounded by memory_bytes. The disk tier stores the
+    encoded tiles content-addressed by their sha256 (identical tiles, e.g. blank ones, are stored
+    once) with an sqlite index, and is bounded by disk_bytes with lru or lfu eviction. The disk tier
+    is shared between processes, e.g. DataLoader workers. Disk hits update the eviction order in
+    batches (see flush) so reads don't take the index's write lock.
+
+    Keys are (imagery_id, z, x, y, tile_size, tile_buffer). Cached arrays are read-only, copy them
+    before modifying.
+
+    Args:
+        directory (Union[str, Path], optional): where to keep tiles on disk, memory only if None. Defaults to None.
+        memory_bytes (int, optional): budget for decoded tiles in memory. Defaults to 256MB.
+        disk_bytes (int, optional): budget for encoded tiles on disk. Defaults to 4GB.
+        eviction (str, optional): disk eviction policy, "lru" or "lfu". Defaults to "lru".
+
+    Example:
+        >>> conn = Connector(API_KEY, tile_cache=TileCache("./cache"))
+        >>> tile = conn.getTile(imagery_id, 13, 2101, 3045)  # downloaded
+        >>> tile = conn.getTile(imagery_id, 13, 2101, 3045)  # from memory
+        >>> conn.tile_cache.stats()['hit_rate']
+        0.5
+    """
+
+    def __init__(self,
+            directory: Union[str, Path] = None,
+            memory_bytes: int = 256*2**20,
+            disk_bytes: int = 4*2**30,
+            eviction: str = "lru"):
+
+        assert eviction in ("lru", "lfu"), f"Unknown eviction policy: {eviction}"
+        self.directory = None if directory is None else Path(directory) / "tiles"
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.eviction = eviction
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.RLock()
+        self._db = None
+        self._pid = None
+        self._accesses = {}
+        self._unflushed_reads = 0
+
+        if self.directory is not None:
+            (self.directory / "blobs").mkdir(parents=True, exist_ok=True)
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_db'] = None
+        state['_pid'] = None
+        state['_accesses'] = {}
+        state['_memory'] = OrderedDict()
+        state['_memory_used'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+    @staticmethod
+    def _keyString(key: tuple) -> str:
+        return "/".join(str(k) for k in key)
+
+
+    def _getDB(self) -> sqlite3.Connection:
+        # connections can't be shared across a fork, open one per process
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(str(self.directory / "index.sqlite"), timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, digest TEXT, last_access REAL, hits INTEGER)""")
+            self._db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER)")
+            self._db.commit()
+            self._pid = os.getpid()
+            # the parent process flushes the hits it recorded before the fork
+            self._accesses = {}
+            self._unflushed_reads = 0
+        return self._db
+
+
+    def _blobPath(self, digest: str) -> Path:
+        return self.directory / "blobs" / digest[:2] / f"{digest}.tile"
+
+
+    def _putMemory(self, key: tuple, array: np.ndarray):
+        if array.nbytes > self.memory_bytes:
+            return
+        array.flags.writeable = False
+        if key in self._memory:
+            self._memory_used -= self._memory.pop(key).nbytes
+        self._memory[key] = array
+        self._memory_used += array.nbytes
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= evicted.nbytes
+
+
+    def get(self, key: tuple) -> Optional[np.ndarray]:
+        """ get a decoded tile, from memory or else from disk
+
+        Args:
+            key (tuple): (imagery_id, z, x, y, tile_size, tile_buffer)
+
+        Returns:
+            Optional[np.ndarray]: the tile, None on a miss
+        """
+        with self._lock:
+            array = self._memory.get(key)
+            if array is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return array
+
+        content = self._getDisk(key)
+        if content is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        array = decodeTile(content)
+        with self._lock:
+            self.disk_hits += 1
+            self._putMemory(key, array)
+        return array
+
+
+    def getContent(self, key: tuple) -> Optional[bytes]:
+        """ get an encoded tile from disk
+
+        Args:
+            key (tuple): (imagery_id, z, x, y, tile_size, tile_buffer)
+
+        Returns:
+            Optional[bytes]: the encoded tile, None on a miss
+        """
+        content = self._getDisk(key)
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+        return content
+
+
+    def _getDisk(self, key: tuple) -> Optional[bytes]:
+        if self.directory is None:
+            return None
+        keyString = self._keyString(key)
+        with self._lock:
+            db = self._getDB()
+            row = db.execute("SELECT digest FROM entries WHERE key = ?", (keyString,)).fetchone()
+            if row is None:
+                return None
+            # a read shouldn't be a write transaction, access times and hits are written in batches
+            _, hits = self._accesses.get(keyString, (0, 0))
+            self._accesses[keyString] = (time.time(), hits + 1)
+            self._unflushed_reads += 1
+            if self._unflushed_reads >= ACCESS_FLUSH_READS:
+                self._flushAccesses(db)
+                db.commit()
+        try:
+            with open(self._blobPath(row[0]), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            # evicted by another process
+            return None
+
+
+    def put(self, key: tuple, content: bytes = None, array: np.ndarray = None):
+        """ store a tile
+
+        Args:
+            key (tuple): (imagery_id, z, x, y, tile_size, tile_buffer)
+            content (bytes, optional): encoded tile, stored on disk. Defaults to None.
+            array (np.ndarray, optional): decoded tile, stored in memory. Defaults to None.
+        """
+        if array is not None:
+            with self._lock:
+                self._putMemory(key, array)
+
+        if content is None or self.directory is None:
+            return
+
+        digest = hashlib.sha256(content).hexdigest()
+        blobPath = self._blobPath(digest)
+        if not blobPath.exists():
+            blobPath.parent.mkdir(exist_ok=True)
+            tmpPath = blobPath.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmpPath, "wb") as f:
+                f.write(content)
+            os.replace(tmpPath, blobPath)
+
+        keyString = self._keyString(key)
+        with self._lock:
+            db = self._getDB()
+            self._flushAccesses(db)
+            row = db.execute("SELECT digest FROM entries WHERE key = ?", (keyString,)).fetchone()
+            # keep the hit count of a key stored again, lfu eviction depends on it
+            db.execute("""INSERT INTO entries VALUES (?, ?, ?, 0)
+                ON CONFLICT(key) DO UPDATE SET digest = excluded.digest, last_access = excluded.last_access""",
+                (keyString, digest, time.time()))
+            db.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?)", (digest, len(content)))
+            if row is not None and row[0] != digest:
+                self._removeBlob(db, row[0])
+            db.commit()
+            self._evictDisk(db)
+
+
+    def _flushAccesses(self, db: sqlite3.Connection):
+        # write the buffered disk hits, the caller commits
+        if self._accesses:
+            db.executemany("UPDATE entries SET last_access = MAX(last_access, ?), hits = hits + ? WHERE key = ?",
+                [(last_access, hits, key) for key, (last_access, hits) in self._accesses.items()])
+        self._accesses = {}
+        self._unflushed_reads = 0
+
+
+    def flush(self):
+        """ write the access times and hit counts of recent disk hits to the index, done
+        automatically every ACCESS_FLUSH_READS disk hits and before every put
+        """
+        if self.directory is None:
+            return
+        with self._lock:
+            db = self._getDB()
+            self._flushAccesses(db)
+            db.commit()
+
+
+    def _removeBlob(self, db: sqlite3.Connection, digest: str) -> int:
+        # delete a blob once no entry uses it, returns the bytes freed
+        if db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None:
+            return 0
+        row = db.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        try:
+            os.remove(self._blobPath(digest))
+        except FileNotFoundError:
+            pass
+        return 0 if row is None else row[0]
+
+
+    def _evictDisk(self, db: sqlite3.Connection):
+        used = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if used <= self.disk_bytes:
+            return
+
+        # blobs no entry points to any more go first, e.g. left by another process
+        for (digest,) in db.execute("SELECT digest FROM blobs WHERE digest NOT IN (SELECT digest FROM entries)").fetchall():
+            used -= self._removeBlob(db, digest)
+
+        if used > self.disk_bytes:
+            order = "last_access" if self.eviction == "lru" else "hits, last_access"
+            for key, digest in db.execute(f"SELECT key, digest FROM entries ORDER BY {order}").fetchall():
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                used -= self._removeBlob(db, digest)
+                if used <= self.disk_bytes:
+                    break
+        db.commit()
+
+
+    def clear(self):
+        """ remove everything from both tiers
+        """
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+            self._accesses = {}
+            self._unflushed_reads = 0
+            if self.directory is not None:
+                db = self._getDB()
+                for (digest,) in db.execute("SELECT digest FROM blobs").fetchall():
+                    try:
+                        os.remove(self._blobPath(digest))
+                    except FileNotFoundError:
+                        pass
+                db.execute("DELETE FROM entries")
+                db.execute("DELETE FROM blobs")
+                db.commit()
+
+
+    def stats(self) -> dict:
+        """ hit counters and usage of each tier
+
+        Returns:
+            dict: memory_hits, disk_hits, misses, hit_rate, memory_bytes and disk_bytes used
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            disk_used = 0
+            if self.directory is not None:
+                disk_used = self._getDB().execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_bytes': self._memory_used,
+                'disk_bytes': disk_used
+            }
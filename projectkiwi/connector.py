@@ -4,9 +4,21 @@ import json
 import numpy as np
 from PIL import Image
 import io
-from typing import List
-from projectkiwi.tools import getOverlap, num2deg, splitZXY, urlFromZxy
-from projectkiwi.models import Annotation, Project, ImageryLayer, Tile, Task, Label
+import os
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+from projectkiwi.tools import decodeTile, dropAlpha, getOverlap, num2deg, randomLabelColor, splitZXY, superTileChildren, urlFromZxy
+from projectkiwi.models import Annotation, Project, ImageryLayer, Tile, TileArray, Task, Label
+from projectkiwi.session import Session, tileRoute
+from projectkiwi.metrics import HTTPMetrics
+from projectkiwi.stream import iterObjectItems
+from projectkiwi.cache import AnnotationMirror, TTLCache, TileCache
+from projectkiwi.pyramid import TilePyramid
+from projectkiwi.uploader import PRESIGNED_URL_LIFETIME, MultipartUpload, PartialUploadError, loadUploadState, saveUploadState
+from pathlib import Path
 import threading
 import queue
 
@@ -14,16 +26,100 @@ import queue
 
 
 class Connector():
-    def __init__(self, key, url="https://projectkiwi.io/"):
+    def __init__(self, key, url="https://projectkiwi.io/",
+            pool_size: int = 10,
+            max_retries: int = 5,
+            backoff_factor: float = 0.5,
+            timeouts: dict = None,
+            adaptive_concurrency: bool = True,
+            metrics: HTTPMetrics = None,
+            annotation_cache: Union[str, Path] = None,
+            metadata_ttl: float = None,
+            tile_cache: TileCache = None):
         """constructor
 
         Args:
             key (str): API key.
             url (str, optional): url for api, in case of multiple instances. Defaults to "https://projectkiwi.io/".
+            pool_size (int, optional): number of kept-alive connections per host. Defaults to 10.
+            max_retries (int, optional): retries on 429/5xx statuses and connection errors. Defaults to 5.
+            backoff_factor (float, optional): base delay in seconds for exponential backoff between retries. Defaults to 0.5.
+            timeouts (dict, optional): (connect, read) timeouts by route name e.g. {'get_annotations': (5, 300)}. Defaults to None.
+            adaptive_concurrency (bool, optional): adapt the number of in-flight requests per route to the server's limits, see projectkiwi.session.AdaptiveLimiter. Defaults to True.
+            metrics (HTTPMetrics, optional): record latency, bytes, retries and statuses by route here, see projectkiwi.metrics.HTTPMetrics. Defaults to None, a new one available as conn.metrics.
+            annotation_cache (Union[str, Path], optional): directory to mirror project annotations in, see projectkiwi.cache.AnnotationMirror. Defaults to None.
+            metadata_ttl (float, optional): cache projects, imagery, labels and imagery status in memory for this many seconds. Defaults to None, no caching.
+            tile_cache (TileCache, optional): cache for getTile and getSuperTile, see projectkiwi.cache.TileCache. Defaults to None.
         """
 
         self.key = key
         self.url = url
+        self._batch_predictions = True
+        self.session = Session(
+                pool_size=pool_size,
+                max_retries=max_retries,
+                backoff_factor=backoff_factor,
+                timeouts=timeouts,
+                adaptive_concurrency=adaptive_concurrency,
+                metrics=metrics)
+        self.metrics = self.session.metrics
+        self.annotation_mirror = None
+        if annotation_cache is not None:
+            self.annotation_mirror = AnnotationMirror(annotation_cache)
+        self.metadata_cache = None
+        if metadata_ttl is not None:
+            self.metadata_cache = TTLCache(metadata_ttl)
+        self.tile_cache = tile_cache
+        self.overviews = {}
+
+
+    def _request(self, method: str, route: str, url: str = None, **kwargs):
+        """ make a request through the pooled session
+
+        Args:
+            method (str): http method e.g. GET
+            route (str): route name e.g. api/get_imagery, used for timeouts
+            url (str, optional): full url if not under the api url. Defaults to None.
+
+        Returns:
+            requests.Response: response
+        """
+        if url is None:
+            url = self.url + route
+        return self.session.request(method, url, route=route, **kwargs)
+
+
+    def _cacheGet(self, key: tuple):
+        """ look up metadata in the TTL cache, if enabled
+
+        Returns:
+            the cached value (lists are copied), or None on a miss
+        """
+        if self.metadata_cache is None:
+            return None
+        found, value = self.metadata_cache.get(key)
+        if not found:
+            return None
+        return list(value) if isinstance(value, list) else value
+
+    def _cachePut(self, key: tuple, value):
+        """ store metadata in the TTL cache, if enabled
+
+        Returns:
+            the value
+        """
+        if self.metadata_cache is not None:
+            self.metadata_cache.put(key, list(value) if isinstance(value, list) else value)
+        return value
+
+    def invalidateCache(self, *prefix):
+        """ Drop cached metadata, e.g. after changing a project outside of this connector
+
+        Args:
+            prefix: leading elements of the cache keys to drop e.g. ("labels", project_id), everything if not given.
+        """
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(*prefix)
 
 
     def getImagery(self, project_id: str) -> List[ImageryLayer]:
@@ -36,20 +132,24 @@ class Connector():
             List[ImageryLayer]: list of imagery layers
         """        
         
+        cached = self._cacheGet(("imagery", project_id))
+        if cached is not None:
+            return cached
+
         route = "api/get_imagery"
         params = {
             'key': self.key, 
             'project_id': project_id
         }
 
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
         r.raise_for_status()
         imageryList = r.json()
         imagery = []
         for layer in imageryList:
             imagery.append(ImageryLayer(**layer))
         assert len(imageryList) == len(imagery), "Failed to parse imagery"
-        return imagery
+        return self._cachePut(("imagery", project_id), imagery)
 
 
     
@@ -59,8 +159,12 @@ class Connector():
             x: int,
             y: int,
             tile_size: int = 256,
-            tile_buffer: int = 0
-        ) -> np.ndarray:
+            tile_buffer: int = 0,
+            raw: bool = False,
+            out: np.ndarray = None,
+            drop_alpha: bool = False,
+            target_size: int = None
+        ) -> Union[np.ndarray, bytes]:
         """Download a tile given the z,x,y and id
 
         Args:
@@ -70,27 +174,210 @@ class Connector():
             y (int): y tile
             tile_size (int): width or height of the square tile
             tile_buffer (int): number of pixels to read each side of the tile
+            raw (bool, optional): return the encoded image (png) without decoding it. Defaults to False.
+            out (np.ndarray, optional): preallocated uint8 array to copy the tile into, see tools.decodeTile. Defaults to None.
+            drop_alpha (bool, optional): drop the alpha channel, RGBA becomes RGB. Defaults to False.
+            target_size (int, optional): decode at reduced resolution to this width/height, see tools.decodeTile. Defaults to None.
 
 
         Returns:
-            np.ndarray: numpy array of tile
+            Union[np.ndarray, bytes]: numpy array of tile, or the encoded tile if raw
         """
 
-        url = urlFromZxy(z, x, y, imagery_id, self.url)
+        key = (imagery_id, z, x, y, tile_size, tile_buffer)
+        decodeOptions = out is not None or drop_alpha or target_size is not None
+
+        pyramid = self.overviews.get(imagery_id)
+        if pyramid is not None and z < pyramid.max_zoom and tile_size == 256 and tile_buffer == 0 and not raw:
+            tile = pyramid.getTile(z, x, y)
+            if drop_alpha:
+                tile = dropAlpha(tile)
+            if target_size is not None and target_size != 256:
+                tile = np.asarray(Image.fromarray(tile).resize((target_size, target_size), Image.BOX))
+            if out is not None:
+                np.copyto(out, tile, casting="no")
+                return out
+            return tile
+
+        cachedDecode = self.tile_cache is not None and not raw and target_size is None
+        if cachedDecode:
+            tile = self.tile_cache.get(key)
+            if tile is not None:
+                if drop_alpha:
+                    tile = dropAlpha(tile)
+                if out is not None:
+                    np.copyto(out, tile, casting="no")
+                    return out
+                return tile
+
+        tileContent = None
+        if self.tile_cache is not None and not cachedDecode:
+            tileContent = self.tile_cache.getContent(key)
+
+        if tileContent is None:
+            url = urlFromZxy(z, x, y, imagery_id, self.url)
+
+            params={
+                'key': self.key,
+                'tile_size': tile_size,
+                'tile_buffer': tile_buffer
+            }
+
+            r = self._request("GET", tileRoute(tile_size), url=url, params=params)
+            r.raise_for_status()
+            tileContent = r.content
+
+            if self.tile_cache is not None:
+                # only default decodes are kept in memory
+                tile = None if raw or decodeOptions else decodeTile(tileContent)
+                self.tile_cache.put(key, tileContent, tile)
+                if tile is not None:
+                    return tile
+
+        if raw:
+            return tileContent
+        return decodeTile(tileContent, out=out, drop_alpha=drop_alpha, target_size=target_size)
+        
 
-        params={
-            'key': self.key,
-            'tile_size': tile_size,
-            'tile_buffer': tile_buffer
-        }
 
-        r = requests.get(url, params=params)
-        r.raise_for_status()
-        tileContent = r.content
-        return np.asarray(Image.open(io.BytesIO(tileContent)))
-        
 
 
+    def getTiles(self,
+            imagery_id: str,
+            zxys: Iterable[Union[str, Tuple[int, int, int]]],
+            tile_size: int = 256,
+            tile_buffer: int = 0,
+            max_workers: int = 8,
+            on_error: Callable = None
+        ) -> Iterator[Tuple[Union[str, Tuple], np.ndarray]]:
+        """Download many tiles concurrently, yielding each one as soon as it completes.
+
+        At most 2*max_workers requests are queued at once, so zxys can be a long or lazy iterable.
+        A failed tile doesn't stop the batch, it is passed to on_error and skipped.
+
+        Args:
+            imagery_id (str): id of the imagery
+            zxys (Iterable[Union[str, Tuple[int, int, int]]]): tiles e.g. ["12/345/678"] or [(12, 345, 678)]
+            tile_size (int, optional): width or height of the square tile. Defaults to 256.
+            tile_buffer (int, optional): number of pixels to read each side of the tile. Defaults to 0.
+            max_workers (int, optional): number of concurrent downloads. Defaults to 8.
+            on_error (Callable, optional): called as on_error(zxy, exception) for each failed tile, a warning is issued if None. Defaults to None.
+
+        Yields:
+            Tuple[Union[str, Tuple], np.ndarray]: the zxy as given and the tile, in order of completion
+
+        Example:
+            >>> for zxy, tile in conn.getTiles(imagery_id, ["13/2101/3045", "13/2101/3046"]):
+            ...     print(zxy, tile.shape)
+            13/2101/3046 (256, 256, 4)
+            13/2101/3045 (256, 256, 4)
+        """
+        for zxy, tile in self._mapTiles(imagery_id, zxys, tile_size, tile_buffer, max_workers, on_error, ordered=False):
+            if tile is not None:
+                yield zxy, tile
+
+
+    def getTilesOrdered(self,
+            imagery_id: str,
+            zxys: Iterable[Union[str, Tuple[int, int, int]]],
+            tile_size: int = 256,
+            tile_buffer: int = 0,
+            max_workers: int = 8,
+            on_error: Callable = None
+        ) -> Iterator[Tuple[Union[str, Tuple], Optional[np.ndarray]]]:
+        """Same as getTiles, but tiles are yielded in the order of zxys and failed tiles are yielded as None.
+
+        Args:
+            imagery_id (str): id of the imagery
+            zxys (Iterable[Union[str, Tuple[int, int, int]]]): tiles e.g. ["12/345/678"] or [(12, 345, 678)]
+            tile_size (int, optional): width or height of the square tile. Defaults to 256.
+            tile_buffer (int, optional): number of pixels to read each side of the tile. Defaults to 0.
+            max_workers (int, optional): number of concurrent downloads. Defaults to 8.
+            on_error (Callable, optional): called as on_error(zxy, exception) for each failed tile, a warning is issued if None. Defaults to None.
+
+        Yields:
+            Tuple[Union[str, Tuple], Optional[np.ndarray]]: the zxy as given and the tile or None if it failed
+        """
+        yield from self._mapTiles(imagery_id, zxys, tile_size, tile_buffer, max_workers, on_error, ordered=True)
+
+
+    def _mapTiles(self, imagery_id, zxys, tile_size, tile_buffer, max_workers, on_error, ordered):
+        if on_error is None:
+            on_error = _warnTileError
+
+        def fetch(zxy):
+            z, x, y = splitZXY(zxy) if isinstance(zxy, str) else zxy
+            return self.getTile(imagery_id, z, x, y, tile_size=tile_size, tile_buffer=tile_buffer)
+
+        def result(zxy, future):
+            try:
+                return zxy, future.result()
+            except Exception as e:
+                on_error(zxy, e)
+                return zxy, None
+
+        zxys = iter(zxys)
+        max_in_flight = 2*max_workers
+        pending = {}
+        order = deque()
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            while True:
+                # top up the window
+                for zxy in zxys:
+                    future = executor.submit(fetch, zxy)
+                    pending[future] = zxy
+                    if ordered:
+                        order.append(future)
+                    if len(pending) >= max_in_flight:
+                        break
+
+                if not pending:
+                    break
+
+                if ordered:
+                    future = order.popleft()
+                    zxy = pending.pop(future)
+                    yield result(zxy, future)
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        zxy = pending.pop(future)
+                        yield result(zxy, future)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+    def enableOverviews(self, imagery_id: str, max_zoom: int, resampling: str = "box", max_workers: int = 8):
+        """ Serve 256px tiles below max_zoom for a layer by downsampling its max_zoom tiles locally.
+
+        After this getTile (and anything built on it) derives lower zoom tiles from the max_zoom tiles,
+        see projectkiwi.pyramid.TilePyramid. Best used with a tile cache so max_zoom tiles are reused.
+
+        Args:
+            imagery_id (str): id of the imagery
+            max_zoom (int): zoom level of the tiles that are downloaded
+            resampling (str, optional): "box", "nearest" or "max". Defaults to "box".
+            max_workers (int, optional): concurrent downloads of max_zoom tiles. Defaults to 8.
+
+        Example:
+            >>> conn = Connector(API_KEY, tile_cache=TileCache("./cache"))
+            >>> conn.enableOverviews(imagery_id, max_zoom=19)
+            >>> tile = conn.getTile(imagery_id, 17, x, y)  # built from 16 zoom 19 tiles
+        """
+        self.overviews[imagery_id] = TilePyramid(self, imagery_id, max_zoom, resampling, max_workers)
+
+
+    def disableOverviews(self, imagery_id: str):
+        """ Go back to downloading every zoom level of a layer from the server
+
+        Args:
+            imagery_id (str): id of the imagery
+        """
+        self.overviews.pop(imagery_id, None)
 
 
     def getTileList(self,
@@ -106,6 +393,30 @@ class Connector():
         Returns:
             List[Tile]: A list of tiles with zxy and url
         """
+        tileList = self._getTileListJSON(imagery_id, project_id, zoom)
+        tiles = Tile.from_dicts_fast(tileList, imagery_id)
+        assert len(tiles) == len(tileList), "Failed to parse tiles"
+        return tiles
+
+
+    def getTileArray(self,
+            imagery_id: str,
+            project_id: str,
+            zoom: int) -> TileArray:
+        """Get the tiles for a given imagery id as a compact TileArray, for large tile lists
+
+        Args:
+            imagery_id (str): ID of the imagery to retrieve a list of tiles for
+            project_id (str): ID of the project
+            zoom (int): Zoom level
+
+        Returns:
+            TileArray: the tiles, indexing it gives Tile objects
+        """
+        return TileArray.from_list(self._getTileListJSON(imagery_id, project_id, zoom), imagery_id)
+
+
+    def _getTileListJSON(self, imagery_id: str, project_id: str, zoom: int) -> List[dict]:
         route = "api/get_tile_list"
         params = {
             'key': self.key, 
@@ -113,19 +424,9 @@ class Connector():
             'project_id': project_id,
             'zoom': zoom}
 
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
         r.raise_for_status()
-        tileList = r.json()
-        tiles = []
-        for tile in tileList:
-            tiles.append(
-                Tile.from_zxy(
-                    zxy = tile['zxy'], 
-                    imagery_id = imagery_id,
-                    url = tile['url'])
-            )
-        assert len(tiles) == len(tileList), "Failed to parse tiles"
-        return tiles
+        return r.json()
 
 
     def getImageryStatus(self, imagery_id: str) -> str:
@@ -137,12 +438,16 @@ class Connector():
         Returns:
             str: status
         """        
+        cached = self._cacheGet(("imagery_status", imagery_id))
+        if cached is not None:
+            return cached
+
         route = "api/get_imagery_status"
         params = {'key': self.key, 'imagery_id': imagery_id}
 
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
         r.raise_for_status()
-        return r.json()['status']
+        return self._cachePut(("imagery_status", imagery_id), r.json()['status'])
 
 
     def getProjects(self) -> List[Project]:
@@ -151,10 +456,14 @@ class Connector():
         Returns:
             List[Projects]: projects
         """
+        cached = self._cacheGet(("projects",))
+        if cached is not None:
+            return cached
+
         route = "api/get_projects" 
         params = {'key': self.key}
 
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
         r.raise_for_status()
 
         try:
@@ -165,57 +474,196 @@ class Connector():
                 projects.append(Project(**proj))
             assert len(projectList) == len(projects), \
                     f"Error: Could not parse projects, {projectList}"
-            return projects
+            return self._cachePut(("projects",), projects)
         except Exception as e:
             print("Error: Could not get projects")
             raise e
         
 
-    def addImagery(self, filename: str, name: str, project_id: str) -> str:
+    def addImagery(self,
+            filename: str,
+            name: str,
+            project_id: str,
+            part_size: int = 64*2**20,
+            max_workers: int = 4,
+            progress: Callable = None) -> str:
         """ Add imagery to projectkiwi.io
 
+        Files larger than part_size are uploaded in parts, several at a time. Finished parts are
+        recorded in <filename>.upload.json, so if the upload is interrupted, calling addImagery
+        again with the same arguments only uploads the missing parts.
+
         Args:
             filename (str): Path to the file to be uploaded
             name (str): Name for the imagery
             project_id (str): Id of the project to add the layer to
+            part_size (int, optional): Size of each part in bytes. Defaults to 64MB.
+            max_workers (int, optional): Number of parts uploaded at once. Defaults to 4.
+            progress (Callable, optional): called with a projectkiwi.uploader.UploadProgress after each part. Defaults to None.
 
         Returns:
             str: imagery id
         """       
-        
-        # get presigned upload url
-        route = "api/get_imagery_upload_url"
-        params = {
-            'key': self.key, 
-            'filename': filename, 
+
+        size = os.path.getsize(filename)
+        imagery_id = None
+        if size > part_size:
+            imagery_id = self._addImageryMultipart(filename, name, project_id, size, part_size, max_workers, progress)
+
+        if imagery_id is None:
+            # get presigned upload url
+            route = "api/get_imagery_upload_url"
+            params = {
+                'key': self.key, 
+                'filename': filename, 
+                'name': name,
+                'project_id': project_id
+            }
+            r = self._request("GET", route, params=params)
+            r.raise_for_status()
+            jsonResponse = r.json()
+            url = jsonResponse['url']
+            
+            # upload
+            with open(filename, 'rb') as data:
+                r = self._request("PUT", "upload", url=url, data=data, headers={'Content-type': ''})
+                r.raise_for_status()
+            imagery_id = jsonResponse['imagery_id']
+
+        self.invalidateCache("imagery", project_id)
+        self.invalidateCache("imagery_url", project_id)
+
+        return imagery_id
+
+
+    def _addImageryMultipart(self, filename, name, project_id, size, part_size, max_workers, progress) -> Optional[str]:
+        """ multipart upload for addImagery
+
+        Returns:
+            Optional[str]: imagery id, None if the server doesn't support multipart uploads
+        """
+        state_file = f"{filename}.upload.json"
+        stat = os.stat(filename)
+        fingerprint = {
+            'project_id': project_id,
             'name': name,
-            'project_id': project_id
+            'size': size,
+            'mtime': stat.st_mtime,
+            'part_size': part_size
+        }
+
+        state = loadUploadState(state_file)
+        if state.get('fingerprint') == fingerprint and self._urlsExpired(state):
+            # resuming after the part urls expired, get new ones for the parts that are left
+            todo = [n + 1 for n in range(len(state['urls'])) if str(n + 1) not in state.get('etags', {})]
+            if todo and self._refreshMultipartUrls(state, state_file, todo) is None:
+                # the server can't reissue urls, start again
+                state = {}
+
+        if state.get('fingerprint') != fingerprint:
+            # the file or arguments changed, start a new upload
+            route = "api/get_imagery_multipart_upload"
+            params = {
+                'key': self.key,
+                'filename': filename,
+                'name': name,
+                'project_id': project_id,
+                'parts': -(-size // part_size)
+            }
+            r = self._request("GET", route, params=params)
+            if r.status_code in (404, 405, 501):
+                return None
+            r.raise_for_status()
+            state = {'fingerprint': fingerprint, **r.json(), 'etags': {}, 'urls_issued_at': time.time()}
+            saveUploadState(state_file, state)
+
+        def refresh(part_numbers: List[int]) -> List[str]:
+            urls = self._refreshMultipartUrls(state, state_file, part_numbers)
+            assert urls is not None, "Part urls expired and the server can't reissue them"
+            return urls
+
+        upload = MultipartUpload(self, filename, state['urls'], part_size, state_file,
+                max_workers=max_workers, progress=progress, refresh_urls=refresh)
+        parts = upload.run()
+
+        route = "api/complete_imagery_multipart_upload"
+        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+        data = {
+            'key': self.key,
+            'imagery_id': state['imagery_id'],
+            'upload_id': state['upload_id'],
+            'parts': parts
+        }
+        r = self._request("POST", route, data=json.dumps(data), headers=headers)
+        r.raise_for_status()
+        os.remove(state_file)
+        return state['imagery_id']
+
+
+    def _urlsExpired(self, state: dict) -> bool:
+        # state files from before urls_issued_at was recorded count as expired
+        lifetime = state.get('expires_in', PRESIGNED_URL_LIFETIME)
+        return time.time() - state.get('urls_issued_at', 0) > 0.9*lifetime
+
+
+    def _refreshMultipartUrls(self, state: dict, state_file: str, part_numbers: List[int]) -> Optional[List[str]]:
+        """ get new presigned urls for some parts of a multipart upload, and save them in the state
+
+        Returns:
+            Optional[List[str]]: urls in the order of part_numbers, None if the server doesn't support it
+        """
+        if not part_numbers:
+            return []
+        route = "api/get_imagery_multipart_urls"
+        params = {
+            'key': self.key,
+            'imagery_id': state['imagery_id'],
+            'upload_id': state['upload_id'],
+            'parts': ",".join(str(n) for n in part_numbers)
         }
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
+        if r.status_code in (404, 405, 501):
+            return None
         r.raise_for_status()
         jsonResponse = r.json()
-        url = jsonResponse['url']
-        
-        # upload
-        with open(filename, 'rb') as data:
-            r = requests.put(url, data=data, headers={'Content-type': ''})
-            r.raise_for_status()
+        urls = jsonResponse['urls']
+
+        for n, url in zip(part_numbers, urls):
+            state['urls'][n - 1] = url
+        state['urls_issued_at'] = time.time()
+        if 'expires_in' in jsonResponse:
+            state['expires_in'] = jsonResponse['expires_in']
+        saveUploadState(state_file, {key: state[key] for key in ('urls', 'urls_issued_at', 'expires_in') if key in state})
+        return urls
 
-        return jsonResponse['imagery_id']
 
     def getSuperTile(self,
                 imagery_id: str,
                 zxy: str,
                 max_zoom: int = 22,
-                padding: int = 0
+                padding: int = 0,
+                out: np.ndarray = None,
+                drop_alpha: bool = False,
+                mosaic: bool = False,
+                max_workers: int = 8,
+                max_attempts: int = 3
         ) -> np.ndarray:
         """Get a tile as higher resolution, as specified by the max zoom.
 
+        By default the server renders the whole super tile. With mosaic=True the 256px child tiles at
+        max_zoom (and the neighbouring tiles needed for the padding) are downloaded in parallel and
+        stitched together here. The child tiles are cached individually if the connector has a tile cache.
+
         Args:
             imagery_id (str): The ID of the imagery
             zxy (str): zxy string to specify the tile e.g. 12/345/678
             max_zoom (int, optional): Maximum zoom. Defaults to 22.
             padding (int, optional): Number of pixels to read on each side of the tile. Defaults to 0.
+            out (np.ndarray, optional): preallocated uint8 array to copy the tile into, see tools.decodeTile. Defaults to None.
+            drop_alpha (bool, optional): drop the alpha channel, RGBA becomes RGB. Defaults to False.
+            mosaic (bool, optional): stitch the super tile from child tiles client side. Defaults to False.
+            max_workers (int, optional): concurrent child tile downloads when mosaicking. Defaults to 8.
+            max_attempts (int, optional): rounds of downloads for failed child tiles when mosaicking. Defaults to 3.
 
         Returns:
             np.ndarray: Image data for the tile.
@@ -225,11 +673,84 @@ class Connector():
         tile_width = 2**(max_zoom - z)
         width = 256*tile_width
 
-        return self.getTile(imagery_id, z, x, y, tile_size=width, tile_buffer=padding)
+        if mosaic:
+            return self._mosaicSuperTile(imagery_id, z, x, y, max_zoom, padding, out, drop_alpha, max_workers, max_attempts)
 
+        return self.getTile(imagery_id, z, x, y, tile_size=width, tile_buffer=padding, out=out, drop_alpha=drop_alpha)
+
+
+
+
+    def _mosaicSuperTile(self, imagery_id, z, x, y, max_zoom, padding, out, drop_alpha, max_workers, max_attempts) -> np.ndarray:
+        """ assemble a super tile from its child tiles at max_zoom, see getSuperTile
+        """
+        n = 2**(max_zoom - z)
+        size = 256*n + 2*padding
+        x0 = x*n
+        y0 = y*n
+
+        children = superTileChildren(z, x, y, max_zoom, padding)
+
+        def place(child, tile):
+            nonlocal out
+            if drop_alpha:
+                tile = dropAlpha(tile)
+            if out is None:
+                out = np.zeros((size, size) + tile.shape[2:], dtype=tile.dtype)
+            _, cx, cy = child
+            # top left of the child in the output, which may be partly outside it
+            left = (cx - x0)*256 + padding
+            top = (cy - y0)*256 + padding
+            l, t = max(left, 0), max(top, 0)
+            r, b = min(left + 256, size), min(top + 256, size)
+            out[t:b, l:r] = tile[t - top:b - top, l - left:r - left]
+
+        errors = {}
+        def onError(child, e):
+            errors[child] = e
+
+        for _ in range(max_attempts):
+            errors.clear()
+            for child, tile in self.getTiles(imagery_id, children, max_workers=max_workers, on_error=onError):
+                place(child, tile)
+            if not errors:
+                break
+            # only retry the children that failed
+            children = list(errors)
+
+        if errors:
+            raise list(errors.values())[0]
+        return out
+
+
+    def snapshot(self,
+            path: Union[str, Path],
+            project_id: str,
+            imagery_id: str = None,
+            queue_id: int = None,
+            zoom: int = None,
+            padding: int = 0,
+            max_workers: int = 8):
+        """Record a project (and optionally its tasks and tiles) in a bundle file for use with
+        projectkiwi.offline.OfflineConnector, see projectkiwi.offline.snapshot.
+
+        Args:
+            path (Union[str, Path]): bundle file to write.
+            project_id (str): Id of the project.
+            imagery_id (str, optional): Id of the imagery to record tiles for. Defaults to None.
+            queue_id (int, optional): Id of the task queue. Defaults to None.
+            zoom (int, optional): zoom of the recorded tiles. Defaults to None.
+            padding (int, optional): padding used for super tiles. Defaults to 0.
+            max_workers (int, optional): concurrent tile downloads. Defaults to 8.
+
+        Returns:
+            SnapshotBundle: the bundle
+        """
+        # imported here, projectkiwi.offline builds on this module
+        from projectkiwi.offline import snapshot
+        return snapshot(self, path, project_id, imagery_id, queue_id, zoom, padding, max_workers)
 
 
-    
     def getAnnotations(self, project_id: str) -> List[Annotation]:
         """Get all annotations in a project
 
@@ -250,26 +771,79 @@ class Connector():
 
         """
 
+        try:
+            return list(self.iterAnnotations(project_id))
+        except Exception as e:
+            print("Error: Could not load annotations")
+            raise e
+
+
+    def iterAnnotations(self, project_id: str, predictions: Optional[bool] = None) -> Iterator[Annotation]:
+        """Stream the annotations in a project, parsing them one at a time as the response arrives.
+
+        Memory use doesn't grow with the size of the project, and the first annotation is available
+        before the rest of the response has been downloaded.
+
+        Args:
+            project_id (str): id for the project to get the annotations for
+            predictions (Optional[bool], optional): True for only predictions, False for only annotations without a confidence, None for both. Defaults to None.
+
+        Yields:
+            Annotation: annotations in the order the server sends them
+
+        Example:
+            >>> for annotation in conn.iterAnnotations(project_id="51f696a5361f", predictions=False):
+            ...     print(annotation.label_name)
+            airport
+        """
+
+        if self.annotation_mirror is not None:
+            self._syncAnnotationMirror(project_id)
+            for annotation in self.annotation_mirror.annotations(project_id):
+                if predictions is None or (annotation.confidence is not None) == predictions:
+                    yield annotation
+            return
+
         route = "api/get_annotations"
         params = {
             'key': self.key,
             'project_id': project_id
         }
 
-        r = requests.get(self.url + route, params=params)
-        r.raise_for_status()
+        r = self._request("GET", route, params=params, stream=True)
+        with r:
+            r.raise_for_status()
+            for annotation_id, data in iterObjectItems(r.iter_content(chunk_size=2**16)):
+                if predictions is not None:
+                    confidence = data.get('confidence')
+                    is_prediction = confidence is not None and confidence != "NULL"
+                    if is_prediction != predictions:
+                        continue
+                yield Annotation.from_dict_fast(data, annotation_id)
 
-        try:
-            annotations = []
-            annotationsDict = r.json()
-            for annotation_id, data in annotationsDict.items():
-                annotations.append(Annotation.from_dict(data, annotation_id))
-            assert len(annotationsDict) == len(annotations), "ERROR: could not parse annotations"
-            return annotations
 
-        except Exception as e:
-            print("Error: Could not load annotations")
-            raise e
+    def _syncAnnotationMirror(self, project_id: str) -> bool:
+        """ revalidate the mirrored annotations for a project, downloading them if they changed
+
+        Args:
+            project_id (str): project id
+
+        Returns:
+            bool: whether the annotations changed
+        """
+        route = "api/get_annotations"
+        params = {
+            'key': self.key,
+            'project_id': project_id
+        }
+        headers = self.annotation_mirror.conditionalHeaders(project_id)
+
+        r = self._request("GET", route, params=params, headers=headers, stream=True)
+        with r:
+            if r.status_code == 304:
+                return False
+            r.raise_for_status()
+            return self.annotation_mirror.store(project_id, r.iter_content(chunk_size=2**16), r.headers)
 
 
     def getPredictions(self, project_id: str) -> List[Annotation]:
@@ -290,9 +864,7 @@ class Connector():
 
         """
         
-        annotations = self.getAnnotations(project_id=project_id)
-
-        return [annotation for annotation in annotations if annotation.confidence != None]
+        return list(self.iterAnnotations(project_id, predictions=True))
 
 
 
@@ -309,15 +881,13 @@ class Connector():
         route = "api/get_tasks"
         params = {'key': self.key, "queue_id": queue_id}
 
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
         r.raise_for_status()
         data = r.json()
         assert data['success'] == True, "Failed to get tasks"
         
         taskList = data['task']
-        tasks = []
-        for task in taskList:
-            tasks.append(Task(**task))
+        tasks = Task.from_dicts_fast(taskList)
         
         assert len(tasks) == len(taskList), "Failed to parse tasks"
 
@@ -336,7 +906,7 @@ class Connector():
         route = "api/get_task"
         params = {'key': self.key, "queue_id": queue_id}
 
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
         r.raise_for_status()
         data = r.json()
         assert data['success'] == True, "Failed to get tasks"
@@ -358,7 +928,7 @@ class Connector():
         route = "api/get_next_task"
         params = {'key': self.key, "queue_id": queue_id}
 
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
         r.raise_for_status()
         data = r.json()
         assert data['success'] == True, "Failed to get tasks"
@@ -384,7 +954,7 @@ class Connector():
         annoDict = dict(annotation)
         annoDict['project_id'] = project
         annoDict['key'] = self.key
-        r = requests.post(self.url + route, data=json.dumps(annoDict), headers=headers)
+        r = self._request("POST", route, data=json.dumps(annoDict), headers=headers)
         r.raise_for_status()
         jsonResponse = r.json()
         return jsonResponse['annotation_id']
@@ -427,11 +997,55 @@ class Connector():
         annoDict = dict(annotation)
         annoDict['project_id'] = project
         annoDict['key'] = self.key
-        r = requests.post(self.url + route, data=json.dumps(annoDict), headers=headers)
+        r = self._request("POST", route, data=json.dumps(annoDict), headers=headers)
         r.raise_for_status()
         jsonResponse = r.json()
         return jsonResponse['annotation_id']
 
+
+    def addPredictions(self, annotations: List[Annotation], project: str) -> List[int]:
+        """Add many predictions to a project in a single request
+
+        If the server doesn't support batched predictions, they are added one at a time instead.
+        If that fails partway, a PartialUploadError says which were added, so only the rest need
+        to be sent again.
+
+        Args:
+            annotations (List[Annotation]): annotation objects with confidence values
+            project (str): project id
+
+        Returns:
+            List[int]: annotation ids, in the same order as the annotations
+        """
+        for annotation in annotations:
+            assert not annotation.confidence is None, "No confidence for prediction"
+
+        if self._batch_predictions:
+            route = "api/add_predictions"
+            headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+            data = {
+                'key': self.key,
+                'project_id': project,
+                'predictions': [dict(annotation) for annotation in annotations]
+            }
+            r = self._request("POST", route, data=json.dumps(data), headers=headers)
+            if r.status_code in (404, 405, 501):
+                # older servers only have api/add_prediction
+                self._batch_predictions = False
+            else:
+                r.raise_for_status()
+                jsonResponse = r.json()
+                return jsonResponse['annotation_ids']
+
+        ids = []
+        for annotation in annotations:
+            try:
+                ids.append(self.addPrediction(annotation, project))
+            except Exception as e:
+                raise PartialUploadError(ids + [None]*(len(annotations) - len(ids)), e) from e
+        return ids
+
+
     def getImageryUrl(self, imagery_id: str, project_id: str) -> str:
         """Get the url for imagery from it's id
 
@@ -442,9 +1056,13 @@ class Connector():
         Returns:
             str: The url template
         """        
+        cached = self._cacheGet(("imagery_url", project_id, imagery_id))
+        if cached is not None:
+            return cached
+
         imagery = self.getImagery(project_id)
         imagery_url = [image.url for image in imagery if image.id == imagery_id][0]
-        return imagery_url
+        return self._cachePut(("imagery_url", project_id, imagery_id), imagery_url)
         
     def removeAllPredictions(self, project_id: str):
         """Remove all predictions in a project
@@ -456,7 +1074,7 @@ class Connector():
         route = "api/remove_all_predictions" 
         params = {'key': self.key, 'project_id': project_id}
 
-        r = requests.delete(self.url + route, 
+        r = self._request("DELETE", route,
                 headers={'Content-Type': 'application/json'},
                 data=json.dumps(params))
         r.raise_for_status()
@@ -471,22 +1089,24 @@ class Connector():
             List[Label]: labels
         """
 
+        cached = self._cacheGet(("labels", project_id))
+        if cached is not None:
+            return cached
+
         route = "api/get_labels"
         params = {
             'key': self.key,
             'project_id': project_id
         }
 
-        r = requests.get(self.url + route, params=params)
+        r = self._request("GET", route, params=params)
         r.raise_for_status()
 
         try:
-            labels = []
             labelsJSON = r.json()
-            for label in labelsJSON:
-                labels.append(Label(**label))
+            labels = Label.from_dicts_fast(labelsJSON)
             assert len(labelsJSON) == len(labels), "ERROR: could not parse labels"
-            return labels
+            return self._cachePut(("labels", project_id), labels)
 
         except Exception as e:
             print("Error: Could not load labels")
@@ -507,15 +1127,7 @@ class Connector():
         """        
 
         if color is None:
-            rgb = list(np.random.choice(range(256), size=3))
-            min_rgb = np.array(rgb).min()
-            max_rgb = np.array(rgb).max()
-            for i,c in enumerate(rgb):
-                if c == min_rgb:
-                    rgb[i] = 0
-                if c == max_rgb:
-                    rgb[i] = 256
-            color = f"rgb({rgb[0]}, {rgb[1]}, {rgb[2]})"
+            color = randomLabelColor()
 
 
         labelDict = {}
@@ -529,7 +1141,13 @@ class Connector():
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
 
 
-        r = requests.post(self.url + route, data=json.dumps(labelDict), headers=headers)
+        r = self._request("POST", route, data=json.dumps(labelDict), headers=headers)
         r.raise_for_status()
+        self.invalidateCache("labels", project_id)
         jsonResponse = r.json()
-        return Label(**jsonResponse)
\ No newline at end of file
+        return Label(**jsonResponse)
+
+
+
+def _warnTileError(zxy, e: Exception):
+    warnings.warn(f"Failed to get tile {zxy}: {e}")
@@ -1,9 +1,13 @@
 from projectkiwi.tools import (
-        bboxFromCoords,
-        getAnnotationsForTile,
-        latLngToImgCoords,
+        TileTransform,
         maskFromPolygon,
-        bbox_iou)
+        raggedBounds,
+        splitRagged,
+        splitZXY)
+
+from projectkiwi.models import AnnotationTable
+from projectkiwi.nms import boxNMS
+from projectkiwi.spatial import AnnotationIndex
 
 from PIL import Image
 from pathlib import Path
@@ -12,14 +16,23 @@ import numpy as np
 import torch
 from PIL import Image
 import torch
+import torchvision
 from PIL import Image
-from typing import List
+from typing import Callable, Iterator, List, Optional, Tuple
+import os
+import warnings
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
 
 class ProjectKiwiDataSet(object):
 
     def imgToTensor(self, img):
+        if img.ndim == 2:
+            img = np.dstack((img, img, img))
         if img.shape[-1] == 2:
             img = np.dstack((img[:,:,0], img[:,:,0], img[:,:,0]))
         assert img.shape[-1] == 3, f"Image must have three channels. expected: [h, w, 3] got: {img.shape}"
@@ -27,22 +40,53 @@ class ProjectKiwiDataSet(object):
 
         return img.permute(2, 0, 1)
 
+    def taskTileFile(self, task) -> Path:
+        return self.cache_location / f"{self.imagery_id}" / f"padding_{self.padding}" / Path(task.zxy + ".png")
+
     def getTaskTile(self, task):
-        imageFile = str(self.cache_location / f"{self.imagery_id}" / f"padding_{self.padding}" / Path(task.zxy + ".png"))
-        if not Path(imageFile).exists():
+        if getattr(self.conn, 'tile_cache', None) is not None:
+            # the connector caches tiles itself
+            return self.conn.getSuperTile(self.imagery_id, task.zxy, self.max_zoom, self.padding, drop_alpha=True)
+
+        imageFile = self.taskTileFile(task)
+        if not imageFile.exists():
             # we can request a "super tile", which covers the same area but is at a higher resolution than a standard tile
             tile = self.conn.getSuperTile(self.imagery_id, task.zxy, self.max_zoom, self.padding)
 
             if tile.shape[2] == 4:
                 tile = tile[:,:,:3]
             im = Image.fromarray(tile)
-            Path(imageFile).parent.mkdir(parents=True, exist_ok=True)
-            im.save(imageFile)
+            imageFile.parent.mkdir(parents=True, exist_ok=True)
+            # write then rename, so other workers (or a TilePrefetcher) never read a partial file
+            tmpFile = imageFile.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            im.save(tmpFile, format="PNG")
+            os.replace(tmpFile, imageFile)
         else:
             im = Image.open(imageFile)
             tile = np.array(im)
         return tile
 
+    def prefetchTaskTile(self, task):
+        """ download the tile for a task into a cache the DataLoader workers can read.
+
+        With a connector tile cache only the encoded tile is stored in its disk tier, decoding is left
+        to the workers. Nothing is done if that cache is memory only, since workers can't read it.
+        Otherwise the tile is saved to cache_location, unless it is already there.
+        """
+        tile_cache = getattr(self.conn, 'tile_cache', None)
+        if tile_cache is not None:
+            if tile_cache.directory is None:
+                return
+            # the same tile, and so the same cache key, as getSuperTile in getTaskTile
+            z, x, y = splitZXY(task.zxy)
+            width = 256*2**(self.max_zoom - z)
+            self.conn.getTile(self.imagery_id, z, x, y, tile_size=width, tile_buffer=self.padding, raw=True)
+            return
+
+        if self.taskTileFile(task).exists():
+            return
+        self.getTaskTile(task)
+
     def getAnnotations(self, project_id):
         annotationsAndPredictions = self.conn.getAnnotations(project_id)
 
@@ -54,9 +98,15 @@ class ProjectKiwiDataSet(object):
                 self.label_ids.append(annotation.label_id)
 
         # filter out predictions, we dont want to train on these
-        self.annotations = [annotation for annotation in annotationsAndPredictions \
+        annotations = [annotation for annotation in annotationsAndPredictions \
                     if annotation.confidence is None and annotation.shape == "Polygon"]
 
+        # columnar and memory mapped, so DataLoader workers share one copy
+        tableLocation = self.cache_location / "annotations" / f"{project_id}"
+        AnnotationTable.from_annotations(annotations).save(tableLocation)
+        self.annotations = AnnotationTable.load(tableLocation)
+        self.annotationIndex = AnnotationIndex(self.annotations)
+
 
     def __init__(self, conn, tasks, project_id, imagery_id, max_zoom, 
             cache_location=Path("./cache"),
@@ -87,26 +137,23 @@ class ProjectKiwiDataSet(object):
         if self.inference == True:
             target = None
         else:
-            annotationsForTile = getAnnotationsForTile(self.annotations, task.zxy, overlap_threshold=0.9)
+            annotationsForTile = self.annotations[self.annotationIndex.queryIndices(task.zxy, overlap_threshold=0.9)]
+            vertices, offsets = annotationsForTile.vertices, annotationsForTile.offsets
+
+            # every vertex of every annotation in the tile converted at once
+            pixels = TileTransform(task.zxy, tile.shape[0]).toPixels(vertices)
+            boxes = raggedBounds(pixels, offsets).tolist()
+
+            # reserve label 0 for background
+            labelNames = annotationsForTile.categories['label_name']
+            labels = [self.label_names.index(labelNames[code]) + 1 for code in annotationsForTile.columns['label_name']]
+            isCrowd = [0] * len(annotationsForTile)
 
-            labels = []
-            boxes = []
-            isCrowd = []
             if self.make_masks:
                 masks = np.zeros((len(annotationsForTile), tile.shape[0], tile.shape[1]))
-            for i,annotation in enumerate(annotationsForTile):
-                boxes.append(bboxFromCoords(annotation.coordinates, task.zxy, tile.shape[0], clip=False))
-
-                # reserve label 0 for background
-                labels.append(self.label_names.index(annotation.label_name) + 1)
-                isCrowd.append(0)
-                
-                if self.make_masks:
-                    poly = latLngToImgCoords(annotation.coordinates, task.zxy, tile.shape[0])
-                    poly = [(x, y) for x,y in poly]
-                    mask = maskFromPolygon(poly, tile.shape[0], tile.shape[1])
-                    masks[i,:,:] = mask
-               
+                polygons = splitRagged([tuple(point) for point in pixels.astype(np.int64).tolist()], offsets)
+                for i, poly in enumerate(polygons):
+                    masks[i,:,:] = maskFromPolygon(poly, tile.shape[0], tile.shape[1])
 
             boxes = torch.as_tensor(boxes, dtype=torch.float32)
             labels = torch.as_tensor(labels, dtype=torch.int64)
@@ -143,6 +190,179 @@ class ProjectKiwiDataSet(object):
 
 
 
+class TilePrefetcher(torch.utils.data.Sampler):
+    """Sampler that downloads the tiles for upcoming tasks in the background.
+
+    Wraps another sampler (the order the DataLoader will read the dataset in) and keeps the tiles
+    for the next `lookahead` indices downloading into the dataset's cache with a pool of threads.
+    An index is only handed to the DataLoader once its tile is in the cache, so the workers in
+    __getitem__ read tiles from disk instead of downloading them one at a time.
+
+    Args:
+        dataset (ProjectKiwiDataSet): the dataset being loaded.
+        sampler (torch.utils.data.Sampler, optional): order of the indices. Defaults to None, in order.
+        lookahead (int, optional): maximum number of tiles downloaded ahead of the consumer. Defaults to 32.
+        max_workers (int, optional): concurrent downloads. Defaults to 8.
+
+    Example:
+        >>> loader = torch.utils.data.DataLoader(dataset,
+        ...     sampler=TilePrefetcher(dataset, torch.utils.data.RandomSampler(dataset)),
+        ...     batch_size=4, num_workers=4, collate_fn=collate_fn)
+        >>> for images, targets, tasks in loader:
+        ...     pass
+        >>> loader.sampler.stats()
+        {'yielded': 100, 'waits': 3, 'wait_seconds': 0.41, 'failed': 0}
+    """
+
+    def __init__(self, dataset, sampler=None, lookahead: int = 32, max_workers: int = 8):
+        assert lookahead > 0, f"lookahead must be positive, got: {lookahead}"
+        self.dataset = dataset
+        self.sampler = sampler if sampler is not None else range(len(dataset))
+        self.lookahead = lookahead
+        self.max_workers = max_workers
+
+        self.yielded = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        window = deque()
+        indices = iter(self.sampler)
+        try:
+            while True:
+                # keep the window full
+                while len(window) < self.lookahead:
+                    idx = next(indices, None)
+                    if idx is None:
+                        break
+                    window.append((idx, executor.submit(self.dataset.prefetchTaskTile, self.dataset.tasks[idx])))
+                if not window:
+                    return
+
+                idx, future = window.popleft()
+                if not future.done():
+                    self.waits += 1
+                    start = time.monotonic()
+                    wait([future])
+                    self.wait_seconds += time.monotonic() - start
+                if future.exception() is not None:
+                    # __getitem__ will try again and raise if it still fails
+                    self.failed += 1
+                self.yielded += 1
+                yield idx
+        finally:
+            # cancel_futures needs python 3.9, cancel the downloads that haven't started by hand
+            for _, future in window:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        """ how often the consumer had to wait for a tile
+
+        Returns:
+            dict: yielded indices, waits, seconds spent waiting and failed downloads, over all epochs
+        """
+        return {
+            'yielded': self.yielded,
+            'waits': self.waits,
+            'wait_seconds': self.wait_seconds,
+            'failed': self.failed,
+        }
+
+
+
+class TaskStream():
+    """Iterate over the tasks in a queue together with their super tiles, downloading ahead.
+
+    The tiles for the next `lookahead` tasks are downloaded in the background while the current
+    one is processed, so a loop that runs a model on each task is bound by the model rather than
+    by one round trip per task. Tasks are yielded in queue order.
+
+    Args:
+        conn (Connector): A connection object from projectkiwi.connector.
+        queue_id (int): Id of the task queue.
+        max_zoom (int): zoom to get the super tiles at, see Connector.getSuperTile.
+        padding (int, optional): pixels to read on each side of the tile. Defaults to 0.
+        complete (Optional[bool], optional): only complete (True) or incomplete (False) tasks, all if None. Defaults to False.
+        imagery_id (str, optional): imagery to get tiles from, each task's own imagery if None. Defaults to None.
+        lookahead (int, optional): maximum number of tiles held ahead of the consumer. Defaults to 8.
+        max_workers (int, optional): concurrent downloads. Defaults to 4.
+        on_error (Callable, optional): called as on_error(task, exception) for each failed tile, a warning is issued if None. Failed tasks are skipped. Defaults to None.
+
+    Example:
+        >>> for task, tile in TaskStream(conn, QUEUE_ID, max_zoom=19):
+        ...     results = model(imgToTensor(tile))
+    """
+
+    def __init__(self,
+            conn,
+            queue_id: int,
+            max_zoom: int,
+            padding: int = 0,
+            complete: Optional[bool] = False,
+            imagery_id: str = None,
+            lookahead: int = 8,
+            max_workers: int = 4,
+            on_error: Callable = None):
+        assert lookahead > 0, f"lookahead must be positive, got: {lookahead}"
+        self.conn = conn
+        self.queue_id = queue_id
+        self.max_zoom = max_zoom
+        self.padding = padding
+        self.complete = complete
+        self.imagery_id = imagery_id
+        self.lookahead = lookahead
+        self.max_workers = max_workers
+        self.on_error = on_error
+
+    def tasks(self) -> List:
+        """ the tasks in the queue that will be yielded
+
+        Returns:
+            List[Task]: tasks
+        """
+        return [task for task in self.conn.getTasks(self.queue_id) if self.complete is None or task.complete == self.complete]
+
+    def getTile(self, task) -> np.ndarray:
+        imagery_id = self.imagery_id if self.imagery_id is not None else task.imagery_id
+        return self.conn.getSuperTile(imagery_id, task.zxy, self.max_zoom, self.padding, drop_alpha=True)
+
+    def __iter__(self) -> Iterator[Tuple]:
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        window = deque()
+        tasks = iter(self.tasks())
+        try:
+            while True:
+                while len(window) < self.lookahead:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    window.append((task, executor.submit(self.getTile, task)))
+                if not window:
+                    return
+
+                task, future = window.popleft()
+                try:
+                    tile = future.result()
+                except Exception as e:
+                    if self.on_error is None:
+                        warnings.warn(f"Failed to get tile for task {task.id}: {e}")
+                    else:
+                        self.on_error(task, e)
+                    continue
+                yield task, tile
+        finally:
+            for _, future in window:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+
 def scoreThresholding(boxes: List, scores: List, class_ids: List, masks: List = None, threshold = 0.1):
     """ apply a score threshold a list of boxes etc
 
@@ -209,8 +429,14 @@ def boxSizeFiltering(boxes: List, scores: List, class_ids: List, masks: List = N
 
 
 def nonMaximumSuppression(boxes: List, scores: List, class_ids: List, masks: List = None,
-    iou_threshold = 0.3):
-    """ apply non-maximum suppression to the output of an object detector
+    iou_threshold = 0.3, class_aware: bool = False, greedy: bool = True):
+    """ apply non-maximum suppression to the output of an object detector.
+    A list wrapper around projectkiwi.nms.boxNMS, use that (or nms.suppressDetections) directly on tensors to stay on the device.
+
+    By default this is standard greedy nms, which keeps a box unless it overlaps a box that was
+    kept. Earlier versions dropped a box if it overlapped any box with a higher score, even one
+    that was itself dropped, so chains of overlapping boxes now keep more of them, and boxes with
+    equal scores may resolve differently. Pass greedy=False for the old rule.
 
     Args:
         boxes (List): bounding boxes for the objects
@@ -218,30 +444,32 @@ def nonMaximumSuppression(boxes: List, scores: List, class_ids: List, masks: Lis
         class_ids (List): class ids
         masks (List, optional): masks if there is a mask-rcnn output. Defaults to None.
         iou_threshold (float, optional): maximum overlap permitted, objects with a greater overlap with a higher confidence box will be omitted. Defaults to 0.3.
+        class_aware (bool, optional): only suppress boxes of the same class. Defaults to False.
+        greedy (bool, optional): greedy nms, or the old rule comparing every pair of boxes if False. Defaults to True.
 
     Returns:
-        _type_: the boxes, scores, ids and optionally masks
+        _type_: the boxes, scores, ids and optionally masks, in their original order
     """   
 
-    returnBoxes, returnScores, returnIds = ([], [], [])
-    if masks is None:
-        returnMasks = None
-    else:
-        returnMasks = []
+    if len(boxes) == 0:
+        return [], [], [], None if masks is None else []
 
-    for i, (box, score, class_id) in enumerate(zip(boxes, scores, class_ids)):
-        skip = False
-        for j, (box2, score2) in enumerate(zip(boxes, scores)):
-            if i != j and score2 > score:
-                if bbox_iou(box, box2) > iou_threshold:
-                    skip = True
-        
-        if not skip: 
-            returnBoxes.append(box)
-            returnScores.append(score)
-            returnIds.append(class_id)
-            if not masks is None:
-                returnMasks.append(masks[i])
+    boxTensor = torch.as_tensor(np.asarray(boxes, dtype=np.float32).reshape(-1, 4))
+    scoreTensor = torch.as_tensor(np.asarray(scores, dtype=np.float32))
+    idTensor = torch.as_tensor(np.asarray(class_ids, dtype=np.int64))
+    if greedy:
+        keep = sorted(boxNMS(boxTensor, scoreTensor, idTensor, iou_threshold, class_aware).tolist())
+    else:
+        # dropped if any box with a higher score overlaps it
+        suppressed = (torchvision.ops.box_iou(boxTensor, boxTensor) > iou_threshold) & (scoreTensor[None, :] > scoreTensor[:, None])
+        if class_aware:
+            suppressed &= idTensor[None, :] == idTensor[:, None]
+        keep = torch.where(~suppressed.any(1))[0].tolist()
+
+    returnBoxes = [boxes[i] for i in keep]
+    returnScores = [scores[i] for i in keep]
+    returnIds = [class_ids[i] for i in keep]
+    returnMasks = None if masks is None else [masks[i] for i in keep]
 
     return returnBoxes, returnScores, returnIds, returnMasks
 
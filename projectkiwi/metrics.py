@@ -0,0 +1,247 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+
+# upper bounds of the latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class RequestEvent(BaseModel):
+    route: str
+    method: str
+    status: Optional[int]
+    latency: float
+    bytes_in: int
+    bytes_out: int
+    attempt: int
+    timestamp: float
+
+
+
+class _RouteStats():
+    """ totals for one route
+    """
+
+    def __init__(self, buckets: Tuple[float]):
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.latency_sum = 0.0
+        self.count = 0
+        self.retries = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.statuses: Dict[Tuple[str, str], int] = {}
+
+
+
+class HTTPMetrics():
+    """Record latency, bytes, retries and statuses of every request, by route.
+
+    Every attempt made by a Connector (including retries) is passed to record(). Totals are kept
+    per route, e.g. "get_tile" or "api/get_annotations", and can be read with snapshot() or exported
+    in the Prometheus text format with prometheus(). Callbacks added with addCallback() get a
+    RequestEvent for each attempt, to forward to other monitoring.
+
+    Latency is measured until the response body has been read, except for streamed responses
+    (getAnnotations) where it is the time to the response headers.
+
+    Args:
+        buckets (Tuple[float], optional): upper bounds of the latency histogram in seconds. Defaults to DEFAULT_BUCKETS.
+
+    Example:
+        >>> conn = Connector(API_KEY)
+        >>> conn.getAnnotations(project_id)
+        >>> conn.metrics.snapshot()["api/get_annotations"]["latency_mean"]
+        1.23
+    """
+
+    def __init__(self, buckets: Tuple[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.callbacks: List[Callable] = []
+        self._routes: Dict[str, _RouteStats] = {}
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def addCallback(self, callback: Callable):
+        """ call a function with a RequestEvent after every attempt
+
+        Args:
+            callback (Callable): function taking a RequestEvent, exceptions are not caught
+        """
+        self.callbacks.append(callback)
+
+
+    def removeCallback(self, callback: Callable):
+        """ stop calling a function added with addCallback
+
+        Args:
+            callback (Callable): the function
+        """
+        self.callbacks.remove(callback)
+
+
+    def record(self,
+            route: str,
+            method: str,
+            status: Optional[int],
+            latency: float,
+            bytes_in: int = 0,
+            bytes_out: int = 0,
+            attempt: int = 1):
+        """ record one attempt of a request
+
+        Args:
+            route (str): route name e.g. api/get_annotations
+            method (str): http method e.g. GET
+            status (Optional[int]): response status, None for a connection error or timeout
+            latency (float): seconds taken
+            bytes_in (int, optional): size of the response body. Defaults to 0.
+            bytes_out (int, optional): size of the request body. Defaults to 0.
+            attempt (int, optional): attempt number, more than 1 for retries. Defaults to 1.
+        """
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = _RouteStats(self.buckets)
+            stats.bucket_counts[bisect_left(self.buckets, latency)] += 1
+            stats.latency_sum += latency
+            stats.count += 1
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            if attempt > 1:
+                stats.retries += 1
+            if status is None:
+                stats.errors += 1
+            key = (method, "error" if status is None else str(status))
+            stats.statuses[key] = stats.statuses.get(key, 0) + 1
+
+        if self.callbacks:
+            event = RequestEvent(
+                    route=route,
+                    method=method,
+                    status=status,
+                    latency=latency,
+                    bytes_in=bytes_in,
+                    bytes_out=bytes_out,
+                    attempt=attempt,
+                    timestamp=time.time())
+            for callback in list(self.callbacks):
+                callback(event)
+
+
+    def reset(self):
+        """ clear all totals, callbacks are kept
+        """
+        with self._lock:
+            self._routes = {}
+
+
+    def snapshot(self) -> Dict[str, dict]:
+        """ totals so far
+
+        Returns:
+            Dict[str, dict]: by route: requests, retries, errors, bytes_in, bytes_out,
+                latency_sum, latency_mean, latency_buckets ({upper bound: cumulative count})
+                and statuses ({"GET 200": count})
+        """
+        with self._lock:
+            snapshot = {}
+            for route, stats in self._routes.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.buckets + (float("inf"),), stats.bucket_counts):
+                    cumulative += count
+                    buckets[bound] = cumulative
+                snapshot[route] = {
+                    'requests': stats.count,
+                    'retries': stats.retries,
+                    'errors': stats.errors,
+                    'bytes_in': stats.bytes_in,
+                    'bytes_out': stats.bytes_out,
+                    'latency_sum': stats.latency_sum,
+                    'latency_mean': stats.latency_sum / stats.count if stats.count else 0.0,
+                    'latency_buckets': buckets,
+                    'statuses': {f"{method} {status}": count for (method, status), count in stats.statuses.items()},
+                }
+            return snapshot
+
+
+    def prometheus(self, prefix: str = "projectkiwi_http") -> str:
+        """ totals in the Prometheus text exposition format, e.g. to serve on a /metrics endpoint
+
+        Args:
+            prefix (str, optional): prefix for metric names. Defaults to "projectkiwi_http".
+
+        Returns:
+            str: metrics text
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name: str, kind: str, description: str):
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        header("request_duration_seconds", "histogram", "Time taken by each request attempt.")
+        for route, stats in snapshot.items():
+            for bound, count in stats['latency_buckets'].items():
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{prefix}_request_duration_seconds_bucket{{route="{route}",le="{le}"}} {count}')
+            lines.append(f'{prefix}_request_duration_seconds_sum{{route="{route}"}} {stats["latency_sum"]}')
+            lines.append(f'{prefix}_request_duration_seconds_count{{route="{route}"}} {stats["requests"]}')
+
+        header("requests_total", "counter", "Request attempts by method and status, status is \"error\" for connection errors.")
+        for route, stats in snapshot.items():
+            for key, count in stats['statuses'].items():
+                method, status = key.split(" ")
+                lines.append(f'{prefix}_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+
+        for name, field, description in (
+                ("retries_total", 'retries', "Request attempts that were retries."),
+                ("received_bytes_total", 'bytes_in', "Bytes received in response bodies."),
+                ("sent_bytes_total", 'bytes_out', "Bytes sent in request bodies.")):
+            header(name, "counter", description)
+            for route, stats in snapshot.items():
+                lines.append(f'{prefix}_{name}{{route="{route}"}} {stats[field]}')
+
+        return "\n".join(lines) + "\n"
+
+
+
+def bodySize(data) -> int:
+    """ size of a request body if it is known without reading it
+
+    Args:
+        data: bytes, str or a file, as passed to requests
+
+    Returns:
+        int: size in bytes, 0 if unknown
+    """
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if isinstance(data, str):
+        return len(data.encode())
+    if hasattr(data, 'read') and hasattr(data, '__len__'):
+        # e.g. uploader.FileSlice
+        return len(data)
+    try:
+        return os.fstat(data.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return 0
@@ -3,10 +3,12 @@ sys.path.append('../../projectkiwi/')
 
 import projectkiwi
 from projectkiwi.tools import (
-        coordsFromPolygon,
-        bboxToPolygon,
+        coordsFromPolygons,
+        raggedFromPolygons,
         yx_to_xy)
-from projectkiwi.data import ProjectKiwiDataSet, scoreThresholding, boxSizeFiltering, nonMaximumSuppression
+from projectkiwi.data import ProjectKiwiDataSet, TilePrefetcher
+from projectkiwi.nms import suppressDetections
+from projectkiwi.uploader import PredictionUploader
 
 from tqdm import tqdm
 from pathlib import Path
@@ -20,7 +22,6 @@ from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
 import sys
 import torch
 import torchvision.models.detection.mask_rcnn
-import threading
 
 
 from skimage import measure
@@ -47,9 +48,6 @@ class BaseDetector(object):
         ValueError: If a model is specified to load but it cant be found/loaded, a valueError will be raised.
     """       
 
-    def threadAddPrediction(self, prediction):
-        self.conn.addPrediction(prediction, self.project_id)
-
     @staticmethod
     def collate_fn(batch):
         return tuple(zip(*batch))
@@ -155,7 +153,7 @@ class BaseDetector(object):
         data_loader_train = torch.utils.data.DataLoader(
                 dataset_train,
                 batch_size=self.batch_size,
-                shuffle=True,
+                sampler=TilePrefetcher(dataset_train, torch.utils.data.RandomSampler(dataset_train)),
                 num_workers=4,
                 collate_fn=self.collate_fn)
 
@@ -171,7 +169,7 @@ class BaseDetector(object):
             data_loader_test = torch.utils.data.DataLoader(
                 dataset_test,
                 batch_size=self.batch_size,
-                shuffle=True,
+                sampler=TilePrefetcher(dataset_test, torch.utils.data.RandomSampler(dataset_test)),
                 num_workers=4,
                 collate_fn=self.collate_fn)
 
@@ -294,11 +292,12 @@ class BaseDetector(object):
 
 
         dataset = ProjectKiwiDataSet(self.conn, tasks, self.project_id, self.imagery_id, self.max_zoom, self.cache_location, self.tile_padding, inference=True, make_masks=False)
-        data_loader_inference = torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=4, collate_fn=self.collate_fn)
+        data_loader_inference = torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, sampler=TilePrefetcher(dataset), num_workers=4, collate_fn=self.collate_fn)
 
         self.model.to(self.device)
         self.model.eval()
 
+        uploader = PredictionUploader(self.conn, self.project_id)
 
         for images, _, tasks in tqdm(data_loader_inference, desc="Doing inference"):
             images = list(image.to(self.device) for image in images)
@@ -306,18 +305,19 @@ class BaseDetector(object):
             for result, task in zip(results, tasks):
 
                 tile_size = 256*2**(self.max_zoom - int(projectkiwi.tools.splitZXY(task.zxy)[0]))
-                class_ids = result['labels'].detach().cpu().numpy()
-                boxes = result['boxes'].detach().cpu().numpy()
-                scores = result['scores'].detach().cpu().numpy()
+                # filter on the device, only the kept detections are copied back
+                result = suppressDetections({key: value.detach() for key, value in result.items()})
+                class_ids = result['labels'].cpu().numpy()
+                boxes = result['boxes'].cpu().numpy()
+                scores = result['scores'].cpu().numpy()
                 if self.masks_required:
-                    masks = result['masks'].detach().cpu().numpy()
+                    masks = result['masks'].cpu().numpy()
                 else:
                     masks = None
-                boxes, scores, class_ids, masks = scoreThresholding(boxes, scores, class_ids, masks)
-                boxes, scores, class_ids, masks = boxSizeFiltering(boxes, scores, class_ids, masks)
-                boxes, scores, class_ids, masks = nonMaximumSuppression(boxes, scores, class_ids, masks)
                 
                 if self.masks_required:
+                    polygons = []
+                    kept = []
                     for box, score, class_id, mask in zip(boxes, scores, class_ids, masks):
                         contours = measure.find_contours(mask[0,:,:], 0.5)
                         if len(contours) == 0:
@@ -327,13 +327,18 @@ class BaseDetector(object):
 
                         if len(approx_contour) < 4:
                             continue
-                        
-                        poly_latlng = coordsFromPolygon(approx_contour, task.zxy, tile_size, self.tile_padding)
 
-                        
-                        if poly_latlng[0] != poly_latlng[-1]:
+                        if list(approx_contour[0]) != list(approx_contour[-1]):
                             continue
 
+                        polygons.append(approx_contour)
+                        kept.append((score, class_id))
+
+                    # convert every polygon in the tile in one go
+                    vertices, offsets = raggedFromPolygons(polygons)
+                    polygonsLatLng = coordsFromPolygons(vertices, offsets, task.zxy, tile_size, self.tile_padding)
+
+                    for poly_latlng, (score, class_id) in zip(polygonsLatLng, kept):
                         prediction = projectkiwi.models.Annotation(
                             shape="Polygon",
                             label_id=self.label_ids[class_id-1],
@@ -341,13 +346,17 @@ class BaseDetector(object):
                             coordinates=poly_latlng,
                             confidence = score)
 
-                        threading.Thread(target=self.threadAddPrediction, args=(prediction,)).start()
+                        uploader.add(prediction)
                 else:
-                    for box, score, class_id in zip(boxes, scores, class_ids):
-                        x1, y1, x2, y2 = [int(box[0]), int(box[1]), int(box[2]), int(box[3])]
-
-                        latLngPoly = coordsFromPolygon(bboxToPolygon(x1, y1, x2, y2), task.zxy, tile_size, self.tile_padding)
-
+                    # every box as a closed 5 point polygon, truncated to whole pixels
+                    x1, y1, x2, y2 = np.trunc(np.asarray(boxes, dtype=np.float64).reshape(-1, 4)).T
+                    vertices = np.stack([
+                            np.stack([x1, x2, x2, x1, x1], -1),
+                            np.stack([y1, y1, y2, y2, y1], -1)], -1).reshape(-1, 2)
+                    offsets = np.arange(len(x1) + 1) * 5
+                    polygonsLatLng = coordsFromPolygons(vertices, offsets, task.zxy, tile_size, self.tile_padding)
+
+                    for latLngPoly, score, class_id in zip(polygonsLatLng, scores, class_ids):
                         # get the prediction ready
                         prediction = projectkiwi.models.Annotation(
                             shape="Polygon",
@@ -356,8 +365,13 @@ class BaseDetector(object):
                             coordinates=latLngPoly,
                             confidence = score)
 
-                        # add the prediction (in a new thread for speeed)
-                        threading.Thread(target=self.threadAddPrediction, args=(prediction,)).start()
+                        # queue the prediction, it's uploaded in the background
+                        uploader.add(prediction)
+
+        summary = uploader.flush()
+        print(f"Uploaded {summary.uploaded} predictions, {summary.failed} failed.")
+        prefetch = data_loader_inference.sampler.stats()
+        print(f"Waited for {prefetch['waits']} of {prefetch['yielded']} tiles to download ({prefetch['wait_seconds']:.1f}s).")
 
 
 
@@ -1,7 +1,52 @@
 from turtle import st
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 import json
+import os
+from pathlib import Path
+import numpy as np
+
+
+# Server responses are trusted and built without pydantic validation by the from_dicts_fast
+# methods. Set PROJECTKIWI_VALIDATE=1 (or models.VALIDATE = True) to validate them, e.g. when
+# debugging a change in the api.
+VALIDATE = os.environ.get("PROJECTKIWI_VALIDATE", "0").lower() not in ("", "0", "false", "no")
+
+
+def _validate(validate: Optional[bool]) -> bool:
+    return VALIDATE if validate is None else validate
+
+
+# pydantic 2 keeps more state on each model, only pydantic 1 models are built by hand
+PYDANTIC_V1 = not hasattr(BaseModel, "model_construct")
+
+
+def _construct(cls, values: dict):
+    # what BaseModel.construct does, without its per call bookkeeping. values must have every field
+    if not PYDANTIC_V1:
+        return cls.model_construct(**values)
+    model = cls.__new__(cls)
+    # in field order, like a validated model, so repr and dict() match
+    values = {name: values[name] for name in cls.__fields__}
+    object.__setattr__(model, '__dict__', values)
+    object.__setattr__(model, '__fields_set__', set(values))
+    return model
+
+
+def _isFloatPairs(coordinates) -> bool:
+    # every vertex has to be checked, a later one can be an int or a string
+    return all(type(point) is list and len(point) == 2 and type(point[0]) is float and type(point[1]) is float
+            for point in coordinates)
+
+
+def _bool(value) -> bool:
+    # the same values pydantic accepts
+    if isinstance(value, (str, bytes)):
+        if isinstance(value, bytes):
+            value = value.decode()
+        return value.lower() in ("1", "on", "t", "true", "y", "yes")
+    return bool(value)
+
 
 class Annotation(BaseModel):  
     shape: str
@@ -44,6 +89,59 @@ class Annotation(BaseModel):
             imagery_id = data['imagery_id'],
             confidence=confidence
         )
+
+    @classmethod
+    def from_dict_fast(cls, data: dict, annotation_id: int = None, validate: bool = None):
+        """Same as from_dict, but for trusted server responses: the fields are converted
+        directly instead of being validated by pydantic, and coordinates that are already
+        lists of floats are used without copying.
+
+        Args:
+            data (dict): annotation from api/get_annotations
+            annotation_id (int, optional): id, if it isn't in data. Defaults to None.
+            validate (bool, optional): use from_dict instead, defaults to models.VALIDATE. Defaults to None.
+
+        Returns:
+            Annotation: annotation
+        """
+        if _validate(validate):
+            return cls.from_dict(data, annotation_id)
+
+        confidence = data['confidence']
+        if annotation_id is None:
+            annotation_id = data['id']
+
+        # json already gives [lng, lat] lists of floats, only convert when they are something else
+        coordinates = data['coordinates']
+        if not _isFloatPairs(coordinates):
+            coordinates = [[float(point[0]), float(point[1])] for point in coordinates]
+
+        return _construct(cls, dict(
+            id = int(annotation_id),
+            shape = data['shape'],
+            label_id = int(data['label_id']),
+            label_name = data['label_name'],
+            label_color = data['label_color'],
+            coordinates = coordinates,
+            url = data['url'],
+            imagery_id = data['imagery_id'],
+            confidence = None if confidence is None or confidence == "NULL" else float(confidence)
+        ))
+
+    @classmethod
+    def from_dicts_fast(cls, annotations: Union[dict, Iterable[Tuple]], validate: bool = None) -> List["Annotation"]:
+        """Build many annotations from a trusted server response, see from_dict_fast.
+
+        Args:
+            annotations (Union[dict, Iterable[Tuple]]): {id: annotation} as returned by api/get_annotations, or (id, annotation) pairs
+            validate (bool, optional): validate with pydantic, defaults to models.VALIDATE. Defaults to None.
+
+        Returns:
+            List[Annotation]: annotations
+        """
+        if isinstance(annotations, dict):
+            annotations = annotations.items()
+        return [cls.from_dict_fast(data, annotation_id, validate) for annotation_id, data in annotations]
     
     def geoJSON(self) -> str:
         """Convert the annotation to a geoJSON string
@@ -80,6 +178,296 @@ class Annotation(BaseModel):
 
 
 
+class AnnotationView():
+    """ A zero-copy view of one row of an AnnotationTable, with the same attributes as Annotation.
+
+    coordinates is a read only [k, 2] numpy view into the table's vertices.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table: "AnnotationTable", index: int):
+        self.table = table
+        self.index = index
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        return self.table.coordinates(self.index)
+
+    @property
+    def shape(self) -> str:
+        return self.table.categories['shape'][self.table.columns['shape'][self.index]]
+
+    @property
+    def label_id(self) -> int:
+        return int(self.table.columns['label_id'][self.index])
+
+    @property
+    def label_name(self) -> Optional[str]:
+        return self.table.categories['label_name'][self.table.columns['label_name'][self.index]]
+
+    @property
+    def label_color(self) -> Optional[str]:
+        return self.table.categories['label_color'][self.table.columns['label_color'][self.index]]
+
+    @property
+    def url(self) -> Optional[str]:
+        return self.table.categories['url'][self.table.columns['url'][self.index]]
+
+    @property
+    def imagery_id(self) -> Optional[str]:
+        return self.table.categories['imagery_id'][self.table.columns['imagery_id'][self.index]]
+
+    @property
+    def confidence(self) -> Optional[float]:
+        confidence = self.table.columns['confidence'][self.index]
+        return None if np.isnan(confidence) else float(confidence)
+
+    @property
+    def id(self) -> Optional[int]:
+        annotation_id = self.table.columns['id'][self.index]
+        return None if annotation_id < 0 else int(annotation_id)
+
+    def toAnnotation(self) -> Annotation:
+        """ copy the row into an Annotation
+
+        Returns:
+            Annotation: annotation
+        """
+        return Annotation(
+            id=self.id,
+            shape=self.shape,
+            label_id=self.label_id,
+            label_name=self.label_name,
+            label_color=self.label_color,
+            coordinates=self.coordinates.tolist(),
+            url=self.url,
+            imagery_id=self.imagery_id,
+            confidence=self.confidence)
+
+    def geoJSON(self) -> str:
+        return self.toAnnotation().geoJSON()
+
+    def __repr__(self) -> str:
+        return f"AnnotationView({self.index}, id={self.id}, label_name={self.label_name!r})"
+
+
+
+class AnnotationTable():
+    """Annotations stored column by column in numpy arrays.
+
+    The vertices of all annotations are in one flat [n_vertices, 2] float64 array, with
+    offsets[i]:offsets[i+1] being the vertices of annotation i. Numeric fields are columns (a NaN
+    confidence and an id of -1 stand for None) and string fields are int32 codes into small lists
+    of unique values. Unlike a list of Annotation objects there are no per annotation Python objects,
+    so forked DataLoader workers reading the table don't copy it, and a table saved with save() can
+    be memory mapped with load() and shared by any number of processes.
+
+    Indexing with an int gives a zero-copy AnnotationView, indexing with a slice, boolean mask or
+    array of indices gives a new AnnotationTable.
+
+    Args:
+        vertices (np.ndarray): [n_vertices, 2] (lng, lat) of every annotation, concatenated.
+        offsets (np.ndarray): [n + 1] start of each annotation in vertices.
+        columns (dict): [n] arrays for label_id, confidence, id, shape, label_name, label_color, url and imagery_id.
+        categories (dict): unique values for the coded columns shape, label_name, label_color, url and imagery_id.
+
+    Example:
+        >>> table = AnnotationTable.from_annotations(conn.getAnnotations(project_id))
+        >>> table[0].coordinates
+        array([[-87.612448,  41.867452], ...])
+        >>> table.save("./cache/annotations")
+        >>> shared = AnnotationTable.load("./cache/annotations")
+    """
+
+    NUMERIC = ('label_id', 'confidence', 'id')
+    CODED = ('shape', 'label_name', 'label_color', 'url', 'imagery_id')
+
+    def __init__(self, vertices: np.ndarray, offsets: np.ndarray, columns: dict, categories: dict):
+        assert len(offsets) >= 1 and offsets[-1] == len(vertices), "offsets don't match the vertices"
+        for name in self.NUMERIC + self.CODED:
+            assert len(columns[name]) == len(offsets) - 1, f"Wrong length for column {name}"
+        self.vertices = vertices
+        self.offsets = offsets
+        self.columns = columns
+        self.categories = categories
+        self.directory = None
+
+
+    @classmethod
+    def from_annotations(cls, annotations: List[Annotation]) -> "AnnotationTable":
+        """ build a table from annotations
+
+        Args:
+            annotations (List[Annotation]): annotations
+
+        Returns:
+            AnnotationTable: table
+        """
+        n = len(annotations)
+        lengths = np.fromiter((len(annotation.coordinates) for annotation in annotations), dtype=np.int64, count=n)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        vertices = np.empty((offsets[-1], 2), dtype=np.float64)
+        for annotation, start, end in zip(annotations, offsets[:-1], offsets[1:]):
+            if end > start:
+                vertices[start:end] = annotation.coordinates
+
+        columns = {
+            'label_id': np.fromiter((annotation.label_id for annotation in annotations), dtype=np.int64, count=n),
+            'confidence': np.fromiter((np.nan if annotation.confidence is None else annotation.confidence
+                    for annotation in annotations), dtype=np.float64, count=n),
+            'id': np.fromiter((-1 if annotation.id is None else annotation.id
+                    for annotation in annotations), dtype=np.int64, count=n),
+        }
+        categories = {}
+        for name in cls.CODED:
+            codes = {}
+            columns[name] = np.fromiter((codes.setdefault(getattr(annotation, name), len(codes))
+                    for annotation in annotations), dtype=np.int32, count=n)
+            categories[name] = list(codes)
+
+        return cls(vertices, offsets, columns, categories)
+
+
+    def toList(self) -> List[Annotation]:
+        """ copy every row into an Annotation
+
+        Returns:
+            List[Annotation]: annotations
+        """
+        return [self[i].toAnnotation() for i in range(len(self))]
+
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+
+    def __iter__(self) -> Iterator[AnnotationView]:
+        for i in range(len(self)):
+            yield AnnotationView(self, i)
+
+
+    def __getitem__(self, index) -> Union[AnnotationView, "AnnotationTable"]:
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f"Annotation index out of range: {index}")
+            return AnnotationView(self, int(index))
+
+        rows = np.arange(len(self))[index]
+        lengths = self.offsets[rows + 1] - self.offsets[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # vertex indices of the selected rows, in order
+        vertexIndex = np.repeat(self.offsets[rows] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        columns = {name: np.asarray(column[rows]) for name, column in self.columns.items()}
+        return AnnotationTable(np.asarray(self.vertices[vertexIndex]), offsets, columns, self.categories)
+
+
+    def __repr__(self) -> str:
+        return f"AnnotationTable({len(self)} annotations, {len(self.vertices)} vertices)"
+
+
+    def coordinates(self, index: int) -> np.ndarray:
+        """ vertices of one annotation, a view into the table
+
+        Args:
+            index (int): row
+
+        Returns:
+            np.ndarray: [k, 2] (lng, lat)
+        """
+        return self.vertices[self.offsets[index]:self.offsets[index + 1]]
+
+
+    def isPrediction(self) -> np.ndarray:
+        """ which rows are predictions, i.e. have a confidence
+
+        Returns:
+            np.ndarray: [n] bool
+        """
+        return ~np.isnan(self.columns['confidence'])
+
+
+    def bounds(self) -> np.ndarray:
+        """ lat/lng bounding box of every annotation
+
+        Returns:
+            np.ndarray: [n, 4] min lng, min lat, max lng, max lat, NaN for annotations without vertices
+        """
+        bounds = np.full((len(self), 4), np.nan)
+        starts = self.offsets[:-1]
+        nonEmpty = self.offsets[1:] > starts
+        if len(self.vertices) > 0 and nonEmpty.any():
+            starts = starts[nonEmpty]
+            bounds[nonEmpty, :2] = np.minimum.reduceat(self.vertices, starts, axis=0)
+            bounds[nonEmpty, 2:] = np.maximum.reduceat(self.vertices, starts, axis=0)
+        return bounds
+
+
+    def save(self, directory):
+        """ write the table to a directory of .npy files, see load
+
+        Args:
+            directory (Union[str, Path]): where to write, created if needed
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        arrays = {'vertices': self.vertices, 'offsets': self.offsets}
+        arrays.update(self.columns)
+        # write then rename, so a table that is memory mapped elsewhere is never modified
+        for name, array in arrays.items():
+            tmpPath = directory / f"{name}.{os.getpid()}.tmp.npy"
+            np.save(tmpPath, np.ascontiguousarray(array))
+            os.replace(tmpPath, directory / f"{name}.npy")
+        tmpPath = directory / f"categories.{os.getpid()}.tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.categories, f)
+        os.replace(tmpPath, directory / "categories.json")
+
+
+    @classmethod
+    def load(cls, directory, mmap_mode: Optional[str] = "r") -> "AnnotationTable":
+        """ read a table written by save, memory mapped by default so processes share the pages
+
+        Args:
+            directory (Union[str, Path]): directory written by save
+            mmap_mode (Optional[str], optional): see numpy.load, None to read into memory. Defaults to "r".
+
+        Returns:
+            AnnotationTable: table
+        """
+        directory = Path(directory)
+        with open(directory / "categories.json") as f:
+            categories = json.load(f)
+
+        def read(name):
+            return np.load(directory / f"{name}.npy", mmap_mode=mmap_mode)
+
+        columns = {name: read(name) for name in cls.NUMERIC + cls.CODED}
+        table = cls(read('vertices'), read('offsets'), columns, categories)
+        if mmap_mode is not None:
+            table.directory = directory
+        return table
+
+
+    def __getstate__(self):
+        # memory mapped tables are pickled by reference, e.g. for spawned DataLoader workers
+        if self.directory is not None:
+            return {'directory': self.directory}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if set(state) == {'directory'}:
+            state = AnnotationTable.load(state['directory']).__dict__
+        self.__dict__.update(state)
+
+
+
 class Project(BaseModel):
     name: str
     id: str
@@ -120,9 +508,7 @@ class Tile(BaseModel):
             zxy: str, 
             imagery_id: str, 
             url: str):
-        z = int(zxy.split("/")[0])
-        x = int(zxy.split("/")[1])
-        y = int(zxy.split("/")[2])
+        z, x, y = (int(v) for v in zxy.split("/"))
 
         return cls(
             zxy=zxy,
@@ -133,6 +519,196 @@ class Tile(BaseModel):
             y=y
         )
 
+    @classmethod
+    def from_dicts_fast(cls, tiles: List[dict], imagery_id: str, validate: bool = None) -> List["Tile"]:
+        """Build tiles from a trusted api/get_tile_list response without pydantic validation.
+
+        Args:
+            tiles (List[dict]): tiles e.g. [{'zxy': "12/345/678", 'url': "..."}]
+            imagery_id (str): id of the imagery
+            validate (bool, optional): validate with pydantic, defaults to models.VALIDATE. Defaults to None.
+
+        Returns:
+            List[Tile]: tiles
+        """
+        if _validate(validate):
+            return [cls.from_zxy(zxy=tile['zxy'], imagery_id=imagery_id, url=tile['url']) for tile in tiles]
+
+        result = []
+        for tile in tiles:
+            zxy = tile['zxy']
+            z, x, y = zxy.split("/")
+            result.append(_construct(cls, dict(zxy=zxy, imagery_id=imagery_id, url=tile['url'], z=int(z), x=int(x), y=int(y))))
+        return result
+
+
+
+class TileArray():
+    """A compact list of tiles, as returned by Connector.getTileArray.
+
+    The z/x/y of every tile are held in one numpy structured array (9 bytes per tile) and the
+    urls are generated from a shared template, instead of one Tile object per entry. Indexing with
+    an int gives a Tile, indexing with a slice, boolean mask or array of indices gives a TileArray.
+
+    Args:
+        zxy (np.ndarray): structured array with fields z, x and y, see TileArray.dtype.
+        imagery_id (str): id of the imagery the tiles belong to.
+        url_template (str, optional): url with {z}, {x} and {y} placeholders. Defaults to None.
+        urls (np.ndarray, optional): url of every tile, only needed if they don't follow a template. Defaults to None.
+
+    Example:
+        >>> tiles = conn.getTileArray(imagery_id, project_id, zoom=18)
+        >>> len(tiles)
+        412340
+        >>> tiles = tiles.filterBbox(-87.62, 41.85, -87.60, 41.87)
+        >>> tiles[0]
+        Tile(zxy='18/67247/97431', imagery_id='2a6dc8a5d5e4', url='...', z=18, x=67247, y=97431)
+    """
+
+    dtype = np.dtype([('z', np.uint8), ('x', np.uint32), ('y', np.uint32)])
+
+    def __init__(self,
+            zxy: np.ndarray,
+            imagery_id: str,
+            url_template: str = None,
+            urls: np.ndarray = None):
+        assert zxy.dtype == self.dtype, f"Expected dtype {self.dtype}, got: {zxy.dtype}"
+        assert url_template is not None or urls is not None, "Either a url template or urls are required"
+        self.zxy = zxy
+        self.imagery_id = imagery_id
+        self.url_template = url_template
+        self.urls = urls
+
+
+    @classmethod
+    def from_list(cls, tile_list: List[dict], imagery_id: str):
+        """ build from the tile list returned by the api, [{'zxy': "12/345/678", 'url': "..."}, ...]
+
+        Args:
+            tile_list (List[dict]): tiles
+            imagery_id (str): id of the imagery
+
+        Returns:
+            TileArray: tiles
+        """
+        zxy = np.zeros(len(tile_list), dtype=cls.dtype)
+        if len(tile_list) == 0:
+            return cls(zxy, imagery_id, urls=np.array([], dtype=object))
+
+        # split every zxy string in one go
+        values = np.array("/".join([tile['zxy'] for tile in tile_list]).split("/"), dtype=np.int64).reshape(-1, 3)
+        zxy['z'], zxy['x'], zxy['y'] = values[:, 0], values[:, 1], values[:, 2]
+
+        # the urls usually only differ by the zxy, keep one template if they all do
+        first = tile_list[0]
+        template = first['url'].replace(first['zxy'], "{z}/{x}/{y}") if first['zxy'] in first['url'] else None
+        if template is not None and all(tile['url'].replace(tile['zxy'], "{z}/{x}/{y}") == template for tile in tile_list):
+            return cls(zxy, imagery_id, url_template=template)
+        return cls(zxy, imagery_id, urls=np.array([tile['url'] for tile in tile_list], dtype=object))
+
+
+    def __len__(self) -> int:
+        return len(self.zxy)
+
+
+    def __getitem__(self, index) -> Union[Tile, "TileArray"]:
+        if isinstance(index, (int, np.integer)):
+            z, x, y = (int(v) for v in self.zxy[index])
+            return Tile(
+                zxy=f"{z}/{x}/{y}",
+                imagery_id=self.imagery_id,
+                url=self.url(index),
+                z=z,
+                x=x,
+                y=y)
+        return TileArray(
+                self.zxy[index],
+                self.imagery_id,
+                url_template=self.url_template,
+                urls=None if self.urls is None else self.urls[index])
+
+
+    def __iter__(self) -> Iterator[Tile]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+    def __repr__(self) -> str:
+        return f"TileArray({len(self)} tiles, imagery_id='{self.imagery_id}')"
+
+
+    def url(self, index: int) -> str:
+        """ url of one tile
+
+        Args:
+            index (int): index of the tile
+
+        Returns:
+            str: url
+        """
+        if self.urls is not None:
+            return self.urls[index]
+        z, x, y = self.zxy[index]
+        return self.url_template.format(z=z, x=x, y=y)
+
+
+    def zxys(self) -> List[Tuple[int, int, int]]:
+        """ (z, x, y) of every tile, e.g. for Connector.getTiles
+
+        Returns:
+            List[Tuple[int, int, int]]: tiles
+        """
+        return [(int(z), int(x), int(y)) for z, x, y in self.zxy.tolist()]
+
+
+    def toList(self) -> List[Tile]:
+        """ materialise every tile, the same as Connector.getTileList
+
+        Returns:
+            List[Tile]: tiles
+        """
+        return list(self)
+
+
+    def filterZoom(self, zoom: int) -> "TileArray":
+        """ tiles at one zoom level
+
+        Args:
+            zoom (int): zoom level
+
+        Returns:
+            TileArray: tiles at that zoom
+        """
+        return self[self.zxy['z'] == zoom]
+
+
+    def filterBbox(self, min_lng: float, min_lat: float, max_lng: float, max_lat: float) -> "TileArray":
+        """ tiles that overlap a lat/lng bounding box
+
+        Args:
+            min_lng (float): west edge in decimal degrees
+            min_lat (float): south edge in decimal degrees
+            max_lng (float): east edge in decimal degrees
+            max_lat (float): north edge in decimal degrees
+
+        Returns:
+            TileArray: tiles overlapping the box
+        """
+        n = np.exp2(self.zxy['z'].astype(np.float64))
+
+        def tileX(lng):
+            return np.floor((lng + 180.0) / 360.0 * n)
+
+        def tileY(lat):
+            lat = np.radians(np.clip(lat, -85.0511287798, 85.0511287798))
+            return np.floor((1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * n)
+
+        x = self.zxy['x']
+        y = self.zxy['y']
+        # tile y grows southwards
+        mask = (x >= tileX(min_lng)) & (x <= tileX(max_lng)) & (y >= tileY(max_lat)) & (y <= tileY(min_lat))
+        return self[mask]
+
 
 
 class Task(BaseModel):
@@ -143,6 +719,27 @@ class Task(BaseModel):
     submitter_login: Optional[str]
     zxy: str
 
+    @classmethod
+    def from_dicts_fast(cls, tasks: List[dict], validate: bool = None) -> List["Task"]:
+        """Build tasks from a trusted api/get_tasks response without pydantic validation.
+
+        Args:
+            tasks (List[dict]): tasks
+            validate (bool, optional): validate with pydantic, defaults to models.VALIDATE. Defaults to None.
+
+        Returns:
+            List[Task]: tasks
+        """
+        if _validate(validate):
+            return [cls(**task) for task in tasks]
+        return [_construct(cls, dict(
+                complete = _bool(task['complete']),
+                id = int(task['id']),
+                imagery_id = str(task['imagery_id']),
+                queue = int(task['queue']),
+                submitter_login = task.get('submitter_login'),
+                zxy = task['zxy'])) for task in tasks]
+
 
 class Label(BaseModel):
     id: Optional[int]
@@ -151,3 +748,23 @@ class Label(BaseModel):
     name: str
     status: str
 
+
+    @classmethod
+    def from_dicts_fast(cls, labels: List[dict], validate: bool = None) -> List["Label"]:
+        """Build labels from a trusted api/get_labels response without pydantic validation.
+
+        Args:
+            labels (List[dict]): labels
+            validate (bool, optional): validate with pydantic, defaults to models.VALIDATE. Defaults to None.
+
+        Returns:
+            List[Label]: labels
+        """
+        if _validate(validate):
+            return [cls(**label) for label in labels]
+        return [_construct(cls, dict(
+                id = None if label.get('id') is None else int(label['id']),
+                project_id = str(label['project_id']),
+                color = label['color'],
+                name = label['name'],
+                status = label['status'])) for label in labels]
@@ -0,0 +1,192 @@
+import numpy as np
+import torch
+import torchvision
+
+
+NMS_METHODS = ("hard", "soft", "mask")
+
+
+def _classOffsets(boxes: torch.Tensor, class_ids: torch.Tensor) -> torch.Tensor:
+    # move each class to its own region so boxes of different classes never overlap,
+    # the same trick torchvision.ops.batched_nms uses
+    if len(boxes) == 0:
+        return boxes
+    offsets = class_ids.to(boxes) * (boxes.max() + 1)
+    return boxes + offsets[:, None]
+
+
+def boxNMS(boxes: torch.Tensor,
+        scores: torch.Tensor,
+        class_ids: torch.Tensor = None,
+        iou_threshold: float = 0.3,
+        class_aware: bool = False) -> torch.Tensor:
+    """ greedy non-maximum suppression of boxes, on whatever device they are on
+
+    Args:
+        boxes (torch.Tensor): [n, 4] x1, y1, x2, y2
+        scores (torch.Tensor): [n] scores
+        class_ids (torch.Tensor, optional): [n] class ids, needed if class_aware. Defaults to None.
+        iou_threshold (float, optional): boxes overlapping a kept box with a higher score by more than this are dropped. Defaults to 0.3.
+        class_aware (bool, optional): only suppress boxes of the same class. Defaults to False.
+
+    Returns:
+        torch.Tensor: indices of the kept boxes, highest score first
+    """
+    boxes = boxes.float()
+    if class_aware:
+        assert class_ids is not None, "class_ids are needed for class aware nms"
+        return torchvision.ops.batched_nms(boxes, scores, class_ids, iou_threshold)
+    return torchvision.ops.nms(boxes, scores, iou_threshold)
+
+
+def softNMS(boxes: torch.Tensor,
+        scores: torch.Tensor,
+        class_ids: torch.Tensor = None,
+        iou_threshold: float = 0.3,
+        class_aware: bool = False,
+        sigma: float = 0.5,
+        linear: bool = False,
+        score_threshold: float = 0.1):
+    """ soft non-maximum suppression (Bodla et al. 2017), overlapping boxes have their scores
+    decayed instead of being dropped, and are only dropped once their score is below score_threshold
+
+    Args:
+        boxes (torch.Tensor): [n, 4] x1, y1, x2, y2
+        scores (torch.Tensor): [n] scores
+        class_ids (torch.Tensor, optional): [n] class ids, needed if class_aware. Defaults to None.
+        iou_threshold (float, optional): overlap above which the linear decay applies. Defaults to 0.3.
+        class_aware (bool, optional): only decay boxes of the same class. Defaults to False.
+        sigma (float, optional): width of the gaussian decay exp(-iou^2/sigma). Defaults to 0.5.
+        linear (bool, optional): decay by (1 - iou) above iou_threshold instead of the gaussian. Defaults to False.
+        score_threshold (float, optional): boxes whose score falls below this are dropped. Defaults to 0.1.
+
+    Returns:
+        keep (torch.Tensor): indices of the kept boxes, in the order they were picked
+        scores (torch.Tensor): their decayed scores
+    """
+    boxes = boxes.float()
+    if class_aware:
+        assert class_ids is not None, "class_ids are needed for class aware nms"
+        boxes = _classOffsets(boxes, class_ids)
+
+    ious = torchvision.ops.box_iou(boxes, boxes)
+    current = scores.float().clone()
+    alive = current >= score_threshold
+    keep = []
+    keptScores = []
+    for _ in range(len(boxes)):
+        if not bool(alive.any()):
+            break
+        best = int(torch.where(alive, current, torch.full_like(current, -1)).argmax())
+        keep.append(best)
+        keptScores.append(current[best])
+        alive[best] = False
+
+        iou = ious[best]
+        if linear:
+            decay = torch.where(iou > iou_threshold, 1 - iou, torch.ones_like(iou))
+        else:
+            decay = torch.exp(-(iou * iou) / sigma)
+        current = torch.where(alive, current * decay, current)
+        alive &= current >= score_threshold
+
+    device = boxes.device
+    if len(keep) == 0:
+        return torch.zeros((0,), dtype=torch.int64, device=device), torch.zeros((0,), device=device)
+    return torch.as_tensor(keep, dtype=torch.int64, device=device), torch.stack(keptScores)
+
+
+def maskIoU(masks1: torch.Tensor, masks2: torch.Tensor = None, mask_threshold: float = 0.5) -> torch.Tensor:
+    """ intersection over union of every pair of masks
+
+    Args:
+        masks1 (torch.Tensor): [n, h, w] or [n, 1, h, w] soft or binary masks
+        masks2 (torch.Tensor, optional): [m, h, w] masks, masks1 against itself if None. Defaults to None.
+        mask_threshold (float, optional): pixels above this are in the mask. Defaults to 0.5.
+
+    Returns:
+        torch.Tensor: [n, m] iou
+    """
+    a = (masks1.reshape(len(masks1), -1) > mask_threshold).float()
+    b = a if masks2 is None else (masks2.reshape(len(masks2), -1) > mask_threshold).float()
+    intersection = a @ b.T
+    union = a.sum(1)[:, None] + b.sum(1)[None, :] - intersection
+    return torch.where(union > 0, intersection / union.clamp(min=1), torch.zeros_like(union))
+
+
+def maskNMS(masks: torch.Tensor,
+        scores: torch.Tensor,
+        class_ids: torch.Tensor = None,
+        iou_threshold: float = 0.3,
+        class_aware: bool = False,
+        mask_threshold: float = 0.5) -> torch.Tensor:
+    """ greedy non-maximum suppression using the iou of instance masks instead of their boxes
+
+    Args:
+        masks (torch.Tensor): [n, h, w] or [n, 1, h, w] masks, e.g. from Mask R-CNN
+        scores (torch.Tensor): [n] scores
+        class_ids (torch.Tensor, optional): [n] class ids, needed if class_aware. Defaults to None.
+        iou_threshold (float, optional): masks overlapping a kept mask with a higher score by more than this are dropped. Defaults to 0.3.
+        class_aware (bool, optional): only suppress masks of the same class. Defaults to False.
+        mask_threshold (float, optional): pixels above this are in the mask. Defaults to 0.5.
+
+    Returns:
+        torch.Tensor: indices of the kept masks, highest score first
+    """
+    order = torch.argsort(scores, descending=True)
+    overlaps = maskIoU(masks[order], mask_threshold=mask_threshold) > iou_threshold
+    if class_aware:
+        assert class_ids is not None, "class_ids are needed for class aware nms"
+        sorted_ids = class_ids[order]
+        overlaps &= sorted_ids[:, None] == sorted_ids[None, :]
+
+    # the iou is computed on the device, the greedy pass is cheap on the cpu
+    overlaps = overlaps.cpu().numpy()
+    keep = np.ones(len(order), dtype=bool)
+    for i in range(len(order)):
+        if keep[i]:
+            keep[i + 1:] &= ~overlaps[i, i + 1:]
+    return order[torch.from_numpy(keep).to(order.device)]
+
+
+def suppressDetections(result: dict,
+        method: str = "hard",
+        iou_threshold: float = 0.3,
+        class_aware: bool = False,
+        score_threshold: float = 0.1,
+        min_side_length: int = 5,
+        **kwargs) -> dict:
+    """ filter the output of a torchvision detection model for one image, without leaving its device.
+    Applies a score threshold and a minimum box size (as scoreThresholding and boxSizeFiltering) and then nms.
+
+    Args:
+        result (dict): boxes, scores, labels and optionally masks
+        method (str, optional): "hard" (box nms), "soft" (soft-nms) or "mask" (mask iou nms). Defaults to "hard".
+        iou_threshold (float, optional): maximum overlap permitted. Defaults to 0.3.
+        class_aware (bool, optional): only suppress detections of the same class. Defaults to False.
+        score_threshold (float, optional): detections scoring this or less are dropped. Defaults to 0.1.
+        min_side_length (int, optional): minimum side length of boxes in whole pixels. Defaults to 5.
+        **kwargs: passed on to softNMS or maskNMS e.g. sigma, mask_threshold
+
+    Returns:
+        dict: the same keys, with the kept detections highest score first
+    """
+    assert method in NMS_METHODS, f"Unknown nms method: {method}"
+
+    boxes = result['boxes']
+    sides = torch.trunc(boxes[:, 2:]) - torch.trunc(boxes[:, :2])
+    valid = (result['scores'] > score_threshold) & (sides >= min_side_length).all(1)
+    result = {key: value[valid] for key, value in result.items()}
+
+    if method == "hard":
+        keep = boxNMS(result['boxes'], result['scores'], result['labels'], iou_threshold, class_aware)
+    elif method == "soft":
+        keep, scores = softNMS(result['boxes'], result['scores'], result['labels'], iou_threshold, class_aware,
+                score_threshold=score_threshold, **kwargs)
+        result['scores'] = result['scores'].clone()
+        result['scores'][keep] = scores.to(result['scores'].dtype)
+    else:
+        assert 'masks' in result, "mask nms needs masks"
+        keep = maskNMS(result['masks'], result['scores'], result['labels'], iou_threshold, class_aware, **kwargs)
+
+    return {key: value[keep] for key, value in result.items()}
@@ -0,0 +1,362 @@
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple, Union
+from urllib.parse import urlencode
+
+import numpy as np
+import requests
+
+from projectkiwi.cache import TileCache
+from projectkiwi.connector import Connector
+from projectkiwi.metrics import HTTPMetrics
+from projectkiwi.tools import splitZXY, superTileChildren
+
+
+# response headers worth keeping in a bundle
+KEPT_HEADERS = ('Content-Type', 'ETag')
+
+
+class SnapshotBundle():
+    """Recorded API responses in a single sqlite file.
+
+    Responses are keyed by method, url and query parameters (without the api key), so a Connector
+    making the same calls gets the same responses back. Written by snapshot() and read by
+    OfflineConnector.
+
+    Args:
+        path (Union[str, Path]): bundle file, created if missing.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._lock = threading.RLock()
+        self._db = None
+        self._pid = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_db'] = None
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+    def _getDB(self) -> sqlite3.Connection:
+        # one connection per process, sqlite connections don't survive a fork
+        if self._db is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY, status INTEGER, headers TEXT, content BLOB)""")
+            self._db.execute("CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value TEXT)")
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+
+    @staticmethod
+    def requestKey(method: str, url: str, params: dict = None) -> str:
+        """ key for a request, the api key is left out so bundles can be shared
+
+        Args:
+            method (str): http method e.g. GET
+            url (str): url without the query string
+            params (dict, optional): query parameters. Defaults to None.
+
+        Returns:
+            str: key
+        """
+        params = sorted((k, str(v)) for k, v in (params or {}).items() if k != 'key')
+        return f"{method} {url}?{urlencode(params)}"
+
+
+    def get(self, key: str) -> Optional[Tuple[int, dict, bytes]]:
+        """ a recorded response
+
+        Args:
+            key (str): key from requestKey
+
+        Returns:
+            Optional[Tuple[int, dict, bytes]]: status, headers and content, None if not recorded
+        """
+        with self._lock:
+            row = self._getDB().execute(
+                    "SELECT status, headers, content FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), bytes(row[2])
+
+
+    def contains(self, key: str) -> bool:
+        """ whether a response is recorded
+
+        Args:
+            key (str): key from requestKey
+
+        Returns:
+            bool: True if recorded
+        """
+        with self._lock:
+            return self._getDB().execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+
+
+    def put(self, key: str, status: int, headers: dict, content: bytes):
+        """ record a response, replacing any earlier one
+
+        Args:
+            key (str): key from requestKey
+            status (int): http status
+            headers (dict): response headers, only KEPT_HEADERS are stored
+            content (bytes): response body
+        """
+        headers = {k: headers[k] for k in KEPT_HEADERS if k in headers}
+        with self._lock:
+            db = self._getDB()
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, status, json.dumps(headers), sqlite3.Binary(content)))
+            db.commit()
+
+
+    def info(self) -> dict:
+        """ what the bundle was made from, as given to setInfo
+
+        Returns:
+            dict: info, empty for a new bundle
+        """
+        with self._lock:
+            rows = self._getDB().execute("SELECT name, value FROM info").fetchall()
+        return {name: json.loads(value) for name, value in rows}
+
+
+    def setInfo(self, **info):
+        """ record what the bundle was made from
+        """
+        with self._lock:
+            db = self._getDB()
+            db.executemany("INSERT OR REPLACE INTO info VALUES (?, ?)",
+                    [(name, json.dumps(value)) for name, value in info.items()])
+            db.commit()
+
+
+    def close(self):
+        """ close the sqlite connection
+        """
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
+
+
+
+class _RecordingSession():
+    """ Session wrapper that records every successful GET in a bundle, with reuse=True
+    requests that are already recorded aren't made again
+    """
+
+    def __init__(self, session, bundle: SnapshotBundle):
+        self.session = session
+        self.bundle = bundle
+        self.metrics = session.metrics
+        self.reuse = False
+        self.downloaded = 0
+        self._lock = threading.Lock()
+
+    def request(self, method: str, url: str, route: str = None, **kwargs) -> requests.Response:
+        key = SnapshotBundle.requestKey(method, url, kwargs.get('params'))
+        if self.reuse and method == "GET" and self.bundle.contains(key):
+            return _ReplaySession(self.bundle, self.metrics).request(method, url, route=route, **kwargs)
+
+        r = self.session.request(method, url, route=route, **kwargs)
+        if method == "GET" and r.ok:
+            # reading .content also buffers streamed responses, they can still be iterated after
+            self.bundle.put(key, r.status_code, r.headers, r.content)
+            with self._lock:
+                self.downloaded += 1
+        return r
+
+
+
+class _ReplaySession():
+    """ stand-in for Session that answers requests from a bundle
+    """
+
+    def __init__(self, bundle: SnapshotBundle, metrics: HTTPMetrics):
+        self.bundle = bundle
+        self.metrics = metrics
+        self.limiter = None
+
+    def close(self):
+        self.bundle.close()
+
+    def request(self, method: str, url: str, route: str = None, **kwargs) -> requests.Response:
+        start = time.monotonic()
+        r = requests.Response()
+        r.url = url
+        r._content_consumed = True
+        found = self.bundle.get(SnapshotBundle.requestKey(method, url, kwargs.get('params'))) if method == "GET" else None
+
+        if found is not None:
+            r.status_code, headers, r._content = found
+            r.headers.update(headers)
+            r.reason = "OK"
+        elif method == "GET":
+            r.status_code, r.reason, r._content = 404, "Not in offline snapshot", b""
+        else:
+            r.status_code, r.reason, r._content = 405, "Offline snapshots are read only", b""
+
+        self.metrics.record(route or url, method, r.status_code, time.monotonic() - start, len(r._content))
+        return r
+
+
+
+class OfflineConnector(Connector):
+    """A Connector that serves everything from a bundle made by snapshot(), without any network access.
+
+    The API is the same as Connector. Calls that were recorded in the snapshot return what the server
+    returned then, anything else raises an HTTPError (404 for reads, 405 for writes). Super tiles are
+    always mosaicked from the recorded tiles at max_zoom (see Connector.getSuperTile), which is why
+    snapshot() records those.
+
+    Args:
+        path (Union[str, Path]): bundle file made by snapshot().
+        metadata_ttl (float, optional): see Connector. Defaults to None.
+        tile_cache (TileCache, optional): see Connector, e.g. to keep decoded tiles in memory. Defaults to None.
+
+    Example:
+        >>> snapshot(conn, "chicago.kiwi", project_id, imagery_id, queue_id, zoom=19)
+        >>> offline = OfflineConnector("chicago.kiwi")
+        >>> tasks = offline.getTasks(queue_id)
+        >>> tile = offline.getSuperTile(imagery_id, tasks[0].zxy, max_zoom=19)
+    """
+
+    def __init__(self, path: Union[str, Path], metadata_ttl: float = None, tile_cache: TileCache = None):
+        bundle = SnapshotBundle(path)
+        info = bundle.info()
+        assert 'url' in info, f"Not a snapshot bundle: {path}"
+
+        super().__init__("", info['url'], adaptive_concurrency=False, metadata_ttl=metadata_ttl, tile_cache=tile_cache)
+        self.bundle = bundle
+        self.info = info
+        self.session = _ReplaySession(bundle, self.metrics)
+
+
+    def getSuperTile(self,
+                imagery_id: str,
+                zxy: str,
+                max_zoom: int = 22,
+                padding: int = 0,
+                out: np.ndarray = None,
+                drop_alpha: bool = False,
+                mosaic: bool = True,
+                max_workers: int = 8,
+                max_attempts: int = 1
+        ) -> np.ndarray:
+        """Get a tile as higher resolution, mosaicked from the recorded tiles at max_zoom.
+
+        Args:
+            imagery_id (str): The ID of the imagery
+            zxy (str): zxy string to specify the tile e.g. 12/345/678
+            max_zoom (int, optional): Maximum zoom. Defaults to 22.
+            padding (int, optional): Number of pixels to read on each side of the tile. Defaults to 0.
+            out (np.ndarray, optional): preallocated uint8 array to decode into. Defaults to None.
+            drop_alpha (bool, optional): drop the alpha channel, RGBA becomes RGB. Defaults to False.
+            mosaic (bool, optional): ignored, super tiles are always mosaicked offline. Defaults to True.
+            max_workers (int, optional): threads decoding child tiles. Defaults to 8.
+            max_attempts (int, optional): ignored, missing tiles won't appear on a second attempt. Defaults to 1.
+
+        Returns:
+            np.ndarray: Image data for the tile.
+        """
+        return super().getSuperTile(imagery_id, zxy, max_zoom, padding, out, drop_alpha,
+                mosaic=True, max_workers=max_workers, max_attempts=1)
+
+
+
+def snapshot(conn: Connector,
+        path: Union[str, Path],
+        project_id: str,
+        imagery_id: str = None,
+        queue_id: int = None,
+        zoom: int = None,
+        padding: int = 0,
+        max_workers: int = 8) -> SnapshotBundle:
+    """Record everything needed to work on a project offline in a single bundle file.
+
+    Records the projects, imagery, labels and annotations (and predictions) of the project. With a
+    queue_id the tasks in the queue are recorded. With an imagery_id and zoom, the imagery status, the
+    tile list at that zoom and the tiles are recorded: the tiles at zoom needed for the super tiles of
+    every task (with padding), or every tile in the tile list if there is no queue.
+
+    Running it again on the same bundle refreshes the metadata and only downloads tiles that are missing.
+
+    Args:
+        conn (Connector): A connection object from projectkiwi.connector.
+        path (Union[str, Path]): bundle file to write, see OfflineConnector.
+        project_id (str): Id of the project.
+        imagery_id (str, optional): Id of the imagery to record tiles for. Defaults to None.
+        queue_id (int, optional): Id of the task queue. Defaults to None.
+        zoom (int, optional): zoom of the recorded tiles, i.e. the max_zoom used for super tiles. Defaults to None.
+        padding (int, optional): padding used for super tiles, neighbouring tiles are recorded to cover it. Defaults to 0.
+        max_workers (int, optional): concurrent tile downloads. Defaults to 8.
+
+    Returns:
+        SnapshotBundle: the bundle
+    """
+    assert (imagery_id is None) == (zoom is None), "imagery_id and zoom must be given together"
+
+    bundle = SnapshotBundle(path)
+    bundle.setInfo(url=conn.url, project_id=project_id, imagery_id=imagery_id, queue_id=queue_id,
+            zoom=zoom, padding=padding, created=time.time())
+
+    # a copy of the connector that records its responses, bypassing its caches
+    recorder = copy.copy(conn)
+    recorder.session = _RecordingSession(conn.session, bundle)
+    recorder.metadata_cache = None
+    recorder.annotation_mirror = None
+    recorder.tile_cache = None
+    recorder.overviews = {}
+
+    recorder.getProjects()
+    recorder.getImagery(project_id)
+    recorder.getLabels(project_id)
+    annotations = recorder.getAnnotations(project_id)
+    tasks = recorder.getTasks(queue_id) if queue_id is not None else []
+
+    if imagery_id is not None:
+        recorder.getImageryStatus(imagery_id)
+        tileList = recorder.getTileList(imagery_id, project_id, zoom)
+
+        if queue_id is not None:
+            zxys = set()
+            for task in tasks:
+                if task.imagery_id == imagery_id:
+                    zxys.update(superTileChildren(*splitZXY(task.zxy), zoom, padding))
+        else:
+            zxys = {(tile.z, tile.x, tile.y) for tile in tileList}
+
+        # tiles don't change, only download the ones that aren't in the bundle yet
+        recorder.session.reuse = True
+        before = recorder.session.downloaded
+
+        def fetch(zxy):
+            recorder.getTile(imagery_id, *zxy, raw=True)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(fetch, sorted(zxys)))
+        tiles = recorder.session.downloaded - before
+    else:
+        tiles = 0
+
+    print(f"Snapshot of {project_id}: {len(annotations)} annotations, {len(tasks)} tasks, {tiles} new tiles in {path}")
+    return bundle
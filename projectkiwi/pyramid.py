@@ -0,0 +1,113 @@
+import numpy as np
+
+
+RESAMPLING = ("box", "nearest", "max")
+
+
+def downsample2x(image: np.ndarray, resampling: str = "box") -> np.ndarray:
+    """ Halve the width and height of an image with a vectorised 2x2 reduction
+
+    Args:
+        image (np.ndarray): image [h, w] or [h, w, c] with even h and w
+        resampling (str, optional): "box" (mean), "nearest" (top left pixel) or "max". Defaults to "box".
+
+    Returns:
+        np.ndarray: image [h/2, w/2(, c)] with the same dtype
+    """
+    assert resampling in RESAMPLING, f"Unknown resampling: {resampling}"
+    h, w = image.shape[:2]
+    assert h % 2 == 0 and w % 2 == 0, f"Image size must be even, got: {image.shape}"
+
+    if resampling == "nearest":
+        return image[::2, ::2]
+
+    blocks = image.reshape((h//2, 2, w//2, 2) + image.shape[2:])
+    if resampling == "max":
+        return blocks.max(axis=(1, 3))
+
+    if np.issubdtype(image.dtype, np.integer):
+        total = blocks.sum(axis=(1, 3), dtype=np.uint32 if image.itemsize < 4 else np.uint64)
+        return ((total + 2) // 4).astype(image.dtype)
+    return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+
+
+class TilePyramid():
+    """Derive lower zoom tiles for a layer locally from its tiles at max_zoom.
+
+    A tile at zoom z is built from its 4 children at z+1 (each taken from the tile cache, or built the
+    same way), mosaicked to 512px and halved. At max_zoom-1 the 4 children are downloaded in parallel
+    (through the tile cache if the connector has one). Only one 512px mosaic per level is held at a time,
+    however far below max_zoom the tile is. Every derived tile is put in the tile cache, under its own
+    key, so going coarse to fine, or fine to coarse, over the same area doesn't download anything twice.
+
+    Usually set up with Connector.enableOverviews, after which Connector.getTile serves these tiles.
+
+    Args:
+        conn (Connector): A connection object from projectkiwi.connector.
+        imagery_id (str): Id of the imagery.
+        max_zoom (int): Zoom level of the tiles that are downloaded.
+        resampling (str, optional): "box", "nearest" or "max", see downsample2x. Defaults to "box".
+        max_workers (int, optional): concurrent downloads of max_zoom tiles. Defaults to 8.
+    """
+
+    def __init__(self, conn, imagery_id: str, max_zoom: int, resampling: str = "box", max_workers: int = 8):
+        assert resampling in RESAMPLING, f"Unknown resampling: {resampling}"
+        self.conn = conn
+        self.imagery_id = imagery_id
+        self.max_zoom = max_zoom
+        self.resampling = resampling
+        self.max_workers = max_workers
+
+
+    def cacheKey(self, z: int, x: int, y: int) -> tuple:
+        """ tile cache key of a derived tile, distinct from the key of the server's tile
+
+        Args:
+            z (int): zoom
+            x (int): x tile
+            y (int): y tile
+
+        Returns:
+            tuple: key
+        """
+        return (self.imagery_id, z, x, y, 256, 0, "overview", self.resampling)
+
+
+    def getTile(self, z: int, x: int, y: int) -> np.ndarray:
+        """ Get a 256px tile, downloaded if at max_zoom and derived otherwise
+
+        Args:
+            z (int): zoom
+            x (int): x tile
+            y (int): y tile
+
+        Returns:
+            np.ndarray: numpy array of tile
+        """
+        if z >= self.max_zoom:
+            return self.conn.getTile(self.imagery_id, z, x, y)
+
+        cache = self.conn.tile_cache
+        if cache is not None:
+            tile = cache.get(self.cacheKey(z, x, y))
+            if tile is not None:
+                return tile
+
+        if z + 1 == self.max_zoom:
+            image = self.conn.getSuperTile(self.imagery_id, f"{z}/{x}/{y}", self.max_zoom,
+                    mosaic=True, max_workers=self.max_workers)
+        else:
+            image = None
+            for j in range(2):
+                for i in range(2):
+                    child = self.getTile(z + 1, 2*x + i, 2*y + j)
+                    if image is None:
+                        image = np.empty((512, 512) + child.shape[2:], dtype=child.dtype)
+                    image[j*256:(j+1)*256, i*256:(i+1)*256] = child
+
+        # a copy, so a cached tile never keeps the mosaic alive
+        tile = np.ascontiguousarray(downsample2x(image, self.resampling))
+        if cache is not None:
+            cache.put(self.cacheKey(z, x, y), array=tile)
+        return tile
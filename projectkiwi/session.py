@@ -0,0 +1,464 @@
+import os
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from projectkiwi.metrics import HTTPMetrics, bodySize
+
+
+# (connect, read) timeouts in seconds, looked up by route name
+DEFAULT_TIMEOUTS = {
+    'default': (10, 60),
+    'get_tile': (10, 120),
+    'get_super_tile': (10, 120),
+    'upload': (10, None),
+}
+
+# statuses that are worth another attempt
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# methods that are safe to send again after the server may have seen them
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+# statuses that mean the server wants less traffic
+OVERLOAD_STATUSES = (429, 503)
+
+
+
+class _RouteLimit():
+    """ concurrency state for one route
+    """
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.latency = None
+        self.last_decrease = 0.0
+
+
+
+class AdaptiveLimiter():
+    """Limit in-flight requests per route, adapting the limit with AIMD.
+
+    Each route starts at initial_limit concurrent requests. Every successful response grows the
+    limit additively (by about one per round of requests). A 429/503, a connection error, or a
+    response much slower than the route's typical latency halves it (at most once per typical
+    latency, so one burst only counts once). A Retry-After header pauses new requests to the
+    route until it has passed.
+
+    Args:
+        initial_limit (int, optional): starting number of in-flight requests per route. Defaults to 4.
+        min_limit (int, optional): lowest limit. Defaults to 1.
+        max_limit (int, optional): highest limit. Defaults to 10.
+        latency_factor (float, optional): responses slower than this multiple of the typical latency count as congestion. Defaults to 3.
+    """
+
+    def __init__(self,
+            initial_limit: int = 4,
+            min_limit: int = 1,
+            max_limit: int = 10,
+            latency_factor: float = 3):
+
+        self.initial_limit = max(min_limit, min(initial_limit, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_factor = latency_factor
+        self._routes: Dict[str, _RouteLimit] = {}
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_condition'] = None
+        state['_routes'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+
+
+    @property
+    def condition(self) -> threading.Condition:
+        """ the condition guarding the routes, rebuilt after a fork
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            # fork may have copied the condition while another thread held it, and the
+            # parent's in-flight requests aren't this process's
+            self._condition = threading.Condition()
+            self._routes = {}
+            self._pid = pid
+        return self._condition
+
+
+    def _route(self, route: str) -> _RouteLimit:
+        if route not in self._routes:
+            self._routes[route] = _RouteLimit(self.initial_limit)
+        return self._routes[route]
+
+
+    def acquire(self, route: str):
+        """ wait for a free slot on a route
+
+        Args:
+            route (str): route name
+        """
+        with self.condition:
+            state = self._route(route)
+            while True:
+                wait = state.blocked_until - time.monotonic()
+                if wait <= 0 and state.in_flight < int(state.limit):
+                    state.in_flight += 1
+                    return
+                self.condition.wait(timeout=wait if wait > 0 else None)
+
+
+    def release(self, route: str, latency: float, status: Optional[int] = None, retry_after: Optional[float] = None):
+        """ free a slot and adapt the limit to how the request went
+
+        Args:
+            route (str): route name
+            latency (float): seconds until the response arrived
+            status (Optional[int], optional): response status, None for a connection error. Defaults to None.
+            retry_after (Optional[float], optional): seconds the server asked to wait. Defaults to None.
+        """
+        with self.condition:
+            state = self._route(route)
+            state.in_flight = max(0, state.in_flight - 1)
+            now = time.monotonic()
+
+            congested = status is None or status in OVERLOAD_STATUSES
+            if not congested and state.latency is not None:
+                congested = latency > self.latency_factor*state.latency
+
+            if congested:
+                if now - state.last_decrease > (state.latency or 0):
+                    state.limit = max(self.min_limit, state.limit / 2)
+                    state.last_decrease = now
+            else:
+                state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+                # typical latency of successful requests
+                state.latency = latency if state.latency is None else 0.9*state.latency + 0.1*latency
+
+            if retry_after is not None:
+                state.blocked_until = max(state.blocked_until, now + retry_after)
+
+            self.condition.notify_all()
+
+
+    def limits(self) -> Dict[str, dict]:
+        """ current state of each route
+
+        Returns:
+            Dict[str, dict]: limit, in_flight and typical latency by route
+        """
+        with self.condition:
+            return {route: {'limit': state.limit, 'in_flight': state.in_flight, 'latency': state.latency}
+                    for route, state in self._routes.items()}
+
+
+class Session():
+    """Pooled, retrying http session shared by all calls made through a connector.
+
+    A single ``requests.Session`` is kept per process so that connections to each host
+    are reused (keep-alive) instead of doing a new TCP+TLS handshake for every call.
+    The session is thread-safe to use from many threads at once, and is re-created
+    lazily after a fork (e.g. inside DataLoader workers) so sockets are never shared
+    between processes.
+
+    Args:
+        pool_size (int, optional): Maximum number of kept-alive connections per host. Defaults to 10.
+        max_retries (int, optional): Number of retries on connection errors and retryable statuses. Defaults to 5.
+        backoff_factor (float, optional): Base delay in seconds for the exponential backoff. Defaults to 0.5.
+        backoff_max (float, optional): Cap on the delay between attempts in seconds. Defaults to 30.
+        timeouts (Dict[str, Tuple], optional): (connect, read) timeouts per route, merged over DEFAULT_TIMEOUTS. Defaults to None.
+        adaptive_concurrency (bool, optional): limit in-flight requests per route with an AdaptiveLimiter, up to pool_size. Defaults to True.
+        metrics (HTTPMetrics, optional): where to record every attempt, a new HTTPMetrics if None. Defaults to None.
+    """
+
+    def __init__(self,
+            pool_size: int = 10,
+            max_retries: int = 5,
+            backoff_factor: float = 0.5,
+            backoff_max: float = 30,
+            timeouts: Dict[str, Tuple] = None,
+            adaptive_concurrency: bool = True,
+            metrics: HTTPMetrics = None):
+
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+
+        self.limiter = AdaptiveLimiter(max_limit=pool_size) if adaptive_concurrency else None
+        self.metrics = metrics if metrics is not None else HTTPMetrics()
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+
+    def __getstate__(self):
+        # sessions and locks can't be pickled, they are rebuilt on first use
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_session'] = None
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    @property
+    def session(self) -> requests.Session:
+        """ the underlying requests session for this process
+        """
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            if self._pid != pid:
+                # the lock may have been copied in a locked state by fork
+                self._lock = threading.Lock()
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    self._session = self._makeSession()
+                    self._pid = pid
+        return self._session
+
+
+    def _makeSession(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+                max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+    def close(self):
+        """ close all pooled connections
+        """
+        if self._session is not None and self._pid == os.getpid():
+            self._session.close()
+        self._session = None
+
+
+    def getTimeout(self, route: str) -> Union[Tuple, float]:
+        """ Get the timeout to use for a route
+
+        Args:
+            route (str): route name e.g. api/get_annotations
+
+        Returns:
+            Union[Tuple, float]: (connect, read) timeout
+        """
+        return timeoutForRoute(self.timeouts, route)
+
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """ Delay before the next attempt, exponential with full jitter.
+
+        Args:
+            attempt (int): number of attempts made so far, starting at 1
+            retry_after (float, optional): delay requested by the server. Defaults to None.
+
+        Returns:
+            float: seconds to wait
+        """
+        return backoffDelay(attempt, self.backoff_factor, self.backoff_max, retry_after)
+
+
+    def request(self, method: str, url: str, route: str = None, idempotent: bool = None, **kwargs) -> requests.Response:
+        """ Make a request, retrying on connection errors and retryable statuses.
+
+        Requests that aren't idempotent (e.g. a POST adding an annotation) are only retried when the
+        connection couldn't be made, since after a 5xx or a read timeout the server may already
+        have done the work and sending it again would do it twice.
+
+        Args:
+            method (str): http method e.g. GET
+            url (str): full url
+            route (str, optional): route name used to pick the timeout. Defaults to the url path.
+            idempotent (bool, optional): whether the request is safe to send twice. Defaults to None,
+                true for GET, HEAD, PUT, DELETE and OPTIONS.
+
+        Returns:
+            requests.Response: the final response, statuses are not raised here.
+        """
+        if route is None:
+            route = urlparse(url).path.strip("/")
+        kwargs.setdefault('timeout', self.getTimeout(route))
+        bytes_out = bodySize(kwargs.get('data'))
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if attempt > 1:
+                rewind(kwargs.get('data'))
+
+            if self.limiter is not None:
+                self.limiter.acquire(route)
+            start = time.monotonic()
+            r = None
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                # every acquire is released, whatever was raised
+                latency = time.monotonic() - start
+                retry_after = None if r is None else parseRetryAfter(r.headers.get('Retry-After'))
+                if self.limiter is not None:
+                    self.limiter.release(route, latency, None if r is None else r.status_code, retry_after)
+
+            if r is None:
+                self.metrics.record(route, method, None, latency, 0, bytes_out, attempt)
+                if attempt > self.max_retries or not (idempotent or isConnectError(error)):
+                    raise error
+                time.sleep(self.backoff(attempt))
+                continue
+
+            self.metrics.record(route, method, r.status_code, latency, responseSize(r), bytes_out, attempt)
+
+            if r.status_code in RETRY_STATUSES and attempt <= self.max_retries and idempotent:
+                r.close()
+                time.sleep(self.backoff(attempt, retry_after))
+                continue
+
+            return r
+
+
+
+def isConnectError(e: Exception) -> bool:
+    """ whether a request failed while connecting, before the server could have seen it
+
+    Args:
+        e (Exception): exception raised by requests
+
+    Returns:
+        bool: True for connection refused, dns failures and connect timeouts
+    """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.ConnectionError) or isinstance(e, requests.exceptions.SSLError):
+        return False
+    # requests wraps urllib3's MaxRetryError, whose reason is the underlying error
+    reason = e.args[0] if e.args else None
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def responseSize(r: requests.Response) -> int:
+    """ size of a response body, from Content-Length if the body hasn't been read (stream=True)
+
+    Args:
+        r (requests.Response): response
+
+    Returns:
+        int: size in bytes, 0 if unknown
+    """
+    if r._content_consumed and isinstance(r._content, bytes):
+        return len(r._content)
+    try:
+        return int(r.headers.get('Content-Length', 0))
+    except ValueError:
+        return 0
+
+
+def tileRoute(tile_size: int) -> str:
+    """ Route name for a tile request. Super tiles take far longer than 256px tiles, so they get
+    their own latency average and concurrency limit instead of looking like congestion.
+
+    Args:
+        tile_size (int): width or height of the requested tile
+
+    Returns:
+        str: get_tile or get_super_tile
+    """
+    return "get_tile" if tile_size <= 256 else "get_super_tile"
+
+
+def timeoutForRoute(timeouts: Dict[str, Tuple], route: str) -> Union[Tuple, float]:
+    """ Look up the timeout for a route, by full route then by its last component
+
+    Args:
+        timeouts (Dict[str, Tuple]): timeouts by route, must include 'default'
+        route (str): route name e.g. api/get_annotations
+
+    Returns:
+        Union[Tuple, float]: (connect, read) timeout
+    """
+    if route in timeouts:
+        return timeouts[route]
+    name = route.split("/")[-1]
+    if name in timeouts:
+        return timeouts[name]
+    return timeouts['default']
+
+
+def backoffDelay(attempt: int, backoff_factor: float, backoff_max: float, retry_after: Optional[float] = None) -> float:
+    """ Exponential backoff with full jitter, never shorter than what the server asked for.
+
+    Args:
+        attempt (int): number of attempts made so far, starting at 1
+        backoff_factor (float): base delay in seconds
+        backoff_max (float): cap on the exponential delay in seconds
+        retry_after (float, optional): delay requested by the server. Defaults to None.
+
+    Returns:
+        float: seconds to wait
+    """
+    delay = random.uniform(0, min(backoff_max, backoff_factor * 2**(attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def parseRetryAfter(value: Optional[str]) -> Optional[float]:
+    """ Parse a Retry-After header, given either in seconds or as an http date
+
+    Args:
+        value (Optional[str]): header value
+
+    Returns:
+        Optional[float]: seconds to wait, None if missing or not understood
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rewind(data):
+    """ Seek a file-like request body back to the start before it is sent again
+
+    Args:
+        data: request body
+    """
+    if hasattr(data, 'seek') and hasattr(data, 'tell'):
+        data.seek(0)
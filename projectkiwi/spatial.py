@@ -0,0 +1,221 @@
+import math
+from itertools import chain
+from typing import List, Union
+
+import numpy as np
+
+from projectkiwi.models import Annotation, AnnotationTable
+
+
+# web mercator is undefined at the poles, latitudes are clipped to this
+MAX_LATITUDE = 85.0511287798
+
+
+def mercatorBounds(annotations: Union[List[Annotation], AnnotationTable]) -> np.ndarray:
+    """ Bounding box of every annotation in normalised web mercator coordinates, where the world is
+    [0, 1] x [0, 1] with y growing southwards, so tile x, y at zoom z covers [x, x+1] / 2^z.
+
+    Args:
+        annotations (Union[List[Annotation], AnnotationTable]): annotations
+
+    Returns:
+        np.ndarray: [n, 4] x1, y1, x2, y2 (left, top, right, bottom), NaN for annotations without coordinates
+    """
+    if isinstance(annotations, AnnotationTable):
+        lngLat = annotations.bounds()
+    else:
+        # every vertex in one array, reduced per annotation
+        counts = np.fromiter((len(annotation.coordinates) for annotation in annotations), np.int64, len(annotations))
+        vertices = np.array(list(chain.from_iterable(annotation.coordinates for annotation in annotations)),
+                dtype=np.float64).reshape(-1, 2)
+        lngLat = np.full((len(annotations), 4), np.nan)
+        nonEmpty = counts > 0
+        if nonEmpty.any():
+            starts = (np.cumsum(counts) - counts)[nonEmpty]
+            lngLat[nonEmpty, :2] = np.minimum.reduceat(vertices, starts, axis=0)
+            lngLat[nonEmpty, 2:] = np.maximum.reduceat(vertices, starts, axis=0)
+
+    bounds = np.empty_like(lngLat)
+    bounds[:, 0] = (lngLat[:, 0] + 180.0) / 360.0
+    bounds[:, 2] = (lngLat[:, 2] + 180.0) / 360.0
+    # the top of the box is its largest latitude
+    for column, latColumn in ((1, 3), (3, 1)):
+        lat = np.radians(np.clip(lngLat[:, latColumn], -MAX_LATITUDE, MAX_LATITUDE))
+        bounds[:, column] = (1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0
+    return bounds
+
+
+def tileBounds(z: int, x: int, y: int) -> np.ndarray:
+    """ A tile in normalised web mercator coordinates, see mercatorBounds
+
+    Args:
+        z (int): zoom
+        x (int): x tile
+        y (int): y tile
+
+    Returns:
+        np.ndarray: [4] x1, y1, x2, y2
+    """
+    n = 2.0 ** z
+    return np.array([x / n, y / n, (x + 1) / n, (y + 1) / n])
+
+
+def overlaps(bounds: np.ndarray, z, x, y) -> np.ndarray:
+    """ The portion of each bounding box that is inside a tile, the same as tools.getOverlap.
+    Pass arrays of z, x, y to get the overlaps with many tiles at once.
+
+    Args:
+        bounds (np.ndarray): [n, 4] boxes from mercatorBounds
+        z (Union[int, np.ndarray]): zoom, or [t] zooms
+        x (Union[int, np.ndarray]): x tile, or [t] x tiles
+        y (Union[int, np.ndarray]): y tile, or [t] y tiles
+
+    Returns:
+        np.ndarray: [n] (or [t, n] for arrays of tiles) overlap [0,1], 0 for empty boxes
+    """
+    # in tile units, relative to the tile, tiles along the first axis
+    n = np.exp2(np.asarray(z, dtype=np.float64))[..., None]
+    x = np.asarray(x, dtype=np.float64)[..., None]
+    y = np.asarray(y, dtype=np.float64)[..., None]
+    x1 = bounds[:, 0]*n - x
+    y1 = bounds[:, 1]*n - y
+    x2 = bounds[:, 2]*n - x
+    y2 = bounds[:, 3]*n - y
+
+    intersection = (np.clip(x2, 0, 1) - np.clip(x1, 0, 1)) * (np.clip(y2, 0, 1) - np.clip(y1, 0, 1))
+    area = np.abs((x2 - x1)*(y2 - y1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        overlap = np.where(area > 0, intersection / area, 0.0)
+    return np.nan_to_num(overlap, nan=0.0)
+
+
+
+class AnnotationIndex():
+    """A grid index of a project's annotations in web mercator tile space.
+
+    Each annotation's bounding box is put in the cells it covers of a grid at a zoom level picked to
+    match the typical annotation size, so a query only looks at the annotations near a tile rather than
+    all of them. Annotations covering many cells are kept in a separate list that every query checks.
+    Overlaps are computed with the same formula as tools.getOverlap, so query gives the same result as
+    getAnnotationsForTile on the full list (which uses the index when it is given one).
+
+    Args:
+        annotations (Union[List[Annotation], AnnotationTable]): annotations to index.
+        grid_zoom (int, optional): zoom of the grid cells, picked from the annotation sizes if None. Defaults to None.
+        max_cells (int, optional): annotations covering more cells than this go in the separate list. Defaults to 16.
+
+    Example:
+        >>> index = AnnotationIndex(conn.getAnnotations(project_id))
+        >>> for task in tasks:
+        ...     annotations = index.query(task.zxy, overlap_threshold=0.9)
+    """
+
+    def __init__(self,
+            annotations: Union[List[Annotation], AnnotationTable],
+            grid_zoom: int = None,
+            max_cells: int = 16):
+        self.annotations = annotations
+        self.bounds = mercatorBounds(annotations)
+        valid = ~np.isnan(self.bounds).any(axis=1)
+
+        if grid_zoom is None:
+            size = np.maximum(self.bounds[valid, 2] - self.bounds[valid, 0], self.bounds[valid, 3] - self.bounds[valid, 1])
+            size = size[size > 0]
+            # cells about as big as a typical annotation
+            grid_zoom = int(np.clip(math.floor(-math.log2(np.median(size))), 0, 24)) if len(size) else 0
+        self.grid_zoom = grid_zoom
+
+        cells = self._cellRange(self.bounds[valid])
+        ids = np.flatnonzero(valid)
+        counts = (cells[:, 2] - cells[:, 0] + 1)*(cells[:, 3] - cells[:, 1] + 1)
+        large = counts > max_cells
+        self.large = ids[large]
+
+        # (cell, annotation) for every cell each small annotation covers
+        ids, cells, counts = ids[~large], cells[~large], counts[~large]
+        owner = np.repeat(np.arange(len(ids)), counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        step = np.arange(len(owner)) - first
+        width = cells[owner, 2] - cells[owner, 0] + 1
+        cx = cells[owner, 0] + step % width
+        cy = cells[owner, 1] + step // width
+        keys = cx*(2**self.grid_zoom) + cy
+
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        self.cell_ids = ids[owner[order]]
+        self.cell_keys, self.cell_starts = np.unique(keys, return_index=True)
+        self.cell_ends = np.append(self.cell_starts[1:], len(keys))
+
+
+    def _cellRange(self, bounds: np.ndarray) -> np.ndarray:
+        # first and last cell x, y covered by each box
+        n = 2**self.grid_zoom
+        cells = np.floor(np.clip(bounds, 0, 1)*n).astype(np.int64)
+        return np.clip(cells, 0, n - 1)
+
+
+    def candidates(self, z: int, x: int, y: int) -> np.ndarray:
+        """ indices of the annotations whose cells touch a tile, a superset of those overlapping it
+
+        Args:
+            z (int): zoom
+            x (int): x tile
+            y (int): y tile
+
+        Returns:
+            np.ndarray: sorted indices
+        """
+        x0, y0, x1, y1 = self._cellRange(tileBounds(z, x, y)[None])[0]
+        if (x1 - x0 + 1)*(y1 - y0 + 1) > len(self.cell_keys):
+            # the tile covers more cells than are in use
+            found = self.cell_keys
+        else:
+            n = 2**self.grid_zoom
+            found = (np.arange(x0, x1 + 1)[:, None]*n + np.arange(y0, y1 + 1)[None, :]).ravel()
+
+        position = np.searchsorted(self.cell_keys, found)
+        position = position[position < len(self.cell_keys)]
+        position = position[np.isin(self.cell_keys[position], found)]
+        cellX, cellY = np.divmod(self.cell_keys[position], 2**self.grid_zoom)
+        inside = (cellX >= x0) & (cellX <= x1) & (cellY >= y0) & (cellY <= y1)
+        position = position[inside]
+
+        ranges = [self.cell_ids[start:end] for start, end in zip(self.cell_starts[position], self.cell_ends[position])]
+        return np.unique(np.concatenate(ranges + [self.large]))
+
+
+    def queryIndices(self, zxy: str, overlap_threshold: float = 0.2) -> np.ndarray:
+        """ indices of the annotations with enough overlap with a tile
+
+        Args:
+            zxy (str): The tile e.g. 12/345/678
+            overlap_threshold (float, optional): How much overlap. Defaults to 0.2.
+
+        Returns:
+            np.ndarray: sorted indices into the annotations
+        """
+        z, x, y = (int(v) for v in zxy.split("/"))
+        if overlap_threshold <= 0:
+            # everything has at least no overlap
+            return np.arange(len(self.bounds))
+        candidates = self.candidates(z, x, y)
+        overlap = overlaps(self.bounds[candidates], z, x, y)
+        return candidates[overlap >= overlap_threshold]
+
+
+    def query(self, zxy: str, overlap_threshold: float = 0.2) -> list:
+        """ annotations with enough overlap with a tile, in their original order
+
+        Args:
+            zxy (str): The tile e.g. 12/345/678
+            overlap_threshold (float, optional): How much overlap. Defaults to 0.2.
+
+        Returns:
+            list: annotations (AnnotationViews if the index was built from an AnnotationTable)
+        """
+        return [self.annotations[int(i)] for i in self.queryIndices(zxy, overlap_threshold)]
+
+
+    def __len__(self) -> int:
+        return len(self.bounds)
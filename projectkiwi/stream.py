@@ -0,0 +1,108 @@
+import codecs
+import json
+import re
+from typing import Any, Iterable, Iterator, Tuple
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _Buffer():
+    """ text buffer filled incrementally from byte chunks
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def more(self) -> bool:
+        """ read the next chunk, returns False once the input is exhausted
+        """
+        if self.eof:
+            return False
+        # drop what has already been consumed
+        if self.pos > 0:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.text += self.decoder.decode(chunk)
+                return True
+        self.text += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def skipWhitespace(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or not self.more():
+                return
+
+    def peek(self) -> str:
+        self.skipWhitespace()
+        if self.pos >= len(self.text):
+            raise ValueError("Unexpected end of JSON input")
+        return self.text[self.pos]
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' in JSON input at position {self.pos}, found '{found}'")
+        self.pos += 1
+
+
+
+def iterObjectItems(chunks: Iterable[bytes]) -> Iterator[Tuple[str, Any]]:
+    """ Incrementally parse a JSON object, yielding its top level (key, value) pairs as soon as each is complete.
+
+    Only one value is held in memory at a time, so huge responses (e.g. api/get_annotations) can be
+    processed with constant memory as they stream in.
+
+    Args:
+        chunks (Iterable[bytes]): the JSON document in pieces, e.g. from Response.iter_content()
+
+    Yields:
+        Tuple[str, Any]: key and decoded value
+
+    Example:
+        >>> list(iterObjectItems([b'{"a": {"x": 1', b'}, "b": 2}']))
+        [('a', {'x': 1}), ('b', 2)]
+    """
+    decoder = json.JSONDecoder()
+    buffer = _Buffer(chunks)
+
+    def decode():
+        # decode one value, reading more input until it is complete. A value must be followed by
+        # another character (or the end of input) so that numbers split across chunks aren't cut short
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer.text, buffer.pos)
+                if end < len(buffer.text) or buffer.eof:
+                    buffer.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if buffer.eof:
+                    raise
+            buffer.more()
+
+    buffer.expect("{")
+    if buffer.peek() == "}":
+        return
+
+    while True:
+        buffer.skipWhitespace()
+        key = decode()
+        buffer.expect(":")
+        buffer.skipWhitespace()
+        value = decode()
+        yield key, value
+
+        separator = buffer.peek()
+        buffer.pos += 1
+        if separator == "}":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or '}}' in JSON input, found '{separator}'")
@@ -1,15 +1,41 @@
+import io
 import math
 from typing import List, Union
 import numpy as np
 from warnings import warn
 from . import models
+from .spatial import AnnotationIndex, mercatorBounds, overlaps
 from PIL import Image, ImageDraw
 from shapely.geometry import Polygon
 
+def _floatArray(values):
+    # tensors stay tensors (on their device), everything else becomes a float64 numpy array.
+    # the returned module has the functions used below under the same names for both
+    if type(values).__module__.split(".")[0] == "torch":
+        import torch
+        return torch, values if values.is_floating_point() else values.double()
+    return np, np.asarray(values, dtype=np.float64)
+
+
+def _zoomScale(xp, values, zoom):
+    # 2^zoom, as an array when zoom is one so it broadcasts against the coordinates
+    if isinstance(zoom, (int, float)):
+        return 2.0 ** zoom
+    if xp is np:
+        return np.exp2(np.asarray(zoom, dtype=np.float64))
+    return 2.0 ** xp.as_tensor(zoom, dtype=values.dtype, device=values.device)
+
+
+def _isScalar(values) -> bool:
+    return isinstance(values, (float, np.floating)) or (isinstance(values, np.ndarray) and values.ndim == 0)
+
+
 def deg2num(lat_deg: float, lon_deg:  float, zoom: int):
     """Convert lat,lng to xyz tile coordinates.
     reference: https://developers.planet.com/docs/planetschool/xyz-tiles-and-slippy-maps/
 
+    Accepts numpy arrays or torch tensors as well as floats, and broadcasts them with zoom.
+
     Args:
         lat_deg (float): latitude in decimal degrees
         lon_deg (float): longitude in decimal degrees
@@ -19,11 +45,14 @@ def deg2num(lat_deg: float, lon_deg:  float, zoom: int):
         x_tile (float): x in tile coordinates at specified zoom level
         y_tile (float): y in tile coordinates at specified zoom level
     """
-
-    lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    xtile = (lon_deg + 180.0) / 360.0 * n
-    ytile = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+    xp, lat = _floatArray(lat_deg)
+    _, lng = _floatArray(lon_deg)
+    n = _zoomScale(xp, lat, zoom)
+    # the usual formulas with the constants folded, to keep the number of array operations down
+    xtile = lng * (n / 360.0) + n / 2.0
+    ytile = n / 2.0 - xp.arcsinh(xp.tan(xp.deg2rad(lat))) * (n / (2.0 * math.pi))
+    if _isScalar(xtile) and _isScalar(ytile):
+        return float(xtile), float(ytile)
     return xtile, ytile
 
 
@@ -32,6 +61,8 @@ def num2deg(xtile: Union[float, int], ytile: Union[float, int], zoom: int):
     """convert x, y, tile coordinates to lat, lng. 
     ref: https://developers.planet.com/docs/planetschool/xyz-tiles-and-slippy-maps/
 
+    Accepts numpy arrays or torch tensors as well as numbers, and broadcasts them with zoom.
+
     Args:
         xtile (Union[float, int]): x position
         ytile (Union[float, int]): y position
@@ -41,14 +72,49 @@ def num2deg(xtile: Union[float, int], ytile: Union[float, int], zoom: int):
         lat_deg (float): latitude in decimal degrees
         lng_deg (float): longitude in decimal degrees
     """
-    n = 2.0 ** zoom
-    lng_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
+    xp, x = _floatArray(xtile)
+    _, y = _floatArray(ytile)
+    n = _zoomScale(xp, x, zoom)
+    lng_deg = x * (360.0 / n) - 180.0
+    lat_deg = xp.rad2deg(xp.arctan(xp.sinh(math.pi - y * (2.0 * math.pi / n))))
+    if _isScalar(lat_deg) and _isScalar(lng_deg):
+        return float(lat_deg), float(lng_deg)
     return lat_deg, lng_deg
 
 
 
+def lngLatToTile(coords, zoom):
+    """Convert [lng, lat] points to xyz tile coordinates, all at once.
+
+    Args:
+        coords (array like): [..., 2] points (lng, lat), a list, numpy array or torch tensor
+        zoom (Union[int, array like]): zoom level, or zoom levels broadcastable to coords[..., 0]
+
+    Returns:
+        array like: [..., 2] (x, y) in tile coordinates, a tensor for tensor input and numpy otherwise
+    """
+    xp, coords = _floatArray(coords)
+    x, y = deg2num(coords[..., 1], coords[..., 0], zoom)
+    return xp.stack([x, y], -1)
+
+
+
+def tileToLngLat(points, zoom):
+    """Convert xyz tile coordinates to [lng, lat] points, all at once.
+
+    Args:
+        points (array like): [..., 2] points (x, y) in tile coordinates, a list, numpy array or torch tensor
+        zoom (Union[int, array like]): zoom level, or zoom levels broadcastable to points[..., 0]
+
+    Returns:
+        array like: [..., 2] (lng, lat), a tensor for tensor input and numpy otherwise
+    """
+    xp, points = _floatArray(points)
+    lat, lng = num2deg(points[..., 0], points[..., 1], zoom)
+    return xp.stack([lng, lat], -1)
+
+
+
 def getBboxLatLng(coords: List[List]):
     """Get bounding box for a polygon.
 
@@ -94,14 +160,9 @@ def getBboxTileCoords(coords: List[List], zxy: str):
     x = int(zxy.split("/")[1])
     y = int(zxy.split("/")[2])
 
-    # get annotation bounding box in tile coordinates
-    x1, y1 = deg2num(y1, x1, z)
-    x2, y2 = deg2num(y2, x2, z)
-
-    x1 -= x
-    x2 -= x
-    y1 -= y
-    y2 -= y
+    # get annotation bounding box in tile coordinates, both corners at once
+    corners = lngLatToTile([[x1, y1], [x2, y2]], z) - [x, y]
+    (x1, y1), (x2, y2) = corners.tolist()
 
     return x1, y1, x2, y2
 
@@ -131,33 +192,53 @@ def getOverlap(coords: List[List], zxy: str):
     return (x_overlap*y_overlap) / annotation_area
 
 
+def getOverlaps(bounds: np.ndarray, zxy: Union[str, List[str]]) -> np.ndarray:
+    """ Get the portion of every annotation's bounding box that is inside a tile, or each of several tiles,
+    in one go. The bounding boxes only depend on the annotations, so compute them once with
+    projectkiwi.spatial.mercatorBounds and reuse them for every tile.
+
+    Args:
+        bounds (np.ndarray): [n, 4] bounding boxes from mercatorBounds(annotations)
+        zxy (Union[str, List[str]]): tile e.g. 12/345/678, or a list of tiles
+
+    Returns:
+        np.ndarray: [n] overlap [0,1] for a tile, [t, n] for a list of t tiles, the same values as getOverlap
+    """
+    if isinstance(zxy, str):
+        return overlaps(bounds, *splitZXY(zxy))
+    z, x, y = np.array([splitZXY(tile) for tile in zxy], dtype=np.int64).reshape(-1, 3).T
+    return overlaps(bounds, z, x, y)
+
+
 def getAnnotationsForTile(
-            annotations: List[models.Annotation],
+            annotations: Union[List[models.Annotation], "AnnotationIndex"],
             zxy: str,
-            overlap_threshold: float = 0.2
+            overlap_threshold: float = 0.2,
+            bounds: np.ndarray = None
         ) -> List[models.Annotation]:
         """ Filter a set of annotations for those that have overlap with some tile
 
         Args:
-            annotations (List[Annotation]): Annotations to filter
+            annotations (Union[List[Annotation], AnnotationIndex]): Annotations to filter, pass a projectkiwi.spatial.AnnotationIndex
+                to avoid checking every annotation when filtering for many tiles
             zxy (str): The tile e.g. 12/345/678
             overlap_threshold (float, optional): How much overlap. Defaults to 0.2.
+            bounds (np.ndarray, optional): mercatorBounds(annotations), to avoid recomputing them when filtering
+                the same annotations for many tiles. Defaults to None.
 
         Returns:
             List[Annotation]: All the annotations that have enough overlap with the specified tile
         """        
 
-        annotationsInTile = []
+        if isinstance(annotations, AnnotationIndex):
+            return annotations.query(zxy, overlap_threshold)
 
-        # filter annotations
-        for annotation in annotations:
-            # check overlap with tile
-            overlap = getOverlap(annotation.coordinates, zxy)
-            if overlap < overlap_threshold:
-                continue
-            annotationsInTile.append(annotation)
+        if bounds is None:
+            bounds = mercatorBounds(annotations)
+        assert len(bounds) == len(annotations), f"Expected bounds for {len(annotations)} annotations, got: {len(bounds)}"
 
-        return annotationsInTile
+        overlap = getOverlaps(bounds, zxy)
+        return [annotations[int(i)] for i in np.flatnonzero(overlap >= overlap_threshold)]
 
 def bboxFromCoords(coordinates: List[List], zxy: str, tile_size: int, clip: bool = False):
     """ Get a bounding box from a polygon (lng, lat)
@@ -262,25 +343,12 @@ def coordsFromPolygon(
 
     z,x,y = splitZXY(zxy)
 
-    points_lat_lng = []
-    for (x1,y1) in polygon:
-
-      x1 -= padding
-      y1 -= padding
-
-      # Normalise
-      x1 /= tile_size
-      y1 /= tile_size
-
-      # add task corner x,y
-      x1 += x
-      y1 += y
+    points = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
 
-      # convert to lat,lng
-      lat, lng = num2deg(x1, y1, z)
-      points_lat_lng.append([lng, lat])
+    # normalise and add the task corner x,y
+    points = (points - padding) / tile_size + [x, y]
 
-    return points_lat_lng
+    return tileToLngLat(points, z).tolist()
 
 def coordsFromBbox(
         x1: int, 
@@ -320,11 +388,7 @@ def coordsFromBbox(
         [x+x2, y+y2],
         [x+x1, y+y2],
         [x+x1, y+y1]]
-    points_lat_lng = []
-    for point in points:
-        lat, lng = num2deg(point[0], point[1], z)
-        points_lat_lng.append([lng, lat])
-    return points_lat_lng
+    return tileToLngLat(points, z).tolist()
 
 
 def latLngToImgCoords(coords: List[List], zxy: str, tile_size: int) -> List[List]:
@@ -341,20 +405,169 @@ def latLngToImgCoords(coords: List[List], zxy: str, tile_size: int) -> List[List
 
     tile_z, tile_x, tile_y = splitZXY(zxy)
 
-    coords_tile = []
-    # get annotation bounding box in tile coordinates
-    for (x, y) in coords:
-      x_prime, y_prime = deg2num(y, x, tile_z)
-      coords_tile.append([x_prime - tile_x, y_prime - tile_y])
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
 
-    coords_img = []
-    for (x,y) in coords_tile:
-      coords_img.append((int(x*tile_size), int(y*tile_size)))
+    # tile coordinates relative to the tile, then pixels (truncated like int())
+    coords_tile = lngLatToTile(coords, tile_z) - [tile_x, tile_y]
+    coords_img = (coords_tile*tile_size).astype(np.int64)
 
-    return coords_img
+    return [tuple(point) for point in coords_img.tolist()]
 
   
 
+class TileTransform():
+    """Convert between pixels in a tile and lng/lat, for many points at once.
+
+    Across a tile, x is an affine function of longitude and y an affine function of the mercator
+    y (asinh(tan(lat))), so the scale and offset of both are worked out once per tile and each
+    conversion is a few array operations over all the points, whichever polygon they belong to.
+
+    Args:
+        zxy (str): tile e.g. 12/345/678
+        tile_size (int): width of the tile in pixels, without padding
+        padding (int, optional): number of extra pixels around the edge of the tile. Defaults to 0.
+
+    Example:
+        >>> transform = TileTransform(task.zxy, 512, padding=32)
+        >>> lngLat = transform.toLngLat(pixels)
+    """
+
+    def __init__(self, zxy: str, tile_size: int, padding: int = 0):
+        z, x, y = splitZXY(zxy)
+        n = 2.0 ** z
+        # lng = px*lng_scale + lng_offset
+        self.lng_scale = 360.0 / (n * tile_size)
+        self.lng_offset = (x - padding / tile_size) * 360.0 / n - 180.0
+        # asinh(tan(lat)) = py*merc_scale + merc_offset
+        self.merc_scale = -2.0 * math.pi / (n * tile_size)
+        self.merc_offset = math.pi - (y - padding / tile_size) * 2.0 * math.pi / n
+
+
+    def toLngLat(self, pixels) -> np.ndarray:
+        """ pixels to lng/lat
+
+        Args:
+            pixels (array like): [..., 2] (x, y) pixels
+
+        Returns:
+            np.ndarray: [..., 2] (lng, lat)
+        """
+        pixels = np.asarray(pixels, dtype=np.float64)
+        lngLat = np.empty_like(pixels)
+        lngLat[..., 0] = pixels[..., 0] * self.lng_scale + self.lng_offset
+        lngLat[..., 1] = np.rad2deg(np.arctan(np.sinh(pixels[..., 1] * self.merc_scale + self.merc_offset)))
+        return lngLat
+
+
+    def toPixels(self, coords) -> np.ndarray:
+        """ lng/lat to pixels
+
+        Args:
+            coords (array like): [..., 2] (lng, lat)
+
+        Returns:
+            np.ndarray: [..., 2] (x, y) pixels, not rounded
+        """
+        coords = np.asarray(coords, dtype=np.float64)
+        pixels = np.empty_like(coords)
+        pixels[..., 0] = (coords[..., 0] - self.lng_offset) / self.lng_scale
+        pixels[..., 1] = (np.arcsinh(np.tan(np.deg2rad(coords[..., 1]))) - self.merc_offset) / self.merc_scale
+        return pixels
+
+
+
+def raggedFromPolygons(polygons: List[List[List[float]]]):
+    """ Flatten a list of polygons to one vertex array and the offset of each polygon
+
+    Args:
+        polygons (List[List[List[float]]]): polygons e.g. [[[x,y],[x,y]], [[x,y],[x,y],[x,y]]]
+
+    Returns:
+        vertices (np.ndarray): [n_vertices, 2] every vertex
+        offsets (np.ndarray): [n + 1] start of each polygon in vertices, the last is n_vertices
+    """
+    offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    np.cumsum([len(polygon) for polygon in polygons], out=offsets[1:])
+    vertices = np.array([point for polygon in polygons for point in polygon], dtype=np.float64).reshape(-1, 2)
+    return vertices, offsets
+
+
+def splitRagged(values: list, offsets: np.ndarray) -> List[list]:
+    """ Split a flat list into one list per polygon
+
+    Args:
+        values (list): one item per vertex
+        offsets (np.ndarray): [n + 1] start of each polygon
+
+    Returns:
+        List[list]: n lists
+    """
+    offsets = offsets.tolist()
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def raggedBounds(vertices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """ Bounding box of every polygon in a flat vertex array
+
+    Args:
+        vertices (np.ndarray): [n_vertices, 2] every vertex
+        offsets (np.ndarray): [n + 1] start of each polygon
+
+    Returns:
+        np.ndarray: [n, 4] min x, min y, max x, max y, NaN for polygons without vertices
+    """
+    bounds = np.full((len(offsets) - 1, 4), np.nan)
+    starts = np.asarray(offsets[:-1])
+    nonEmpty = np.asarray(offsets[1:]) > starts
+    if nonEmpty.any():
+        bounds[nonEmpty, :2] = np.minimum.reduceat(vertices, starts[nonEmpty], axis=0)
+        bounds[nonEmpty, 2:] = np.maximum.reduceat(vertices, starts[nonEmpty], axis=0)
+    return bounds
+
+
+def coordsFromPolygons(
+        vertices: np.ndarray,
+        offsets: np.ndarray,
+        zxy: str,
+        tile_size: int,
+        padding: int = 0) -> List[List[List[float]]]:
+    """ coordsFromPolygon for every polygon in a tile at once
+
+    Args:
+        vertices (np.ndarray): [n_vertices, 2] (x, y) pixels of every polygon, see raggedFromPolygons
+        offsets (np.ndarray): [n + 1] start of each polygon in vertices
+        zxy (str): zxy string for the tile e.g. 12/34/567
+        tile_size (int): width of the tile
+        padding (int, optional): number of extra pixels around the edge of the tile. Defaults to 0.
+
+    Returns:
+        List[List[List[float]]]: coordinates of each polygon in [[lng,lat],[lng,lat]] format
+    """
+    lngLat = TileTransform(zxy, tile_size, padding).toLngLat(vertices)
+    return splitRagged(lngLat.tolist(), offsets)
+
+
+def latLngsToImgCoords(
+        vertices: np.ndarray,
+        offsets: np.ndarray,
+        zxy: str,
+        tile_size: int) -> List[List[tuple]]:
+    """ latLngToImgCoords for every polygon in a tile at once
+
+    Args:
+        vertices (np.ndarray): [n_vertices, 2] (lng, lat) of every polygon, e.g. AnnotationTable.vertices
+        offsets (np.ndarray): [n + 1] start of each polygon in vertices
+        zxy (str): tile zxy string e.g. 12/34/567
+        tile_size (int): width of the tile e.g. 256 - dont forget padding
+
+    Returns:
+        List[List[tuple]]: (x, y) pixels of each polygon, truncated to ints
+    """
+    pixels = TileTransform(zxy, tile_size).toPixels(vertices).astype(np.int64)
+    return splitRagged([tuple(point) for point in pixels.tolist()], offsets)
+
+
+
 def splitZXY(zxy: str):
     """ Split an zxy string up in to z,x,y component
 
@@ -382,6 +595,31 @@ def splitZXY(zxy: str):
     return z, x, y
 
 
+def superTileChildren(z: int, x: int, y: int, max_zoom: int, padding: int = 0) -> List[tuple]:
+    """ The tiles at max_zoom needed to assemble a super tile, its children plus a ring of
+    neighbours wide enough for the padding, clipped to the world
+
+    Args:
+        z (int): zoom of the super tile
+        x (int): x of the super tile
+        y (int): y of the super tile
+        max_zoom (int): zoom of the child tiles
+        padding (int, optional): pixels read on each side of the super tile. Defaults to 0.
+
+    Returns:
+        List[tuple]: (z, x, y) of each tile, row by row
+    """
+    assert max_zoom >= z, f"max_zoom must be at least the tile zoom, got: {max_zoom} < {z}"
+    n = 2**(max_zoom - z)
+    x0 = x*n
+    y0 = y*n
+    ring = -(-padding // 256)
+    last = 2**max_zoom - 1
+    return [(max_zoom, cx, cy)
+            for cy in range(max(0, y0 - ring), min(last, y0 + n - 1 + ring) + 1)
+            for cx in range(max(0, x0 - ring), min(last, x0 + n - 1 + ring) + 1)]
+
+
 def urlFromZxy(z: int, x: int, y: int, imagery_id: str, baseUrl: str, serverless: bool = True) -> str:
     """Generate a url given a zxy and an imagery id
 
@@ -402,6 +640,78 @@ def urlFromZxy(z: int, x: int, y: int, imagery_id: str, baseUrl: str, serverless
         return f"{baseUrl}/api/get_tile/{imagery_id}/{z}/{x}/{y}"
 
 
+def decodeTile(content: bytes,
+        out: np.ndarray = None,
+        drop_alpha: bool = False,
+        target_size: int = None) -> np.ndarray:
+    """ Decode an encoded tile image (e.g. png) to a numpy array
+
+    Args:
+        content (bytes): encoded image
+        out (np.ndarray, optional): preallocated uint8 array to copy the result into, must have its shape.
+            Pillow always decodes into its own buffer, so this saves the caller an allocation
+            (e.g. filling a slice of a batch), not the decode's. Defaults to None.
+        drop_alpha (bool, optional): drop the alpha channel while decoding, RGBA becomes RGB. Defaults to False.
+        target_size (int, optional): width/height to decode to. Jpegs are decoded at reduced resolution
+            directly (draft mode), other formats are reduced by an integer factor before any resize. Defaults to None.
+
+    Returns:
+        np.ndarray: the decoded image [h, w, c], this is out if given
+    """
+    im = Image.open(io.BytesIO(content))
+
+    if target_size is not None and im.size != (target_size, target_size):
+        if im.format == "JPEG":
+            im.draft(im.mode, (target_size, target_size))
+        factor = min(im.size) // target_size
+        if factor > 1:
+            im = im.reduce(factor)
+        if im.size != (target_size, target_size):
+            im = im.resize((target_size, target_size), Image.BOX)
+
+    if drop_alpha and im.mode in ("RGBA", "LA"):
+        im = im.convert(im.mode[:-1])
+
+    if out is None:
+        return np.asarray(im)
+    # Pillow can't decode into external memory, this is one copy out of its buffer
+    np.copyto(out, np.asarray(im), casting="no")
+    return out
+
+
+def dropAlpha(tile: np.ndarray) -> np.ndarray:
+    """ Drop the alpha channel of a decoded tile, if it has one
+
+    Args:
+        tile (np.ndarray): tile [h, w, c]
+
+    Returns:
+        np.ndarray: tile without alpha, RGBA becomes RGB and LA becomes L
+    """
+    if tile.ndim == 3 and tile.shape[2] == 4:
+        return tile[:,:,:3]
+    if tile.ndim == 3 and tile.shape[2] == 2:
+        return tile[:,:,0]
+    return tile
+
+
+def randomLabelColor() -> str:
+    """ Pick a random, saturated color for a label
+
+    Returns:
+        str: color string e.g. rgb(0, 100, 256)
+    """
+    rgb = list(np.random.choice(range(256), size=3))
+    min_rgb = np.array(rgb).min()
+    max_rgb = np.array(rgb).max()
+    for i,c in enumerate(rgb):
+        if c == min_rgb:
+            rgb[i] = 0
+        if c == max_rgb:
+            rgb[i] = 256
+    return f"rgb({rgb[0]}, {rgb[1]}, {rgb[2]})"
+
+
 def maskFromPolygon(polygon: List[List], width: int, height: int) -> np.ndarray:
     """generates a binary mask from a polygon in image coordinates
 
@@ -0,0 +1,382 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from pydantic import BaseModel
+
+from projectkiwi.models import Annotation
+
+
+# seconds presigned part urls are assumed to be valid for, unless the server says otherwise
+PRESIGNED_URL_LIFETIME = 3600
+
+
+class PartialUploadError(Exception):
+    """Raised by Connector.addPredictions when only some of the predictions were added.
+
+    Args:
+        annotation_ids (List[Optional[int]]): id of each prediction that was added, None for the rest.
+        error (Exception): what stopped the upload.
+    """
+
+    def __init__(self, annotation_ids: List[Optional[int]], error: Exception):
+        super().__init__(f"Added {sum(i is not None for i in annotation_ids)} of {len(annotation_ids)} predictions: {error}")
+        self.annotation_ids = annotation_ids
+        self.error = error
+
+
+
+class UploadSummary(BaseModel):
+    uploaded: int
+    failed: int
+    errors: List[str]
+
+
+
+class PredictionUploader():
+    """Upload predictions in the background with a fixed pool of workers.
+
+    Predictions are queued with add(), which blocks when the queue is full so a fast
+    producer can't run away from the network. Workers group queued predictions into
+    batches for Connector.addPredictions. Batches aren't retried here: the connector's
+    session already retries what is safe to send again, and re-sending a batch the server
+    partly added would duplicate predictions. Call flush() at the end to wait for everything
+    to be uploaded.
+
+    Args:
+        conn (Connector): A connection object from projectkiwi.connector.
+        project_id (str): Id of the project to add the predictions to.
+        num_workers (int, optional): Number of upload threads. Defaults to 4.
+        batch_size (int, optional): Maximum number of predictions per request. Defaults to 50.
+        max_queue (int, optional): Maximum number of predictions waiting to be uploaded. Defaults to 1000.
+        batch_timeout (float, optional): Seconds to wait for a batch to fill before sending it. Defaults to 0.2.
+
+    Example:
+        >>> with PredictionUploader(conn, project_id) as uploader:
+        ...     for prediction in predictions:
+        ...         uploader.add(prediction)
+        >>> print(uploader.summary())
+        uploaded=120 failed=0 errors=[]
+    """
+
+    _stop = object()
+
+    def __init__(self,
+            conn,
+            project_id: str,
+            num_workers: int = 4,
+            batch_size: int = 50,
+            max_queue: int = 1000,
+            batch_timeout: float = 0.2):
+
+        self.conn = conn
+        self.project_id = project_id
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+        self.uploaded = 0
+        self.failed = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+
+    def add(self, prediction: Annotation):
+        """ queue a prediction for upload, blocks while the queue is full
+
+        Args:
+            prediction (Annotation): an annotation object with a confidence value
+        """
+        assert not self._closed, "Uploader has already been flushed"
+        assert not prediction.confidence is None, "No confidence for prediction"
+        self._queue.put(prediction)
+
+
+    def flush(self) -> UploadSummary:
+        """ wait for all queued predictions to be uploaded and stop the workers
+
+        Returns:
+            UploadSummary: number of uploaded and failed predictions
+        """
+        if not self._closed:
+            self._closed = True
+            for _ in self._workers:
+                self._queue.put(self._stop)
+            for worker in self._workers:
+                worker.join()
+        return self.summary()
+
+
+    def summary(self) -> UploadSummary:
+        """ counts so far
+
+        Returns:
+            UploadSummary: number of uploaded and failed predictions
+        """
+        with self._lock:
+            return UploadSummary(uploaded=self.uploaded, failed=self.failed, errors=list(self.errors))
+
+
+    def _work(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._stop:
+                break
+            batch = [item]
+
+            # fill the batch from whatever arrives shortly
+            deadline = time.monotonic() + self.batch_timeout
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is self._stop:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._upload(batch)
+
+
+    def _upload(self, batch: List[Annotation]):
+        try:
+            self.conn.addPredictions(batch, self.project_id)
+        except PartialUploadError as e:
+            added = sum(i is not None for i in e.annotation_ids)
+            with self._lock:
+                self.uploaded += added
+                self.failed += len(batch) - added
+                self.errors.append(str(e.error))
+            return
+        except Exception as e:
+            with self._lock:
+                self.failed += len(batch)
+                self.errors.append(str(e))
+            return
+        with self._lock:
+            self.uploaded += len(batch)
+
+
+
+class UploadProgress(BaseModel):
+    bytes_sent: int
+    total_bytes: int
+    parts_done: int
+    total_parts: int
+    elapsed: float
+    throughput: float
+
+
+
+class FileSlice():
+    """A read-only file-like view of part of a file, so a part can be streamed instead of read into memory.
+
+    Args:
+        filename (str): Path to the file.
+        offset (int): start of the slice in bytes.
+        size (int): length of the slice in bytes.
+    """
+
+    def __init__(self, filename: str, offset: int, size: int):
+        self.offset = offset
+        self.size = size
+        self._file = open(filename, "rb")
+        self._file.seek(offset)
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def read(self, n: int = -1) -> bytes:
+        remaining = self.size - self._position
+        if n is None or n < 0 or n > remaining:
+            n = remaining
+        data = self._file.read(n)
+        self._position += len(data)
+        return data
+
+    def seek(self, position: int, whence: int = 0) -> int:
+        if whence == 1:
+            position += self._position
+        elif whence == 2:
+            position += self.size
+        self._position = max(0, min(self.size, position))
+        self._file.seek(self.offset + self._position)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        self._file.close()
+
+
+
+class MultipartUpload():
+    """Upload a large file to a set of presigned part urls in parallel, resumably.
+
+    Each part is streamed from the file on its own and recorded in a state file as soon as it
+    succeeds. If the upload is interrupted, running it again with the same state file only uploads
+    the parts that are missing. Failed requests are retried by the connector's session; a part
+    rejected with 403 (its url expired) gets new urls from refresh_urls and is tried once more.
+
+    Args:
+        conn (Connector): A connection object from projectkiwi.connector, used for its session.
+        filename (str): Path to the file to upload.
+        urls (List[str]): presigned url for each part, in order.
+        part_size (int): size of every part but the last, in bytes.
+        state_file (str): where to record finished parts.
+        max_workers (int, optional): Number of parts uploaded at once. Defaults to 4.
+        progress (Callable, optional): called with an UploadProgress after each part. Defaults to None.
+        refresh_urls (Callable, optional): given part numbers (starting at 1) returns new urls for them, in order. Defaults to None.
+    """
+
+    def __init__(self,
+            conn,
+            filename: str,
+            urls: List[str],
+            part_size: int,
+            state_file: str,
+            max_workers: int = 4,
+            progress: Callable = None,
+            refresh_urls: Callable = None):
+
+        self.conn = conn
+        self.filename = filename
+        self.urls = list(urls)
+        self.part_size = part_size
+        self.state_file = state_file
+        self.max_workers = max_workers
+        self.progress = progress
+        self.refresh_urls = refresh_urls
+
+        self.total_bytes = os.path.getsize(filename)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.etags = loadUploadState(state_file).get('etags', {})
+
+
+    def _partSize(self, part: int) -> int:
+        return min(self.part_size, self.total_bytes - part*self.part_size)
+
+
+    def run(self) -> List[dict]:
+        """ upload every part that isn't already done
+
+        Returns:
+            List[dict]: part_number (starting at 1) and etag for every part, as needed to complete the upload
+        """
+        todo = [part for part in range(len(self.urls)) if str(part + 1) not in self.etags]
+        self.bytes_sent = sum(self._partSize(int(part) - 1) for part in self.etags)
+        self.start = time.monotonic()
+        self.bytes_at_start = self.bytes_sent
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for future in [executor.submit(self._uploadPart, part) for part in todo]:
+                future.result()
+
+        return [{'part_number': part + 1, 'etag': self.etags[str(part + 1)]} for part in range(len(self.urls))]
+
+
+    def _put(self, part: int, url: str):
+        with FileSlice(self.filename, part*self.part_size, self._partSize(part)) as data:
+            return self.conn._request("PUT", "upload", url=url, data=data, headers={'Content-type': ''})
+
+
+    def _refresh(self, part: int, stale_url: str):
+        # new urls for every unfinished part at once, unless another part already got them
+        with self._refresh_lock:
+            if self.urls[part] != stale_url:
+                return
+            # refresh_urls saves the state file too, so hold off recording finished parts meanwhile
+            with self._lock:
+                todo = [p for p in range(len(self.urls)) if str(p + 1) not in self.etags]
+                for p, url in zip(todo, self.refresh_urls([p + 1 for p in todo])):
+                    self.urls[p] = url
+
+
+    def _uploadPart(self, part: int):
+        url = self.urls[part]
+        r = self._put(part, url)
+        if r.status_code == 403 and self.refresh_urls is not None:
+            self._refresh(part, url)
+            r = self._put(part, self.urls[part])
+        r.raise_for_status()
+
+        with self._lock:
+            self.etags[str(part + 1)] = r.headers.get('ETag', "")
+            saveUploadState(self.state_file, {'etags': self.etags})
+            self.bytes_sent += self._partSize(part)
+            if self.progress is not None:
+                self.progress(self.report())
+
+
+    def report(self) -> UploadProgress:
+        """ progress so far, throughput only counts bytes sent by this run
+
+        Returns:
+            UploadProgress: progress
+        """
+        elapsed = time.monotonic() - self.start
+        return UploadProgress(
+            bytes_sent=self.bytes_sent,
+            total_bytes=self.total_bytes,
+            parts_done=len(self.etags),
+            total_parts=len(self.urls),
+            elapsed=elapsed,
+            throughput=(self.bytes_sent - self.bytes_at_start) / elapsed if elapsed > 0 else 0.0)
+
+
+
+def loadUploadState(state_file: str) -> dict:
+    """ read an upload state file
+
+    Args:
+        state_file (str): path to the state file
+
+    Returns:
+        dict: the state, empty if there is no state file
+    """
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def saveUploadState(state_file: str, update: dict):
+    """ update an upload state file atomically
+
+    Args:
+        state_file (str): path to the state file
+        update (dict): keys to set
+    """
+    state = loadUploadState(state_file)
+    state.update(update)
+    tmp = f"{state_file}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, state_file)
@@ -27,6 +27,9 @@ setup(
     'torchvision',
     'scikit-image'
   ],
+  extras_require={
+    'async': ['aiohttp'],
+  },
   classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
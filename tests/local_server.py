@@ -0,0 +1,108 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class LocalServer():
+    """ Stand-in http server for tests that shouldn't touch projectkiwi.io
+
+    Routes are registered as functions taking (handler, query, body) and returning
+    (status, headers, body), a path ending in * matches any path with that prefix.
+    Every request is recorded in `requests`.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.connections = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def handle_any(self):
+                parsed = urlparse(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b""
+                server.requests.append((self.command, parsed.path, body))
+                server.connections.add(self.client_address)
+                query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                route = server.routes.get((self.command, parsed.path.strip("/")))
+                if route is None:
+                    # fall back to prefix routes e.g. "get_tile/*"
+                    for (method, path), fn in server.routes.items():
+                        if method == self.command and path.endswith("*") and \
+                                parsed.path.strip("/").startswith(path[:-1]):
+                            route = fn
+                            break
+                if route is None:
+                    status, headers, content = 404, {}, b"not found"
+                else:
+                    status, headers, content = route(self, query, body)
+                if isinstance(content, (dict, list)):
+                    content = json.dumps(content).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_any
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def route(self, method, path):
+        def register(fn):
+            self.routes[(method, path)] = fn
+            return fn
+        return register
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def pngBytes(array) -> bytes:
+    """ encode a numpy array as png
+    """
+    import io
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def serveTiles(server, tiles, fail=()):
+    """ serve tiles from a dict of {(z, x, y): array} on get_tile/<imagery_id>/z/x/y
+
+    tiles in fail return a 404, missing tiles are blank.
+    """
+    @server.route("GET", "get_tile/*")
+    def getTile(handler, query, body):
+        z, x, y = [int(v) for v in handler.path.split("?")[0].strip("/").split("/")[-3:]]
+        if (z, x, y) in fail:
+            return 404, {}, b""
+        tile = tiles.get((z, x, y))
+        if tile is None:
+            import numpy as np
+            tile = np.zeros((256, 256, 3), dtype=np.uint8)
+        return 200, {}, pngBytes(tile)
+
+
+def localTileUrl(server):
+    """ replacement for projectkiwi.tools.urlFromZxy pointing at a local server
+    """
+    def urlFromZxy(z, x, y, imagery_id, baseUrl, serverless=True):
+        return f"{server.url}get_tile/{imagery_id}/{z}/{x}/{y}"
+    return urlFromZxy
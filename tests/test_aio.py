@@ -0,0 +1,58 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import asyncio
+import numpy as np
+import projectkiwi.aio
+from projectkiwi.aio import AsyncConnector
+
+from local_server import LocalServer, pngBytes
+
+
+def test_async_tiles(monkeypatch):
+    tile = np.full((256, 256, 3), 7, dtype=np.uint8)
+
+    with LocalServer() as server:
+        monkeypatch.setattr(projectkiwi.aio, "urlFromZxy",
+            lambda z, x, y, imagery_id, baseUrl: f"{server.url}get_tile/{imagery_id}/{z}/{x}/{y}")
+
+        for x in range(8):
+            server.route("GET", f"get_tile/abc/5/{x}/3")(lambda handler, query, body: (200, {}, pngBytes(tile)))
+
+        @server.route("GET", "api/get_imagery_status")
+        def status(handler, query, body):
+            return 200, {}, {'status': 'ready'}
+
+        async def run():
+            async with AsyncConnector("key", server.url, limit_per_host=2) as conn:
+                tiles = await asyncio.gather(*[conn.getTile("abc", 5, x, 3) for x in range(8)])
+                status = await conn.getImageryStatus("abc")
+            return tiles, status
+
+        tiles, status = asyncio.run(run())
+
+    assert status == "ready", "Failed to get status"
+    assert len(tiles) == 8, "Missing tiles"
+    assert all(np.array_equal(t, tile) for t in tiles), "Tiles decoded incorrectly"
+
+
+def test_async_post_not_retried():
+    import aiohttp
+
+    with LocalServer() as server:
+        calls = []
+
+        @server.route("POST", "api/add_label")
+        def addLabel(handler, query, body):
+            calls.append(body)
+            return 500, {}, b""
+
+        async def run():
+            async with AsyncConnector("key", server.url, backoff_factor=0.01) as conn:
+                try:
+                    await conn.addLabel("p1", "tree")
+                except aiohttp.ClientResponseError as e:
+                    return e.status
+
+        assert asyncio.run(run()) == 500, "Should raise the server error"
+        assert len(calls) == 1, "POST should not be retried after the server saw it"
@@ -0,0 +1,181 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import pickle
+import numpy as np
+import projectkiwi.connector
+from projectkiwi.connector import Connector
+from projectkiwi.cache import TileCache
+
+from local_server import LocalServer, pngBytes, serveTiles, localTileUrl
+from test_stream import annotationsPayload
+
+
+def test_annotation_mirror(tmp_path):
+    payload = {'version': 1, 'data': annotationsPayload(10)}
+    statuses = []
+
+    with LocalServer() as server:
+
+        @server.route("GET", "api/get_annotations")
+        def getAnnotations(handler, query, body):
+            etag = f'"v{payload["version"]}"'
+            if handler.headers.get('If-None-Match') == etag:
+                statuses.append(304)
+                return 304, {'ETag': etag}, b""
+            statuses.append(200)
+            return 200, {'ETag': etag}, payload['data']
+
+        conn = Connector("key", server.url, annotation_cache=tmp_path)
+        first = conn.getAnnotations("project")
+        second = conn.getAnnotations("project")
+        assert statuses == [200, 304], "Annotations were not revalidated"
+        assert first[0] is second[0], "Annotations were parsed again"
+
+        # a new connector revalidates from disk
+        conn = Connector("key", server.url, annotation_cache=tmp_path)
+        assert len(conn.getAnnotations("project")) == 10, "Failed to read mirror"
+        assert statuses[-1] == 304, "Mirror not reused"
+
+        payload['version'] = 2
+        payload['data'] = annotationsPayload(12)
+        assert len(conn.getAnnotations("project")) == 12, "Changed annotations not downloaded"
+        assert len(conn.getPredictions("project")) == 4, "Wrong predictions"
+
+
+def test_annotation_mirror_hash_fallback(tmp_path):
+    with LocalServer() as server:
+
+        @server.route("GET", "api/get_annotations")
+        def getAnnotations(handler, query, body):
+            return 200, {}, annotationsPayload(5)
+
+        conn = Connector("key", server.url, annotation_cache=tmp_path)
+        first = conn.getAnnotations("project")
+        second = conn.getAnnotations("project")
+        assert first[0] is second[0], "Unchanged payload was parsed again"
+
+
+def test_metadata_cache():
+    labels = [{'id': 1, 'project_id': "project", 'color': "rgb(0, 0, 0)", 'name': "tree", 'status': "active"}]
+
+    with LocalServer() as server:
+
+        @server.route("GET", "api/get_labels")
+        def getLabels(handler, query, body):
+            return 200, {}, labels
+
+        @server.route("POST", "api/add_label")
+        def addLabel(handler, query, body):
+            label = {'id': 2, 'project_id': "project", 'color': "rgb(0, 0, 0)", 'name': "car", 'status': "active"}
+            labels.append(label)
+            return 200, {}, label
+
+        @server.route("GET", "api/get_imagery")
+        def getImagery(handler, query, body):
+            return 200, {}, [{'id': "abc", 'project': "project", 'name': "layer", 'url': "https://tiles/{z}/{x}/{y}", 'attribution': ""}]
+
+        conn = Connector("key", server.url, metadata_ttl=60)
+        assert len(conn.getLabels("project")) == 1, "Missing label"
+        conn.getLabels("project").clear()
+        assert len(conn.getLabels("project")) == 1, "Cached list was modified"
+
+        conn.addLabel("car", "project")
+        assert len(conn.getLabels("project")) == 2, "Labels not invalidated after addLabel"
+
+        assert conn.getImageryUrl("abc", "project") == "https://tiles/{z}/{x}/{y}", "Wrong url"
+        assert conn.getImageryUrl("abc", "project") == "https://tiles/{z}/{x}/{y}", "Wrong url"
+
+        stats = conn.metadata_cache.stats()
+        assert stats['hits'] == 3, f"Wrong hit count: {stats}"
+
+        requests = [path for method, path, body in server.requests if method == "GET"]
+        assert requests.count("/api/get_labels") == 2, "Labels not cached"
+        assert requests.count("/api/get_imagery") == 1, "Imagery not cached"
+
+
+def test_tile_cache(tmp_path):
+    tiles = {x: np.full((256, 256, 3), x, dtype=np.uint8) for x in range(5)}
+    contents = {x: pngBytes(tile) for x, tile in tiles.items()}
+    disk_bytes = sum(len(contents[x]) for x in [2, 3, 4])
+    cache = TileCache(tmp_path, memory_bytes=2*256*256*3, disk_bytes=disk_bytes)
+
+    for x in range(5):
+        cache.put(("abc", 5, x, 3, 256, 0), contents[x], tiles[x])
+
+    # the last two fit in memory, the last three on disk
+    assert cache.get(("abc", 5, 4, 3, 256, 0))[0, 0, 0] == 4, "Wrong tile"
+    assert cache.stats()['memory_hits'] == 1, "Tile not in memory"
+    assert cache.get(("abc", 5, 2, 3, 256, 0))[0, 0, 0] == 2, "Wrong tile"
+    assert cache.stats()['disk_hits'] == 1, "Tile not on disk"
+    assert cache.get(("abc", 5, 0, 3, 256, 0)) is None, "Tile not evicted"
+    assert cache.stats()['disk_bytes'] <= disk_bytes, "Disk budget exceeded"
+    assert cache.stats()['hit_rate'] == 2/3, "Wrong hit rate"
+
+    # identical tiles are stored once
+    cache.clear()
+    cache.put(("abc", 5, 0, 0, 256, 0), contents[0])
+    cache.put(("abc", 5, 0, 1, 256, 0), contents[0])
+    assert cache.stats()['disk_bytes'] == len(contents[0]), "Tile content not deduplicated"
+
+    # a new process-like instance reads from disk
+    clone = pickle.loads(pickle.dumps(cache))
+    disk_hits = clone.stats()['disk_hits']
+    assert clone.get(("abc", 5, 0, 1, 256, 0))[0, 0, 0] == 0, "Failed to read from disk"
+    assert clone.stats()['disk_hits'] == disk_hits + 1, "Not a disk hit"
+
+
+def test_tile_cache_overwrite(tmp_path):
+    cache = TileCache(tmp_path, disk_bytes=250, eviction="lfu")
+    cache.put(("abc", 5, 0, 0, 256, 0), b"x"*100)
+    assert cache.getContent(("abc", 5, 0, 0, 256, 0)) == b"x"*100, "Tile not stored"
+
+    # storing a key again frees its old content and keeps its hits
+    cache.put(("abc", 5, 0, 0, 256, 0), b"y"*100)
+    assert cache.stats()['disk_bytes'] == 100, "Old content still counted"
+    assert len(list((tmp_path / "tiles" / "blobs").rglob("*.tile"))) == 1, "Old content left on disk"
+
+    cache.put(("abc", 5, 0, 1, 256, 0), b"z"*100)
+    assert cache.getContent(("abc", 5, 0, 0, 256, 0)) == b"y"*100, "Live tile evicted"
+    assert cache.getContent(("abc", 5, 0, 1, 256, 0)) == b"z"*100, "New tile evicted"
+
+    # the hit count survived the overwrite, so lfu evicts the other tile
+    cache.getContent(("abc", 5, 0, 1, 256, 0))
+    cache.put(("abc", 5, 0, 0, 256, 0), b"w"*100)
+    cache.put(("abc", 5, 0, 2, 256, 0), b"v"*100)
+    assert cache.getContent(("abc", 5, 0, 0, 256, 0)) == b"w"*100, "Hits lost on overwrite"
+    assert cache.stats()['disk_bytes'] <= 250, "Disk budget exceeded"
+
+
+def test_tile_cache_batched_hits(tmp_path, monkeypatch):
+    import projectkiwi.cache
+    monkeypatch.setattr(projectkiwi.cache, "ACCESS_FLUSH_READS", 3)
+    cache = TileCache(tmp_path, eviction="lfu")
+    cache.put(("abc", 5, 0, 0, 256, 0), b"x"*100)
+    db = cache._getDB()
+    hits = lambda: db.execute("SELECT hits FROM entries").fetchone()[0]
+
+    cache.getContent(("abc", 5, 0, 0, 256, 0))
+    cache.getContent(("abc", 5, 0, 0, 256, 0))
+    assert hits() == 0, "Reads written to the index one at a time"
+    cache.getContent(("abc", 5, 0, 0, 256, 0))
+    assert hits() == 3, "Reads not flushed after a batch"
+    cache.getContent(("abc", 5, 0, 0, 256, 0))
+    cache.flush()
+    assert hits() == 4, "Reads not flushed"
+
+
+def test_connector_tile_cache(tmp_path, monkeypatch):
+    tiles = {(5, x, 3): np.full((256, 256, 3), x, dtype=np.uint8) for x in range(4)}
+
+    with LocalServer() as server:
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        serveTiles(server, tiles)
+
+        conn = Connector("key", server.url, tile_cache=TileCache(tmp_path))
+        for _ in range(3):
+            for x in range(4):
+                assert conn.getTile("abc", 5, x, 3)[0, 0, 0] == x, "Wrong tile"
+
+        assert len(server.requests) == 4, "Tiles were downloaded again"
+        assert conn.tile_cache.stats()['hit_rate'] == 8/12, "Wrong hit rate"
@@ -0,0 +1,60 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import numpy as np
+import projectkiwi.connector
+from projectkiwi.connector import Connector
+from projectkiwi.metrics import HTTPMetrics
+
+from local_server import LocalServer, serveTiles, localTileUrl
+
+
+def test_metrics_by_route(monkeypatch):
+    with LocalServer() as server:
+        calls = []
+
+        @server.route("GET", "api/get_imagery_status")
+        def status(handler, query, body):
+            calls.append(query)
+            if len(calls) == 1:
+                return 503, {'Retry-After': '0'}, b""
+            return 200, {}, {'status': 'ready'}
+
+        serveTiles(server, {})
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+
+        events = []
+        conn = Connector("key", server.url, backoff_factor=0.01)
+        conn.metrics.addCallback(events.append)
+        conn.getImageryStatus("abc")
+        conn.getTile("abc", 18, 1, 2)
+
+        snapshot = conn.metrics.snapshot()
+        status = snapshot["api/get_imagery_status"]
+        assert status["requests"] == 2, "Both attempts should be recorded"
+        assert status["retries"] == 1, "Retry not counted"
+        assert status["statuses"] == {"GET 503": 1, "GET 200": 1}, "Wrong status counts"
+        assert status["bytes_in"] == len(b'{"status": "ready"}'), "Wrong bytes in"
+        assert status["latency_buckets"][float("inf")] == 2, "Histogram should count every attempt"
+
+        tile = snapshot["get_tile"]
+        assert tile["requests"] == 1 and tile["bytes_in"] > 0, "Tile request not recorded"
+        assert [event.route for event in events] == ["api/get_imagery_status"]*2 + ["get_tile"], "Wrong callback events"
+
+        text = conn.metrics.prometheus()
+        assert 'projectkiwi_http_requests_total{route="api/get_imagery_status",method="GET",status="503"} 1' in text, \
+            "Missing status counter"
+        assert 'projectkiwi_http_request_duration_seconds_count{route="get_tile"} 1' in text, "Missing histogram"
+        assert 'projectkiwi_http_retries_total{route="api/get_imagery_status"} 1' in text, "Missing retries"
+
+
+def test_metrics_bytes_out():
+    metrics = HTTPMetrics(buckets=(0.1, 1))
+    metrics.record("upload", "PUT", 200, 0.5, bytes_out=1000)
+    metrics.record("upload", "PUT", None, 2, bytes_out=1000, attempt=2)
+    stats = metrics.snapshot()["upload"]
+    assert stats["bytes_out"] == 2000, "Wrong bytes out"
+    assert stats["errors"] == 1, "Connection error not counted"
+    assert stats["latency_buckets"] == {0.1: 0, 1: 1, float("inf"): 2}, "Wrong histogram"
+    metrics.reset()
+    assert metrics.snapshot() == {}, "Reset should clear totals"
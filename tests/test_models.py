@@ -0,0 +1,97 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import pickle
+import numpy as np
+from projectkiwi.models import Annotation, AnnotationTable
+from projectkiwi.tools import getAnnotationsForTile
+
+from test_stream import annotationsPayload
+
+
+def makeAnnotations():
+    annotations = [Annotation.from_dict(data, int(i)) for i, data in annotationsPayload(5).items()]
+    annotations.append(Annotation(shape="Point", label_id=2, label_name="tree", coordinates=[[1.5, 2.5]]))
+    return annotations
+
+
+def test_annotation_table_round_trip():
+    annotations = makeAnnotations()
+    table = AnnotationTable.from_annotations(annotations)
+
+    assert len(table) == 6 and table.vertices.shape == (21, 2), "Wrong table size"
+    assert table.toList() == annotations, "Round trip changed the annotations"
+    assert table[5].coordinates.base is not None, "Coordinates should be a view"
+    assert table[-1].label_name == "tree" and table[-1].confidence is None and table[-1].id is None, "Wrong row"
+    assert table[0].geoJSON() == annotations[0].geoJSON(), "Wrong geoJSON"
+    assert list(table.isPrediction()) == [a.confidence is not None for a in annotations], "Wrong predictions"
+
+    subset = table[table.isPrediction()]
+    assert subset.toList() == [a for a in annotations if a.confidence is not None], "Wrong subset"
+    assert table[[5, 0]].toList() == [annotations[5], annotations[0]], "Wrong reordering"
+
+    bounds = table.bounds()
+    assert np.allclose(bounds[0], [-87.612448, 41.852301, -87.605238, 41.867452]), "Wrong bounds"
+    assert np.allclose(bounds[5], [1.5, 2.5, 1.5, 2.5]), "Wrong bounds for a point"
+
+    # the tile tools work on views as they do on annotations
+    inTile = getAnnotationsForTile(table, "12/1051/1522", overlap_threshold=0.5)
+    assert len(inTile) == 5, "Wrong annotations in tile"
+    assert [view.id for view in inTile] == [a.id for a in getAnnotationsForTile(annotations, "12/1051/1522", 0.5)], \
+        "Views should filter like annotations"
+
+
+def test_annotation_table_memmap(tmp_path):
+    annotations = makeAnnotations()
+    AnnotationTable.from_annotations(annotations).save(tmp_path / "table")
+    table = AnnotationTable.load(tmp_path / "table")
+
+    assert isinstance(table.vertices, np.memmap), "Table should be memory mapped"
+    assert table.toList() == annotations, "Saved table changed the annotations"
+
+    # memory mapped tables are pickled by reference
+    data = pickle.dumps(table)
+    assert len(data) < 500, "Pickle should not contain the arrays"
+    assert pickle.loads(data).toList() == annotations, "Unpickled table changed"
+
+    inMemory = AnnotationTable.load(tmp_path / "table", mmap_mode=None)
+    assert pickle.loads(pickle.dumps(inMemory)).toList() == annotations, "In memory table didn't pickle"
+
+
+def test_fast_construction(monkeypatch):
+    import pytest
+    import pydantic
+    import projectkiwi.models
+    from projectkiwi.models import Label, Task, Tile
+
+    payload = annotationsPayload(6)
+    payload["1003"]['coordinates'] = [["-87.6", "41.8"], [-87, 41]]
+    payload["1004"]['label_id'] = "12"
+    fast = Annotation.from_dicts_fast(payload)
+    assert fast == [Annotation.from_dict(data, int(i)) for i, data in payload.items()], "Fast annotations differ"
+    assert fast[3].coordinates == [[-87.6, 41.8], [-87.0, 41.0]] and fast[4].label_id == 12, "Fields not converted"
+    validated = Annotation.from_dict(payload["1000"], 1000)
+    assert repr(fast[0]) == repr(validated), "Fast annotation repr differs"
+    assert fast[0].dict() == validated.dict(), "Fast annotation dict differs"
+    assert fast[0].copy() == validated and fast[0].__fields_set__ == validated.__fields_set__, "Fast annotation state differs"
+
+    mixed = dict(payload["1000"], coordinates=[[-87.6, 41.8], [-87, 41], [-86.5, "40.5"]])
+    assert Annotation.from_dict_fast(mixed, 1000).coordinates == [[-87.6, 41.8], [-87.0, 41.0], [-86.5, 40.5]], "Later vertices not converted"
+    assert all(type(v) is float for point in Annotation.from_dict_fast(mixed, 1000).coordinates for v in point), "Ints left in coordinates"
+
+    tasks = [{'complete': "0", 'id': "4", 'imagery_id': "abc", 'queue': 3, 'zxy': "18/1/2", 'extra': 1}]
+    assert Task.from_dicts_fast(tasks) == [Task(**tasks[0])], "Fast tasks differ"
+    assert Task.from_dicts_fast(tasks)[0].complete is False, "Wrong bool"
+
+    tiles = [{'zxy': "18/1/2", 'url': "u"}]
+    assert Tile.from_dicts_fast(tiles, "abc") == [Tile.from_zxy("18/1/2", "abc", "u")], "Fast tiles differ"
+
+    labels = [{'id': "7", 'project_id': "p", 'color': "#fff", 'name': "tree", 'status': "active"}]
+    assert Label.from_dicts_fast(labels) == [Label(**labels[0])], "Fast labels differ"
+
+    # the debug flag brings validation back
+    bad = [{'complete': True, 'id': 1, 'queue': 3, 'zxy': "1/2/3", 'imagery_id': None}]
+    Task.from_dicts_fast(bad)
+    monkeypatch.setattr(projectkiwi.models, "VALIDATE", True)
+    with pytest.raises(pydantic.ValidationError):
+        Task.from_dicts_fast(bad)
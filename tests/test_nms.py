@@ -0,0 +1,89 @@
+import sys, os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+
+import numpy as np
+import torch
+
+from projectkiwi.data import nonMaximumSuppression
+from projectkiwi.nms import boxNMS, maskIoU, maskNMS, softNMS, suppressDetections
+from projectkiwi.tools import bbox_iou
+
+
+def randomDetections(n, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 200, (n, 2))
+    wh = rng.uniform(10, 60, (n, 2))
+    boxes = np.concatenate([xy, xy + wh], 1).astype(np.float32)
+    return boxes, rng.uniform(0, 1, n).astype(np.float32), rng.integers(1, 4, n)
+
+
+def greedyNMS(boxes, scores, class_ids, iou_threshold, class_aware):
+    keep = []
+    for i in np.argsort(-scores, kind="stable"):
+        if all(bbox_iou(boxes[i], boxes[j]) <= iou_threshold or (class_aware and class_ids[i] != class_ids[j]) for j in keep):
+            keep.append(i)
+    return keep
+
+
+def test_box_nms():
+    boxes, scores, class_ids = randomDetections(60)
+    for class_aware in [False, True]:
+        keep = boxNMS(torch.from_numpy(boxes), torch.from_numpy(scores), torch.from_numpy(class_ids), 0.3, class_aware)
+        assert keep.tolist() == greedyNMS(boxes, scores, class_ids, 0.3, class_aware), f"Wrong boxes kept, class_aware={class_aware}"
+
+    # the list wrapper keeps the original order and objects
+    masks = [np.full((1, 4, 4), i) for i in range(len(boxes))]
+    kept = nonMaximumSuppression(list(boxes), list(scores), list(class_ids), masks)
+    expected = sorted(greedyNMS(boxes, scores, class_ids, 0.3, False))
+    assert [int(mask[0, 0, 0]) for mask in kept[3]] == expected, "Wrong detections from the wrapper"
+    assert kept[0][0] is boxes[expected[0]] or np.array_equal(kept[0][0], boxes[expected[0]]), "Wrong box from the wrapper"
+    assert nonMaximumSuppression([], [], []) == ([], [], [], None), "Empty input should give empty output"
+
+    # a chain of boxes, the last only overlaps the suppressed middle one
+    chain = [[0, 0, 10, 10], [5, 0, 15, 10], [10, 0, 20, 10]]
+    assert nonMaximumSuppression(chain, [0.9, 0.8, 0.7], [1, 1, 1])[1] == [0.9, 0.7], "Greedy nms should keep the last box"
+    assert nonMaximumSuppression(chain, [0.9, 0.8, 0.7], [1, 1, 1], greedy=False)[1] == [0.9], "Old rule should drop the chain"
+    assert nonMaximumSuppression(chain, [0.9, 0.8, 0.7], [1, 2, 2], class_aware=True, greedy=False)[1] == [0.9, 0.8], "Old rule ignored classes"
+
+
+def test_soft_nms():
+    boxes = torch.tensor([[0, 0, 10, 10], [1, 0, 11, 10], [50, 50, 60, 60]], dtype=torch.float32)
+    scores = torch.tensor([0.9, 0.8, 0.7])
+
+    keep, newScores = softNMS(boxes, scores, score_threshold=0.01)
+    assert keep.tolist() == [0, 2, 1], "Overlapping box should be kept with a lower score"
+    iou = 9 / 11
+    assert np.allclose(newScores.numpy(), [0.9, 0.7, 0.8*np.exp(-iou**2/0.5)], atol=1e-6), "Wrong gaussian decay"
+
+    keep, _ = softNMS(boxes, scores, iou_threshold=0.5, linear=True, score_threshold=0.2)
+    assert keep.tolist() == [0, 2], "Decayed box below the threshold should be dropped"
+
+    keep, _ = softNMS(boxes, scores, torch.tensor([1, 2, 1]), class_aware=True, score_threshold=0.5)
+    assert sorted(keep.tolist()) == [0, 1, 2], "Boxes of other classes should not be decayed"
+
+
+def test_mask_nms():
+    masks = torch.zeros((3, 1, 20, 20))
+    masks[0, 0, :10, :10] = 1
+    masks[1, 0, :10, 1:10] = 0.9
+    masks[2, 0, 10:, 10:] = 1
+    scores = torch.tensor([0.5, 0.9, 0.8])
+
+    iou = maskIoU(masks)
+    assert np.allclose(iou.numpy(), [[1, 0.9, 0], [0.9, 1, 0], [0, 0, 1]]), "Wrong mask iou"
+    assert maskNMS(masks, scores).tolist() == [1, 2], "Wrong masks kept"
+    assert maskNMS(masks, scores, torch.tensor([1, 2, 1]), class_aware=True).tolist() == [1, 2, 0], \
+        "Masks of other classes should not be suppressed"
+
+    result = {
+        'boxes': torch.tensor([[0, 0, 10, 10], [1, 0, 10, 10], [10, 10, 20, 20], [0, 0, 2, 2]], dtype=torch.float32),
+        'scores': torch.tensor([0.5, 0.9, 0.8, 0.95]),
+        'labels': torch.tensor([1, 1, 1, 1]),
+        'masks': torch.cat([masks, torch.ones((1, 1, 20, 20))]),
+    }
+    for method in ["hard", "mask"]:
+        kept = suppressDetections(result, method=method)
+        # the tiny box is filtered out by size before nms
+        assert np.allclose(kept['scores'].numpy(), [0.9, 0.8]) and len(kept['masks']) == 2, f"Wrong detections for {method}"
+    assert len(suppressDetections(result, method="soft", score_threshold=0.05)['boxes']) == 3, "Soft nms should keep decayed boxes"
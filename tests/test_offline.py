@@ -0,0 +1,102 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import numpy as np
+import pytest
+import requests
+import projectkiwi.connector
+from projectkiwi.connector import Connector
+from projectkiwi.models import Annotation
+from projectkiwi.offline import OfflineConnector, SnapshotBundle
+
+from local_server import LocalServer, serveTiles, localTileUrl
+from test_stream import annotationsPayload
+
+
+def serveProject(server):
+    @server.route("GET", "api/get_projects")
+    def projects(handler, query, body):
+        return 200, {}, [{'name': "test", 'id': "p1", 'user_login': "me"}]
+
+    @server.route("GET", "api/get_imagery")
+    def imagery(handler, query, body):
+        return 200, {}, [{'id': "im1", 'project': "p1", 'name': "layer", 'url': "", 'attribution': ""}]
+
+    @server.route("GET", "api/get_labels")
+    def labels(handler, query, body):
+        return 200, {}, [{'id': 1, 'project_id': "p1", 'color': "#fff", 'name': "tree", 'status': "active"}]
+
+    @server.route("GET", "api/get_annotations")
+    def annotations(handler, query, body):
+        return 200, {}, annotationsPayload(6)
+
+    @server.route("GET", "api/get_tasks")
+    def tasks(handler, query, body):
+        return 200, {}, {'success': True, 'task': [
+            {'complete': False, 'id': 1, 'imagery_id': "im1", 'queue': 3, 'zxy': "16/10/20"},
+            {'complete': False, 'id': 2, 'imagery_id': "im1", 'queue': 3, 'zxy': "16/11/20"}]}
+
+    @server.route("GET", "api/get_imagery_status")
+    def status(handler, query, body):
+        return 200, {}, {'status': "ready"}
+
+    @server.route("GET", "api/get_tile_list")
+    def tileList(handler, query, body):
+        return 200, {}, [{'zxy': "17/20/40", 'url': ""}]
+
+
+def test_snapshot_and_replay(monkeypatch, tmp_path):
+    tiles = {(17, 20 + i % 4, 40 + i // 4): np.full((256, 256, 3), i, dtype=np.uint8) for i in range(8)}
+    bundlePath = tmp_path / "project.kiwi"
+
+    with LocalServer() as server:
+        serveProject(server)
+        serveTiles(server, tiles)
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+
+        conn = Connector("secret", server.url)
+        conn.snapshot(bundlePath, "p1", imagery_id="im1", queue_id=3, zoom=17)
+        tileRequests = [r for r in server.requests if "get_tile/" in r[1]]
+        assert len(tileRequests) == 8, "Should record the 4 children of each task"
+        expected = conn.getSuperTile("im1", "16/11/20", 17, mosaic=True)
+
+        # a second snapshot only refreshes the metadata
+        conn.snapshot(bundlePath, "p1", imagery_id="im1", queue_id=3, zoom=17)
+        assert len([r for r in server.requests if "get_tile/" in r[1]]) == 8 + 4, "Tiles downloaded again"
+        url = server.url
+
+    with open(bundlePath, "rb") as f:
+        assert b"secret" not in f.read(), "The api key shouldn't be stored"
+
+    # the server is gone, everything comes from the bundle
+    offline = OfflineConnector(bundlePath)
+    assert offline.url == url, "Wrong url"
+    assert offline.getProjects()[0].id == "p1", "Wrong projects"
+    assert offline.getImagery("p1")[0].id == "im1", "Wrong imagery"
+    assert offline.getLabels("p1")[0].name == "tree", "Wrong labels"
+    assert len(offline.getAnnotations("p1")) == 6, "Wrong annotations"
+    assert len(offline.getPredictions("p1")) == 2, "Wrong predictions"
+    assert [task.id for task in offline.getTasks(3)] == [1, 2], "Wrong tasks"
+    assert offline.getImageryStatus("im1") == "ready", "Wrong status"
+
+    tile = offline.getSuperTile("im1", "16/11/20", 17)
+    assert np.array_equal(tile, expected), "Wrong super tile"
+    assert np.array_equal(offline.getTile("im1", 17, 20, 40), tiles[(17, 20, 40)]), "Wrong tile"
+
+    with pytest.raises(requests.HTTPError):
+        offline.getTile("im1", 17, 0, 0)
+    with pytest.raises(requests.HTTPError):
+        offline.addAnnotation(Annotation(shape="Point", label_id=1, coordinates=[[0, 0]]), "p1")
+
+
+def test_snapshot_tile_list(monkeypatch, tmp_path):
+    with LocalServer() as server:
+        serveProject(server)
+        serveTiles(server, {})
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+
+        conn = Connector("key", server.url)
+        bundle = conn.snapshot(tmp_path / "project.kiwi", "p1", imagery_id="im1", zoom=17)
+        assert [r[1] for r in server.requests if "get_tile/" in r[1]] == ["/get_tile/im1/17/20/40"], \
+            "Without a queue every tile in the tile list should be recorded"
+        assert bundle.info()['zoom'] == 17, "Wrong bundle info"
@@ -0,0 +1,154 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import time
+import numpy as np
+import torch
+import projectkiwi.connector
+from projectkiwi.connector import Connector
+from projectkiwi.data import ProjectKiwiDataSet, TilePrefetcher
+from projectkiwi.models import Task
+
+from local_server import LocalServer, pngBytes, localTileUrl
+from test_stream import annotationsPayload
+
+
+def test_prefetcher(monkeypatch, tmp_path):
+    with LocalServer() as server:
+
+        @server.route("GET", "api/get_annotations")
+        def annotations(handler, query, body):
+            return 200, {}, annotationsPayload(3)
+
+        @server.route("GET", "get_tile/*")
+        def getTile(handler, query, body):
+            time.sleep(0.01)
+            x = int(handler.path.split("?")[0].split("/")[-2])
+            return 200, {}, pngBytes(np.full((256, 256, 3), x, dtype=np.uint8))
+
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        conn = Connector("key", server.url)
+        tasks = [Task(complete=True, id=i, imagery_id="im1", queue=1, zxy=f"16/{i}/7") for i in range(12)]
+        dataset = ProjectKiwiDataSet(conn, tasks, "p1", "im1", 16, tmp_path, inference=True)
+
+        sampler = TilePrefetcher(dataset, torch.utils.data.RandomSampler(dataset), lookahead=4, max_workers=4)
+        order = []
+        for idx in sampler:
+            assert dataset.taskTileFile(tasks[idx]).exists(), "Index yielded before its tile was cached"
+            order.append(idx)
+        assert sorted(order) == list(range(12)), "Every index should be yielded once"
+        assert sampler.stats()['yielded'] == 12 and sampler.stats()['failed'] == 0, "Wrong stats"
+
+        # the second epoch reads from the cache
+        downloads = len(server.requests)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=4, sampler=sampler, collate_fn=lambda b: tuple(zip(*b)))
+        for images, _, batch in loader:
+            for image, task in zip(images, batch):
+                assert round(float(image[0, 0, 0])*255) == task.id, "Wrong tile for task"
+        assert len(server.requests) == downloads, "Cached tiles downloaded again"
+        assert not list(tmp_path.rglob("*.tmp")), "Temporary files left behind"
+
+
+def test_prefetch_tile_cache(monkeypatch, tmp_path):
+    from projectkiwi.cache import TileCache
+
+    with LocalServer() as server:
+
+        @server.route("GET", "api/get_annotations")
+        def annotations(handler, query, body):
+            return 200, {}, annotationsPayload(3)
+
+        @server.route("GET", "get_tile/*")
+        def getTile(handler, query, body):
+            x = int(handler.path.split("?")[0].split("/")[-2])
+            return 200, {}, pngBytes(np.full((512, 512, 3), x, dtype=np.uint8))
+
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        tasks = [Task(complete=True, id=i, imagery_id="im1", queue=1, zxy=f"16/{i}/7") for i in range(4)]
+
+        # encoded tiles go to the disk tier only, the workers decode them
+        conn = Connector("key", server.url, tile_cache=TileCache(tmp_path / "tiles"))
+        dataset = ProjectKiwiDataSet(conn, tasks, "p1", "im1", 17, tmp_path, inference=True)
+        for task in tasks:
+            dataset.prefetchTaskTile(task)
+        assert conn.tile_cache.stats()['memory_bytes'] == 0, "Prefetched tiles decoded"
+        downloads = len(server.requests)
+        for i, task in enumerate(tasks):
+            image, _, _ = dataset[i]
+            assert round(float(image[0, 0, 0])*255) == task.id, "Wrong tile for task"
+        assert len(server.requests) == downloads, "Prefetched tiles downloaded again"
+
+        # a memory only cache can't be shared with workers, so nothing is prefetched
+        conn = Connector("key", server.url, tile_cache=TileCache())
+        dataset = ProjectKiwiDataSet(conn, tasks, "p1", "im1", 17, tmp_path, inference=True)
+        downloads = len(server.requests)
+        dataset.prefetchTaskTile(tasks[0])
+        assert len(server.requests) == downloads, "Prefetched into a memory only cache"
+
+
+def test_task_stream(monkeypatch):
+    from projectkiwi.data import TaskStream
+
+    with LocalServer() as server:
+        import threading
+        lock = threading.Lock()
+        inFlight = [0, 0]
+
+        @server.route("GET", "api/get_tasks")
+        def tasks(handler, query, body):
+            return 200, {}, {'success': True, 'task': [
+                {'complete': i % 4 == 0, 'id': i, 'imagery_id': "im1", 'queue': 3, 'zxy': f"16/{i}/7"} for i in range(12)]}
+
+        @server.route("GET", "get_tile/*")
+        def getTile(handler, query, body):
+            x = int(handler.path.split("?")[0].split("/")[-2])
+            if x == 5:
+                return 404, {}, b""
+            with lock:
+                inFlight[0] += 1
+                inFlight[1] = max(inFlight)
+            time.sleep(0.05)
+            with lock:
+                inFlight[0] -= 1
+            return 200, {}, pngBytes(np.full((256, 256, 4), x, dtype=np.uint8))
+
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        conn = Connector("key", server.url)
+
+        errors = []
+        stream = TaskStream(conn, 3, max_zoom=16, lookahead=4, on_error=lambda task, e: errors.append(task.id))
+        results = list(stream)
+
+        assert [task.id for task, _ in results] == [1, 2, 3, 6, 7, 9, 10, 11], "Wrong tasks or order"
+        assert all(tile.shape == (256, 256, 3) and tile[0, 0, 0] == task.id for task, tile in results), "Wrong tiles"
+        assert errors == [5], "Failed task not reported"
+        assert inFlight[1] > 1, "Tiles should be downloaded concurrently"
+
+
+def test_training_targets(monkeypatch, tmp_path):
+    from projectkiwi.tools import bboxFromCoords, deg2num, latLngToImgCoords, maskFromPolygon
+
+    with LocalServer() as server:
+
+        @server.route("GET", "api/get_annotations")
+        def annotations(handler, query, body):
+            return 200, {}, annotationsPayload(4)
+
+        @server.route("GET", "get_tile/*")
+        def getTile(handler, query, body):
+            return 200, {}, pngBytes(np.zeros((256, 256, 3), dtype=np.uint8))
+
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        conn = Connector("key", server.url)
+        x, y = deg2num(41.86, -87.609, 14)
+        task = Task(complete=True, id=1, imagery_id="im1", queue=1, zxy=f"14/{int(x)}/{int(y)}")
+        dataset = ProjectKiwiDataSet(conn, [task], "p1", "im1", 14, tmp_path)
+
+        _, target, _ = dataset[0]
+        coordinates = annotationsPayload(1)["1000"]['coordinates']
+        # the predictions are filtered out
+        assert target['boxes'].shape == (2, 4) and target['labels'].tolist() == [1, 1], "Wrong annotations in tile"
+        expected = bboxFromCoords(coordinates, task.zxy, 256)
+        assert np.allclose(target['boxes'][0].numpy(), expected, atol=1e-3), "Wrong box"
+        mask = maskFromPolygon(latLngToImgCoords(coordinates, task.zxy, 256), 256, 256)
+        assert (target['masks'][0].numpy() == mask).all(), "Wrong mask"
@@ -0,0 +1,50 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import numpy as np
+import projectkiwi.connector
+from projectkiwi.connector import Connector
+from projectkiwi.cache import TileCache
+from projectkiwi.pyramid import downsample2x
+
+from local_server import LocalServer, serveTiles, localTileUrl
+
+
+def test_downsample():
+    image = np.arange(16, dtype=np.uint8).reshape(4, 4)
+    assert downsample2x(image).tolist() == [[3, 5], [11, 13]], "Bad box filter"
+    assert downsample2x(image, "nearest").tolist() == [[0, 2], [8, 10]], "Bad nearest"
+    assert downsample2x(image, "max").tolist() == [[5, 7], [13, 15]], "Bad max"
+
+    rgb = np.full((512, 512, 3), 200, dtype=np.uint8)
+    assert downsample2x(rgb).shape == (256, 256, 3), "Wrong shape"
+    assert downsample2x(rgb)[0, 0, 0] == 200, "Overflow in box filter"
+
+
+def test_overviews(monkeypatch):
+    tiles = {}
+    for x in range(8, 12):
+        for y in range(4, 8):
+            tiles[(4, x, y)] = np.full((256, 256, 3), 4*(x - 8) + (y - 4), dtype=np.uint8)
+
+    with LocalServer() as server:
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        serveTiles(server, tiles)
+
+        conn = Connector("key", server.url, tile_cache=TileCache())
+        conn.enableOverviews("abc", max_zoom=4)
+
+        tile = conn.getTile("abc", 2, 2, 1)
+        assert tile.shape == (256, 256, 3), "Wrong shape"
+        assert tile[0, 0, 0] == 0 and tile[-1, -1, 0] == 15, "Wrong pixels"
+        assert len(server.requests) == 16, "Wrong number of downloads"
+
+        # the zoom 3 level is already derived, and zoom 4 tiles are cached
+        assert conn.getTile("abc", 3, 5, 3)[0, 0, 0] == 10, "Wrong intermediate tile"
+        assert conn.getTile("abc", 4, 11, 7)[0, 0, 0] == 15, "Wrong max zoom tile"
+        assert len(server.requests) == 16, "Tiles downloaded again"
+
+        # derived tiles are cached as standalone arrays under their own key
+        assert conn.tile_cache.get(("abc", 3, 5, 3, 256, 0)) is None, "Derived tile cached as the server's tile"
+        cached = conn.tile_cache.get(conn.overviews["abc"].cacheKey(3, 5, 3))
+        assert cached is not None and cached.base is None, "Cached tile should own its memory"
@@ -0,0 +1,163 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import pickle
+from projectkiwi.connector import Connector
+from projectkiwi.session import AdaptiveLimiter, Session, parseRetryAfter
+
+from local_server import LocalServer
+
+
+def test_retry_on_unavailable():
+    with LocalServer() as server:
+        calls = []
+
+        @server.route("GET", "api/get_imagery_status")
+        def status(handler, query, body):
+            calls.append(query)
+            if len(calls) < 3:
+                return 503, {'Retry-After': '0'}, b""
+            return 200, {}, {'status': 'ready'}
+
+        conn = Connector("key", server.url, backoff_factor=0.01)
+        assert conn.getImageryStatus("abc") == "ready", "Failed to retry"
+        assert len(calls) == 3, "Wrong number of attempts"
+
+
+def test_connections_reused():
+    with LocalServer() as server:
+
+        @server.route("GET", "api/get_imagery_status")
+        def status(handler, query, body):
+            return 200, {}, {'status': 'ready'}
+
+        conn = Connector("key", server.url)
+        for _ in range(5):
+            conn.getImageryStatus("abc")
+        assert len(server.connections) == 1, "Connections not kept alive"
+
+
+def test_session_pickle():
+    session = Session(pool_size=3)
+    session.session
+    clone = pickle.loads(pickle.dumps(session))
+    assert clone.pool_size == 3, "Lost settings"
+    assert clone._session is None, "Session should be rebuilt after unpickling"
+    assert parseRetryAfter("2") == 2, "Bad retry-after"
+    assert parseRetryAfter("soon") is None, "Bad retry-after"
+
+
+def test_adaptive_limit():
+    limiter = AdaptiveLimiter(initial_limit=4, max_limit=8)
+    for _ in range(40):
+        limiter.acquire("get_tile")
+        limiter.release("get_tile", 0.01, 200)
+    assert limiter.limits()["get_tile"]["limit"] == 8, "Limit should grow to max_limit"
+
+    limiter.acquire("get_tile")
+    limiter.release("get_tile", 0.01, 429)
+    assert limiter.limits()["get_tile"]["limit"] == 4, "Limit should halve on 429"
+    assert limiter.limits()["get_tile"]["in_flight"] == 0, "Slots not released"
+    assert "get_annotations" not in limiter.limits(), "Routes should be independent"
+
+
+def test_super_tiles_limited_separately(monkeypatch):
+    import numpy as np
+    import projectkiwi.connector
+    from local_server import pngBytes, localTileUrl
+
+    with LocalServer() as server:
+        @server.route("GET", "get_tile/*")
+        def getTile(handler, query, body):
+            size = int(query['tile_size'])
+            return 200, {}, pngBytes(np.zeros((size, size, 3), dtype=np.uint8))
+
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        conn = Connector("key", server.url)
+        for x in range(4):
+            conn.getTile("im1", 12, x, 7)
+        conn.getSuperTile("im1", "12/0/7", max_zoom=15)
+
+        # so a slow super tile doesn't count as congestion against the typical 256px tile
+        assert set(conn.session.limiter.limits()) == {"get_tile", "get_super_tile"}, "Super tiles should have their own limit"
+        snapshot = conn.metrics.snapshot()
+        assert snapshot["get_tile"]["requests"] == 4 and snapshot["get_super_tile"]["requests"] == 1, "Requests under the wrong route"
+
+
+def test_adaptive_concurrency_on_429():
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    with LocalServer() as server:
+        lock = threading.Lock()
+        active = [0]
+        calls = []
+
+        @server.route("GET", "api/get_imagery_status")
+        def status(handler, query, body):
+            with lock:
+                active[0] += 1
+                overloaded = active[0] > 2
+                calls.append(overloaded)
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            if overloaded:
+                return 429, {'Retry-After': '0'}, b""
+            return 200, {}, {'status': 'ready'}
+
+        conn = Connector("key", server.url, pool_size=16, backoff_factor=0.01, max_retries=20)
+        with ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(lambda i: conn.getImageryStatus(str(i)), range(60)))
+
+        assert all(result == "ready" for result in results), "Requests failed"
+        assert conn.session.limiter.limits()["api/get_imagery_status"]["limit"] <= 8, "Limit didn't back off"
+        assert sum(calls[-20:]) < 10, "Still overloading the server"
+
+
+def test_post_not_retried_after_server_error():
+    with LocalServer() as server:
+        calls = []
+
+        @server.route("POST", "api/add_label")
+        def addLabel(handler, query, body):
+            calls.append(body)
+            return 503, {}, b""
+
+        session = Session(backoff_factor=0.01)
+        r = session.request("POST", server.url + "api/add_label", data="{}")
+        assert r.status_code == 503 and len(calls) == 1, "POST should not be retried after the server saw it"
+
+        r = session.request("POST", server.url + "api/add_label", data="{}", idempotent=True)
+        assert len(calls) == 1 + 1 + session.max_retries, "Idempotent POST should be retried"
+
+    # nothing listening, so the request never reached a server
+    session = Session(max_retries=2, backoff_factor=0.01)
+    try:
+        session.request("POST", "http://127.0.0.1:1/api/add_label", data="{}")
+        assert False, "Should have raised"
+    except Exception:
+        pass
+    assert session.metrics.snapshot()["api/add_label"]["requests"] == 3, "POST should be retried on connect errors"
+
+
+def test_limiter_released_on_any_error():
+    import requests
+
+    session = Session(pool_size=2)
+    for _ in range(4):
+        try:
+            session.request("GET", "http://", route="broken")
+            assert False, "Should have raised"
+        except requests.exceptions.RequestException:
+            pass
+    assert session.limiter.limits()["broken"]["in_flight"] == 0, "Slots leaked by errors"
+
+    # as if this process had been forked from one where the condition was held
+    limiter = session.limiter
+    limiter.condition.acquire()
+    limiter._pid = -1
+    limiter.acquire("get_tile")
+    limiter.release("get_tile", 0.01, 200)
+    assert limiter.limits()["get_tile"]["in_flight"] == 0, "Condition not rebuilt after fork"
@@ -0,0 +1,69 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import random
+
+import numpy as np
+from projectkiwi.models import Annotation, AnnotationTable
+from projectkiwi.spatial import AnnotationIndex, mercatorBounds
+from projectkiwi.tools import deg2num, getAnnotationsForTile, getOverlap, getOverlaps
+
+
+def randomAnnotations(n, seed=0):
+    rng = random.Random(seed)
+    annotations = []
+    for i in range(n):
+        lng, lat = -87.7 + rng.random()*0.2, 41.8 + rng.random()*0.1
+        # mostly small, some huge
+        size = 0.05 if i % 50 == 0 else rng.random()*0.002
+        coordinates = [[lng, lat], [lng + size, lat], [lng + size, lat + size*0.7], [lng, lat]]
+        annotations.append(Annotation(shape="Polygon", label_id=1, coordinates=coordinates, id=i))
+    return annotations
+
+
+def test_index_matches_scan():
+    annotations = randomAnnotations(800)
+    index = AnnotationIndex(annotations)
+    table = AnnotationTable.from_annotations(annotations)
+    tableIndex = AnnotationIndex(table)
+
+    rng = random.Random(1)
+    for _ in range(40):
+        z = rng.choice([12, 14, 16, 17])
+        x, y = deg2num(41.8 + rng.random()*0.1, -87.7 + rng.random()*0.2, z)
+        zxy = f"{z}/{int(x)}/{int(y)}"
+        threshold = rng.choice([0.01, 0.2, 0.9])
+
+        expected = [a.id for a in getAnnotationsForTile(annotations, zxy, threshold)]
+        assert [a.id for a in getAnnotationsForTile(index, zxy, threshold)] == expected, f"Wrong annotations for {zxy}"
+        assert [a.id for a in tableIndex.query(zxy, threshold)] == expected, f"Wrong table annotations for {zxy}"
+
+    assert len(index.large) > 0, "Huge annotations should be kept separately"
+    assert len(index.query("0/0/0", 0)) == len(annotations), "A threshold of 0 should match everything"
+
+
+def test_index_empty():
+    index = AnnotationIndex([])
+    assert index.query("12/1051/1522") == [], "Empty index should match nothing"
+
+
+def test_batch_overlaps():
+    annotations = randomAnnotations(200)
+    bounds = mercatorBounds(annotations)
+    assert np.allclose(bounds, mercatorBounds(AnnotationTable.from_annotations(annotations))), "Table bounds should match"
+
+    tiles = []
+    for z in [12, 14, 16]:
+        x, y = deg2num(41.85, -87.6, z)
+        tiles += [f"{z}/{int(x) + dx}/{int(y) + dy}" for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+    overlap = getOverlaps(bounds, tiles)
+    assert overlap.shape == (len(tiles), len(annotations)), "Should be an overlap per tile and annotation"
+    for t, zxy in enumerate(tiles):
+        expected = [getOverlap(a.coordinates, zxy) for a in annotations]
+        assert np.allclose(overlap[t], expected, rtol=0, atol=1e-9), f"Wrong overlaps for {zxy}"
+        assert np.allclose(getOverlaps(bounds, zxy), expected, rtol=0, atol=1e-9), f"Wrong single tile overlaps for {zxy}"
+
+    zxy = tiles[4]
+    assert [a.id for a in getAnnotationsForTile(annotations, zxy, 0.5, bounds=bounds)] == \
+            [a.id for a in annotations if getOverlap(a.coordinates, zxy) >= 0.5], "Wrong annotations for tile"
@@ -0,0 +1,58 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import json
+import random
+from projectkiwi.connector import Connector
+from projectkiwi.stream import iterObjectItems
+
+from local_server import LocalServer
+
+
+def annotationsPayload(n):
+    annotations = {}
+    for i in range(n):
+        annotations[str(1000 + i)] = {
+            'shape': "Polygon",
+            'label_id': 374,
+            'label_name': "airport",
+            'label_color': "rgb(10, 184, 227)",
+            'coordinates': [[-87.612448, 41.867452], [-87.605238, 41.867452], [-87.605238, 41.852301], [-87.612448, 41.867452]],
+            'url': None,
+            'imagery_id': "NULL",
+            'confidence': 0.5 if i % 3 == 0 else "NULL"
+        }
+    return annotations
+
+
+def test_iter_object_items():
+    document = {"a": {"x": [1, 2.5, "é"]}, "b": 12345, "c": "}", "d": [], "e": None}
+    text = json.dumps(document).encode()
+
+    # split at every possible point, including inside multi-byte characters
+    for size in [1, 2, 3, 7, len(text)]:
+        chunks = [text[i:i+size] for i in range(0, len(text), size)]
+        assert dict(iterObjectItems(chunks)) == document, f"Failed to parse with chunk size {size}"
+
+    assert list(iterObjectItems([b" { } "])) == [], "Failed to parse empty object"
+
+
+def test_iter_annotations():
+    payload = annotationsPayload(100)
+
+    with LocalServer() as server:
+
+        @server.route("GET", "api/get_annotations")
+        def getAnnotations(handler, query, body):
+            return 200, {}, payload
+
+        conn = Connector("key", server.url)
+        annotations = conn.getAnnotations("project")
+        predictions = conn.getPredictions("project")
+        labelled = list(conn.iterAnnotations("project", predictions=False))
+
+    assert len(annotations) == 100, "Missing annotations"
+    assert annotations[0].id == 1000, "Wrong id"
+    assert len(predictions) == 34, "Wrong number of predictions"
+    assert all(p.confidence == 0.5 for p in predictions), "Not a prediction"
+    assert len(labelled) == 66 and all(a.confidence is None for a in labelled), "Wrong annotations"
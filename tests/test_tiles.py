@@ -0,0 +1,127 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import io
+import numpy as np
+from PIL import Image
+import projectkiwi.connector
+from projectkiwi.connector import Connector
+from projectkiwi.tools import decodeTile
+
+from local_server import LocalServer, pngBytes, serveTiles, localTileUrl
+
+
+def test_get_tiles(monkeypatch):
+    tiles = {(5, x, 3): np.full((256, 256, 3), x, dtype=np.uint8) for x in range(10)}
+
+    with LocalServer() as server:
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        serveTiles(server, tiles, fail=[(5, 4, 3)])
+
+        conn = Connector("key", server.url, max_retries=0)
+        zxys = [f"5/{x}/3" for x in range(10)]
+
+        errors = []
+        results = dict(conn.getTiles("abc", zxys, max_workers=3, on_error=lambda zxy, e: errors.append(zxy)))
+        assert len(results) == 9, "Missing tiles"
+        assert errors == ["5/4/3"], "Failure not reported"
+        assert results["5/7/3"][0, 0, 0] == 7, "Wrong tile"
+
+        ordered = list(conn.getTilesOrdered("abc", [(5, x, 3) for x in range(10)], max_workers=3, on_error=lambda zxy, e: None))
+        assert [zxy for zxy, _ in ordered] == [(5, x, 3) for x in range(10)], "Tiles out of order"
+        assert ordered[4][1] is None, "Failed tile should be None"
+        assert ordered[2][1][0, 0, 0] == 2, "Wrong tile"
+
+
+def test_decode_options():
+    rgba = np.zeros((512, 512, 4), dtype=np.uint8)
+    rgba[:, :, 0] = 200
+    rgba[:, :, 3] = 255
+    content = pngBytes(rgba)
+
+    assert decodeTile(content).shape == (512, 512, 4), "Wrong default decode"
+    assert decodeTile(content, drop_alpha=True).shape == (512, 512, 3), "Alpha not dropped"
+
+    small = decodeTile(content, drop_alpha=True, target_size=128)
+    assert small.shape == (128, 128, 3), "Not decoded at reduced size"
+    assert small[0, 0, 0] == 200, "Wrong pixel values"
+
+    out = np.empty((256, 256, 3), dtype=np.uint8)
+    result = decodeTile(content, out=out, drop_alpha=True, target_size=256)
+    assert result is out and out[10, 10, 0] == 200, "Not decoded into buffer"
+
+    jpeg = io.BytesIO()
+    Image.fromarray(rgba[:, :, :3]).save(jpeg, format="JPEG")
+    assert decodeTile(jpeg.getvalue(), target_size=64).shape == (64, 64, 3), "Bad jpeg draft decode"
+
+
+def test_raw_tiles(monkeypatch):
+    tiles = {(5, 1, 3): np.full((256, 256, 4), 9, dtype=np.uint8)}
+
+    with LocalServer() as server:
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        serveTiles(server, tiles)
+
+        conn = Connector("key", server.url)
+        content = conn.getTile("abc", 5, 1, 3, raw=True)
+        assert isinstance(content, bytes), "Expected encoded tile"
+        assert np.array_equal(decodeTile(content), tiles[(5, 1, 3)]), "Bad encoded tile"
+        assert conn.getTile("abc", 5, 1, 3, drop_alpha=True).shape == (256, 256, 3), "Alpha not dropped"
+
+
+def test_mosaic_super_tile(monkeypatch):
+    # zoom 6 tiles with a distinct value each, covering 5/10/12 and its neighbours
+    tiles = {}
+    for x in range(19, 23):
+        for y in range(23, 27):
+            tiles[(6, x, y)] = np.full((256, 256, 4), 10*(x - 19) + (y - 23), dtype=np.uint8)
+
+    with LocalServer() as server:
+        monkeypatch.setattr(projectkiwi.connector, "urlFromZxy", localTileUrl(server))
+        failures = []
+
+        @server.route("GET", "get_tile/*")
+        def getTile(handler, query, body):
+            z, x, y = [int(v) for v in handler.path.split("?")[0].strip("/").split("/")[-3:]]
+            # fail the first request for one child
+            if (x, y) == (21, 25) and not failures:
+                failures.append((x, y))
+                return 404, {}, b""
+            return 200, {}, pngBytes(tiles[(z, x, y)])
+
+        conn = Connector("key", server.url, max_retries=0)
+        tile = conn.getSuperTile("abc", "5/10/12", max_zoom=6, padding=20, mosaic=True, drop_alpha=True)
+
+    assert failures, "Child never failed"
+    assert tile.shape == (512 + 40, 512 + 40, 3), "Wrong size"
+    assert tile[20, 20, 0] == 11, "Wrong top left child"
+    assert tile[20 + 256, 20 + 256, 0] == 22, "Wrong bottom right child"
+    assert tile[0, 0, 0] == 0, "Wrong padding from neighbour"
+    assert tile[-1, -1, 0] == 33, "Wrong padding from neighbour"
+
+
+def test_tile_array():
+    from projectkiwi.models import TileArray
+    from projectkiwi.tools import num2deg
+
+    base = "https://api.projectkiwi.io/get_tile/im1/"
+    tileList = [{'zxy': f"18/{67240 + i}/{97430 + j}", 'url': f"{base}18/{67240 + i}/{97430 + j}"}
+            for i in range(20) for j in range(10)]
+    tiles = TileArray.from_list(tileList, "im1")
+    assert len(tiles) == 200 and tiles.urls is None, "Urls should share a template"
+    assert tiles[13].zxy == tileList[13]['zxy'] and tiles[13].url == tileList[13]['url'], "Wrong tile"
+    assert [tile.zxy for tile in tiles] == [tile['zxy'] for tile in tileList], "Wrong iteration"
+
+    # a bbox covering tiles x 67243..67245 and y 97432..97433
+    max_lat, min_lng = num2deg(67243.5, 97432.5, 18)
+    min_lat, max_lng = num2deg(67245.5, 97433.5, 18)
+    inside = tiles.filterBbox(min_lng, min_lat, max_lng, max_lat)
+    assert sorted(inside.zxys()) == [(18, x, y) for x in range(67243, 67246) for y in range(97432, 97434)], \
+        "Wrong tiles in bbox"
+    assert len(tiles.filterZoom(17)) == 0 and len(tiles.filterZoom(18)) == 200, "Wrong zoom filter"
+
+    # urls that don't follow a template are kept per tile
+    tileList[5]['url'] = "https://elsewhere/5"
+    tiles = TileArray.from_list(tileList, "im1")
+    assert tiles.urls is not None and tiles[5].url == "https://elsewhere/5", "Wrong url"
+    assert tiles[[5, 6]][0].url == "https://elsewhere/5", "Urls should follow indexing"
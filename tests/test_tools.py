@@ -0,0 +1,90 @@
+import sys, os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import math
+
+import numpy as np
+import torch
+
+from projectkiwi.tools import coordsFromPolygon, deg2num, latLngToImgCoords, lngLatToTile, num2deg, tileToLngLat
+
+
+def deg2numScalar(lat_deg, lon_deg, zoom):
+    n = 2.0 ** zoom
+    return (lon_deg + 180.0) / 360.0 * n, (1.0 - math.asinh(math.tan(math.radians(lat_deg))) / math.pi) / 2.0 * n
+
+
+def test_tile_math_arrays():
+    rng = np.random.default_rng(0)
+    lngLat = np.stack([rng.uniform(-180, 180, 500), rng.uniform(-85, 85, 500)], -1)
+
+    x, y = deg2num(41.8, -87.7, 12)
+    assert isinstance(x, float) and isinstance(y, float), "Scalars should give floats"
+    assert np.allclose((x, y), deg2numScalar(41.8, -87.7, 12), rtol=0, atol=1e-9), "Wrong scalar tile coordinates"
+
+    tile = lngLatToTile(lngLat, 18)
+    expected = np.array([deg2numScalar(lat, lng, 18) for lng, lat in lngLat])
+    assert tile.shape == (500, 2) and np.allclose(tile, expected, rtol=0, atol=1e-6), "Wrong tile coordinates"
+    assert np.allclose(tileToLngLat(tile, 18), lngLat, rtol=0, atol=1e-9), "Round trip should give the points back"
+
+    # broadcast over zoom: every point at zooms 0..19
+    zooms = np.arange(20)[:, None]
+    tiles = lngLatToTile(lngLat, zooms)
+    assert tiles.shape == (20, 500, 2), "Zoom should broadcast"
+    assert np.allclose(tiles[12], lngLatToTile(lngLat, 12), rtol=0, atol=1e-9), "Wrong tile coordinates for zoom"
+    lat, lng = num2deg(tiles[..., 0], tiles[..., 1], zooms)
+    assert np.allclose(lng, lngLat[:, 0], rtol=0, atol=1e-9) and np.allclose(lat, lngLat[:, 1], rtol=0, atol=1e-9), \
+        "Wrong lat, lng for zoom"
+
+    # tensors stay tensors
+    tensorTile = lngLatToTile(torch.from_numpy(lngLat), 18)
+    assert torch.is_tensor(tensorTile) and np.allclose(tensorTile.numpy(), tile, rtol=0, atol=1e-6), "Wrong tensor result"
+    assert torch.is_tensor(tileToLngLat(tensorTile, torch.tensor(18))), "Tensor should give a tensor"
+
+
+def test_polygon_conversions():
+    zxy = "12/1051/1522"
+    polygon = [[100, 100], [200, 100], [200, 200], [100, 200], [100, 100]]
+
+    coords = coordsFromPolygon(polygon, zxy, 256, padding=10)
+    assert isinstance(coords, list) and isinstance(coords[0], list) and len(coords) == 5, "Should be a list of [lng, lat]"
+    lat, lng = num2deg(1051 + 90/256, 1522 + 90/256, 12)
+    assert np.allclose(coords[0], [lng, lat], rtol=0, atol=1e-9), "Wrong corner"
+
+    pixels = latLngToImgCoords(coords, zxy, 256)
+    assert all(isinstance(p, tuple) and isinstance(p[0], int) for p in pixels), "Should be a list of int tuples"
+    for (px, py), (x, y) in zip(pixels, polygon):
+        assert abs(px - (x - 10)) <= 1 and abs(py - (y - 10)) <= 1, "Round trip should give the pixels back"
+
+    assert coordsFromPolygon([], zxy, 256) == [] and latLngToImgCoords([], zxy, 256) == [], "Empty polygons should work"
+
+
+def test_ragged_polygons():
+    from projectkiwi.tools import TileTransform, coordsFromPolygons, latLngsToImgCoords, raggedBounds, raggedFromPolygons
+
+    rng = np.random.default_rng(2)
+    zxy = "14/4204/6090"
+    polygons = [rng.uniform(-16, 272, (k, 2)).tolist() for k in [5, 3, 0, 12, 4]]
+    vertices, offsets = raggedFromPolygons(polygons)
+    assert vertices.shape == (24, 2) and offsets.tolist() == [0, 5, 8, 8, 20, 24], "Wrong ragged layout"
+
+    coords = coordsFromPolygons(vertices, offsets, zxy, 256, padding=16)
+    assert len(coords) == 5 and coords[2] == [], "Should be a polygon per offset"
+    for polygon, batched in zip(polygons, coords):
+        assert np.allclose(np.reshape(batched, (-1, 2)), np.reshape(coordsFromPolygon(polygon, zxy, 256, 16), (-1, 2)),
+                rtol=0, atol=1e-10), "Batch should match coordsFromPolygon"
+
+    lngLat, lngLatOffsets = raggedFromPolygons(coords)
+    pixels = latLngsToImgCoords(lngLat, lngLatOffsets, zxy, 256)
+    for polygon, batched in zip(coords, pixels):
+        single = latLngToImgCoords(polygon, zxy, 256)
+        assert all(abs(a - b) <= 1 for p, q in zip(batched, single) for a, b in zip(p, q)), \
+            "Batch should match latLngToImgCoords"
+
+    # round trip through the per tile transform, with padding
+    transform = TileTransform(zxy, 256, padding=16)
+    assert np.allclose(transform.toPixels(transform.toLngLat(vertices)), vertices, rtol=0, atol=1e-6), "Round trip failed"
+
+    bounds = raggedBounds(vertices, offsets)
+    assert np.isnan(bounds[2]).all() and np.allclose(bounds[3], [*np.min(polygons[3], 0), *np.max(polygons[3], 0)]), \
+        "Wrong bounds"
@@ -0,0 +1,145 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import json
+import pytest
+from projectkiwi.connector import Connector
+
+from local_server import LocalServer
+
+
+def imageryServer(server, parts, broken=(), generation=None):
+    """ stand-in for the imagery upload routes, parts are stored in the parts dict.
+    With a generation list, only urls from the latest generation are accepted
+    """
+    completed = {}
+
+    if generation is not None:
+        @server.route("GET", "api/get_imagery_multipart_urls")
+        def refresh(handler, query, body):
+            generation[0] += 1
+            urls = [f"{server.url}upload/u1/g{generation[0]}/{n}" for n in query['parts'].split(",")]
+            return 200, {}, {'urls': urls}
+
+    @server.route("GET", "api/get_imagery_multipart_upload")
+    def start(handler, query, body):
+        urls = [f"{server.url}upload/u1/g0/{n + 1}" for n in range(int(query['parts']))]
+        return 200, {}, {'imagery_id': "img1", 'upload_id': "u1", 'urls': urls}
+
+    @server.route("PUT", "upload/u1/*")
+    def putPart(handler, query, body):
+        part = int(handler.path.strip("/").split("/")[-1])
+        if part in broken:
+            return 403, {}, b""
+        if generation is not None and f"/g{generation[0]}/" not in handler.path:
+            return 403, {}, b""
+        parts[part] = body
+        return 200, {'ETag': f'"etag{part}"'}, b""
+
+    @server.route("POST", "api/complete_imagery_multipart_upload")
+    def complete(handler, query, body):
+        data = json.loads(body)
+        assert [p['etag'] for p in data['parts']] == [f'"etag{n + 1}"' for n in range(len(data['parts']))]
+        completed['data'] = b"".join(parts[p['part_number']] for p in data['parts'])
+        return 200, {}, {'success': True}
+
+    return completed
+
+
+def test_multipart_upload(tmp_path):
+    filename = str(tmp_path / "ortho.tif")
+    content = os.urandom(10*1000 + 17)
+    with open(filename, "wb") as f:
+        f.write(content)
+
+    with LocalServer() as server:
+        parts = {}
+        broken = {4}
+        completed = imageryServer(server, parts, broken)
+
+        conn = Connector("key", server.url, max_retries=0)
+        reports = []
+
+        # the first attempt fails on one part, the rest are kept
+        with pytest.raises(Exception):
+            conn.addImagery(filename, "ortho", "project", part_size=1000, max_workers=3, progress=reports.append)
+        assert os.path.exists(filename + ".upload.json"), "No state saved"
+        assert len(parts) == 10, "Parts missing after first attempt"
+
+        broken.clear()
+        sent_before = len([r for r in server.requests if r[0] == "PUT"])
+        imagery_id = conn.addImagery(filename, "ortho", "project", part_size=1000, max_workers=3, progress=reports.append)
+        sent_after = len([r for r in server.requests if r[0] == "PUT"])
+
+    assert imagery_id == "img1", "Wrong imagery id"
+    assert sent_after - sent_before == 1, "Finished parts were uploaded again"
+    assert completed['data'] == content, "Upload corrupted"
+    assert reports[-1].bytes_sent == len(content) and reports[-1].parts_done == 11, "Bad progress"
+    assert not os.path.exists(filename + ".upload.json"), "State not cleaned up"
+
+
+def test_single_upload_fallback(tmp_path):
+    filename = str(tmp_path / "ortho.tif")
+    with open(filename, "wb") as f:
+        f.write(b"x"*3000)
+
+    with LocalServer() as server:
+        uploaded = {}
+
+        @server.route("GET", "api/get_imagery_upload_url")
+        def uploadUrl(handler, query, body):
+            return 200, {}, {'imagery_id': "img2", 'url': f"{server.url}upload/single"}
+
+        @server.route("PUT", "upload/single")
+        def put(handler, query, body):
+            uploaded['data'] = body
+            return 200, {}, b""
+
+        conn = Connector("key", server.url)
+        assert conn.addImagery(filename, "ortho", "project", part_size=1000) == "img2", "Wrong imagery id"
+        assert uploaded['data'] == b"x"*3000, "Upload corrupted"
+
+
+
+def test_multipart_expired_urls(tmp_path):
+    filename = str(tmp_path / "ortho.tif")
+    content = os.urandom(5*1000 + 3)
+    with open(filename, "wb") as f:
+        f.write(content)
+
+    with LocalServer() as server:
+        parts = {}
+        generation = [1]
+        # every url handed out when the upload starts has already expired
+        completed = imageryServer(server, parts, generation=generation)
+
+        conn = Connector("key", server.url, max_retries=0)
+        assert conn.addImagery(filename, "ortho", "project", part_size=1000, max_workers=3) == "img1", "Wrong imagery id"
+        assert completed['data'] == content, "Upload corrupted"
+        refreshes = [r for r in server.requests if "get_imagery_multipart_urls" in r[1]]
+        assert len(refreshes) == 1, "Urls should be refreshed once for all the parts"
+
+        # resuming from an old state file gets new urls before sending anything
+        stat = os.stat(filename)
+        state = {
+            'fingerprint': {'project_id': "project", 'name': "ortho", 'size': len(content),
+                    'mtime': stat.st_mtime, 'part_size': 1000},
+            'imagery_id': "img1",
+            'upload_id': "u1",
+            'urls': [f"{server.url}upload/u1/g0/{n + 1}" for n in range(6)],
+            'etags': {'1': '"etag1"'}
+        }
+        with open(filename + ".upload.json", "w") as f:
+            json.dump(state, f)
+        puts = len([r for r in server.requests if r[0] == "PUT"])
+        assert conn.addImagery(filename, "ortho", "project", part_size=1000) == "img1", "Resume failed"
+        assert len([r for r in server.requests if r[0] == "PUT"]) - puts == 5, "Only the missing parts should be sent, once"
+        assert completed['data'] == content, "Resumed upload corrupted"
+
+        # every part was sent before the urls expired, only the completion is left
+        state['etags'] = {str(n + 1): f'"etag{n + 1}"' for n in range(6)}
+        with open(filename + ".upload.json", "w") as f:
+            json.dump(state, f)
+        requests = len(server.requests)
+        assert conn.addImagery(filename, "ortho", "project", part_size=1000) == "img1", "Completion failed"
+        assert [r[1] for r in server.requests[requests:]] == ["/api/complete_imagery_multipart_upload"], "Only the completion should be sent"
@@ -0,0 +1,105 @@
+import sys,os
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(__file__))
+import json
+import threading
+from projectkiwi.connector import Connector
+from projectkiwi.models import Annotation
+from projectkiwi.uploader import PredictionUploader
+
+from local_server import LocalServer
+
+
+def makePrediction(i):
+    return Annotation(
+        shape="Polygon",
+        label_id=374,
+        imagery_id="93650ec6508a",
+        coordinates=[
+            [-87.612448, 41.867452],
+            [-87.605238, 41.867452],
+            [-87.605238, 41.852301],
+            [-87.612448, 41.852301],
+            [-87.612448, 41.867452]],
+        confidence = i / 100)
+
+
+def test_batched_upload():
+    with LocalServer() as server:
+        received = []
+        lock = threading.Lock()
+
+        @server.route("POST", "api/add_predictions")
+        def addPredictions(handler, query, body):
+            predictions = json.loads(body)['predictions']
+            with lock:
+                received.extend(predictions)
+            return 200, {}, {'annotation_ids': list(range(len(predictions)))}
+
+        conn = Connector("key", server.url)
+        with PredictionUploader(conn, "project", num_workers=2, batch_size=10, max_queue=5) as uploader:
+            for i in range(95):
+                uploader.add(makePrediction(i))
+
+        summary = uploader.summary()
+        assert summary.uploaded == 95 and summary.failed == 0, f"Bad summary: {summary}"
+        assert len(received) == 95, "Missing predictions"
+        assert len(server.requests) < 95, "Predictions were not batched"
+
+
+def test_single_upload_fallback():
+    with LocalServer() as server:
+        singles = []
+
+        @server.route("POST", "api/add_prediction")
+        def addPrediction(handler, query, body):
+            singles.append(json.loads(body))
+            return 200, {}, {'annotation_id': len(singles)}
+
+        conn = Connector("key", server.url)
+        ids = conn.addPredictions([makePrediction(i) for i in range(3)], "project")
+        assert ids == [1, 2, 3], "Fallback to single predictions failed"
+        assert conn._batch_predictions is False, "Should remember that batches aren't supported"
+
+
+def test_failed_upload():
+    class FailingConnector():
+        def addPredictions(self, annotations, project):
+            raise RuntimeError("no network")
+
+    uploader = PredictionUploader(FailingConnector(), "project", num_workers=1)
+    for i in range(4):
+        uploader.add(makePrediction(i))
+    summary = uploader.flush()
+    assert summary.failed == 4 and summary.uploaded == 0, f"Bad summary: {summary}"
+    assert "no network" in summary.errors[0], "Error not recorded"
+
+
+def test_partial_fallback_not_resent():
+    from projectkiwi.uploader import PartialUploadError
+
+    with LocalServer() as server:
+        singles = []
+
+        @server.route("POST", "api/add_prediction")
+        def addPrediction(handler, query, body):
+            singles.append(json.loads(body))
+            if len(singles) == 3:
+                return 500, {}, b""
+            return 200, {}, {'annotation_id': len(singles)}
+
+        conn = Connector("key", server.url, backoff_factor=0.01)
+        conn._batch_predictions = False
+        try:
+            conn.addPredictions([makePrediction(i) for i in range(4)], "project")
+            assert False, "Should have raised"
+        except PartialUploadError as e:
+            assert e.annotation_ids == [1, 2, None, None], "Wrong ids for the added predictions"
+
+        singles.clear()
+        with PredictionUploader(conn, "project", num_workers=1, batch_size=4) as uploader:
+            for i in range(4):
+                uploader.add(makePrediction(i))
+        summary = uploader.summary()
+        assert summary.uploaded == 2 and summary.failed == 2, f"Bad summary: {summary}"
+        assert len(singles) == 3, "Predictions that were added should not be sent again"